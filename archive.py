@@ -0,0 +1,635 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import collections
+import hashlib
+import logging
+import multiprocessing
+import multiprocessing.pool
+import os
+import os.path
+import stat
+import struct
+import subprocess
+import tarfile
+import threading
+import time
+import zlib
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+COMPRESSION_ALGORITHMS = ('gzip', 'xz', 'none')
+
+COMPRESSION_EXTENSIONS = {
+        'gzip': '.gz',
+        'xz': '.xz',
+        'none': '',
+        }
+
+# Uncompressed bytes per independently compressed block in parallel gzip.
+GZIP_BLOCK_SIZE = 1 << 20
+
+_COPY_CHUNK_SIZE = 1 << 20
+
+# The first magic number of .pyc files with a flags field (Python 3.7).
+PYC_FLAGS_MAGIC_NUMBER = 3392
+
+# Python 2 magic numbers are all above those of Python 3.
+PYTHON2_MIN_MAGIC_NUMBER = 20000
+
+# Block size for xz in reproducible builds, so the output doesn't depend on
+# the number of threads.
+XZ_BLOCK_SIZE = 1 << 24
+
+ManifestEntry = collections.namedtuple('ManifestEntry',
+        ('kind', 'mode', 'src_path', 'data', 'link_target'))
+
+
+class PackageManifest(object):
+    """A description of the contents of a package.
+
+    Entries refer to the files that make up the package where they already
+    are, so a package can be written without first copying everything into
+    a staging hierarchy.
+
+    Paths in the manifest are relative to the root of the package and use
+    "/" as separator. The parent directories of every entry are added
+    implicitly.
+
+    Attributes:
+        entries: dict of ManifestEntrys keyed by path
+    """
+    def __init__(self):
+        self.entries = {}
+
+    def add_directory(self, path, mode=0755):
+        path = self._normalize_path(path)
+        if path:
+            self._add_parent_directories(path)
+        self.entries[path] = ManifestEntry('d', mode, None, None, None)
+
+    def add_file(self, path, src_path, mode=None):
+        """Add a file whose contents are read from src_path when written."""
+        if mode is None:
+            mode = stat.S_IMODE(os.stat(src_path).st_mode)
+        path = self._normalize_path(path)
+        self._add_parent_directories(path)
+        self.entries[path] = ManifestEntry('f', mode, src_path, None, None)
+
+    def add_data(self, path, data, mode=0644):
+        """Add a file with the given contents."""
+        path = self._normalize_path(path)
+        self._add_parent_directories(path)
+        self.entries[path] = ManifestEntry('f', mode, None, data, None)
+
+    def add_symlink(self, path, link_target):
+        path = self._normalize_path(path)
+        self._add_parent_directories(path)
+        self.entries[path] = ManifestEntry('l', 0777, None, None,
+                link_target)
+
+    def add_entry(self, path, entry):
+        """Add a ManifestEntry, such as one taken from another manifest."""
+        path = self._normalize_path(path)
+        if path:
+            self._add_parent_directories(path)
+        self.entries[path] = entry
+
+    def add_tree(self, src_root, path, exclude=()):
+        """Add a directory tree, preserving symlinks.
+
+        Args:
+            src_root: The filesystem path of the root of the tree
+            path: The path in the package to add the tree at
+            exclude: Paths relative to src_root to leave out. See scan_tree.
+        """
+        path = self._normalize_path(path)
+        self.add_directory(path,
+                stat.S_IMODE(os.stat(src_root).st_mode))
+        for rel_path, file_stat in scan_tree(src_root, exclude):
+            full_path = os.path.join(src_root, rel_path)
+            entry_path = os.path.normpath(os.path.join(path, rel_path))
+            mode = stat.S_IMODE(file_stat.st_mode)
+            if stat.S_ISLNK(file_stat.st_mode):
+                self.entries[entry_path] = ManifestEntry('l', mode, None,
+                        None, os.readlink(full_path))
+            elif stat.S_ISDIR(file_stat.st_mode):
+                self.entries[entry_path] = ManifestEntry('d', mode, None,
+                        None, None)
+            else:
+                self.entries[entry_path] = ManifestEntry('f', mode,
+                        full_path, None, None)
+
+    def _add_parent_directories(self, path):
+        parent = os.path.dirname(path)
+        while parent and parent not in self.entries:
+            self.entries[parent] = ManifestEntry('d', 0755, None, None, None)
+            parent = os.path.dirname(parent)
+
+    def _normalize_path(self, path):
+        path = os.path.normpath(path).lstrip('/')
+        if path == '.':
+            return ''
+        return path
+
+
+def scan_tree(src_root, exclude=()):
+    """List the entries of a directory tree.
+
+    Excluded entries are left out, and so are directories that are left
+    empty because everything in them is excluded.
+
+    Args:
+        src_root: The filesystem path of the root of the tree
+        exclude: Paths relative to src_root to leave out
+
+    Returns: A sorted list of (relative path, lstat result) tuples.
+    """
+    exclude = frozenset(exclude)
+    entries = {}
+    pruned_dirs = set()
+    for dirpath, subdirs, filenames in os.walk(src_root):
+        for name in subdirs + filenames:
+            full_path = os.path.join(dirpath, name)
+            rel_path = os.path.relpath(full_path, src_root)
+            if rel_path in exclude:
+                pruned_dirs.add(os.path.dirname(rel_path))
+                continue
+            entries[rel_path] = os.lstat(full_path)
+
+    if pruned_dirs:
+        child_counts = collections.defaultdict(int)
+        for rel_path in entries:
+            child_counts[os.path.dirname(rel_path)] += 1
+        # Children sort after their parents, so reverse order sees a
+        # directory only after all of its contents.
+        for rel_path in sorted(entries, reverse=True):
+            if (rel_path in pruned_dirs and not child_counts[rel_path] and
+                    stat.S_ISDIR(entries[rel_path].st_mode)):
+                del entries[rel_path]
+                parent = os.path.dirname(rel_path)
+                child_counts[parent] -= 1
+                pruned_dirs.add(parent)
+
+    return sorted(entries.iteritems())
+
+
+def get_installed_size(manifest):
+    """Get the disk space a package's files take, as dpkg estimates it.
+
+    Every file takes its size rounded up to a whole KiB, and every directory
+    and symlink takes one KiB.
+
+    Args:
+        manifest: The PackageManifest of the data of the package
+
+    Returns: The size in KiB.
+    """
+    installed_size = 0
+    for entry in manifest.entries.itervalues():
+        if entry.kind != 'f':
+            installed_size += 1
+            continue
+        if entry.src_path is not None:
+            size = os.stat(entry.src_path).st_size
+        else:
+            size = len(entry.data)
+        installed_size += (size + 1023) // 1024
+    return installed_size
+
+
+def get_md5sums(manifest, digest_cache=None, source_date_epoch=None,
+        jobs=None):
+    """Get the MD5 digests of the files of a manifest as they are written.
+
+    Files are hashed on a pool of worker threads. Digests of files that are
+    written as they are come from the digest cache when one is given.
+
+    Args:
+        manifest: The PackageManifest to get the digests of
+        digest_cache: A digg.dev.hackbuilder.digest.DigestCache, or None to
+            hash every file
+        source_date_epoch: See write_tar. Files whose contents write_tar
+            changes are hashed as written.
+        jobs: The number of threads to hash with. This defaults to the
+            number of CPUs.
+
+    Returns: A sorted list of (path, hex digest) tuples.
+    """
+    src_paths = []
+    normalized_paths = []
+    md5sums = {}
+    for path, entry in manifest.entries.iteritems():
+        if entry.kind != 'f':
+            continue
+        if entry.src_path is None:
+            md5sums[path] = hashlib.md5(entry.data).hexdigest()
+        elif source_date_epoch is not None and path.endswith('.pyc'):
+            normalized_paths.append(path)
+        else:
+            src_paths.append(path)
+
+    def hash_normalized_file(path):
+        with open(manifest.entries[path].src_path, 'rb') as f:
+            return hashlib.md5(normalize_pyc_header(f.read(),
+                source_date_epoch)).hexdigest()
+
+    md5sums.update(zip(normalized_paths,
+            digg.dev.hackbuilder.util.run_in_parallel(hash_normalized_file,
+                normalized_paths, jobs)))
+    full_paths = [manifest.entries[path].src_path for path in src_paths]
+    if digest_cache is None:
+        digests = digg.dev.hackbuilder.util.run_in_parallel(
+                lambda full_path: digg.dev.hackbuilder.util.hash_file(
+                    full_path, 'md5'),
+                full_paths, jobs)
+    else:
+        digests = digest_cache.get_digests(full_paths, 'md5', jobs)
+    md5sums.update(zip(src_paths, digests))
+    return sorted(md5sums.iteritems())
+
+
+def write_tar(manifest, fileobj, source_date_epoch=None):
+    """Write the entries of a manifest as an uncompressed tar stream.
+
+    Entries are written in sorted order and owned by root.
+
+    When source_date_epoch is given, the output only depends on the contents
+    of the manifest: modification times are clamped to source_date_epoch,
+    modes are normalized and the timestamps in .pyc headers are clamped the
+    same way as the modification times of their sources.
+
+    Args:
+        manifest: The PackageManifest to write
+        fileobj: The file object to write the tar stream to
+        source_date_epoch: The latest modification time of any entry, or
+            None for a build that isn't reproducible
+    """
+    if source_date_epoch is None:
+        default_mtime = int(time.time())
+    else:
+        default_mtime = source_date_epoch
+
+    tar = tarfile.open(fileobj=fileobj, mode='w|',
+            format=tarfile.GNU_FORMAT)
+    try:
+        for path in sorted(manifest.entries):
+            entry = manifest.entries[path]
+            info = tarfile.TarInfo('./' + path if path else './')
+            info.mode = entry.mode
+            if source_date_epoch is not None:
+                info.mode = normalize_mode(entry.kind, entry.mode)
+            info.uid = info.gid = 0
+            info.uname = info.gname = 'root'
+            info.mtime = default_mtime
+            if entry.kind == 'd':
+                info.type = tarfile.DIRTYPE
+                tar.addfile(info)
+            elif entry.kind == 'l':
+                info.type = tarfile.SYMTYPE
+                info.linkname = entry.link_target
+                tar.addfile(info)
+            elif entry.src_path is not None:
+                with open(entry.src_path, 'rb') as f:
+                    file_stat = os.fstat(f.fileno())
+                    info.size = file_stat.st_size
+                    info.mtime = clamp_mtime(int(file_stat.st_mtime),
+                            source_date_epoch)
+                    if source_date_epoch is not None and path.endswith('.pyc'):
+                        data = normalize_pyc_header(f.read(),
+                                source_date_epoch)
+                        tar.addfile(info, _StringReader(data))
+                    else:
+                        tar.addfile(info, f)
+            else:
+                info.size = len(entry.data)
+                tar.addfile(info, _StringReader(entry.data))
+    finally:
+        tar.close()
+
+
+def clamp_mtime(mtime, source_date_epoch):
+    if source_date_epoch is None:
+        return mtime
+    return min(mtime, source_date_epoch)
+
+
+def normalize_mode(kind, mode):
+    """Get the mode a package entry gets in a reproducible build.
+
+    Directories and files with any execute bit become 0755 and other files
+    become 0644.
+    """
+    if kind == 'l':
+        return 0777
+    if kind == 'd' or mode & 0111:
+        return 0755
+    return 0644
+
+
+def normalize_pyc_header(data, source_date_epoch):
+    """Clamp the source timestamp recorded in a .pyc file.
+
+    The timestamp is clamped the same way as the modification time of the
+    source file when it is packaged, so the .pyc file stays valid. Hash based
+    .pyc files are returned unchanged.
+
+    Args:
+        data: The contents of the .pyc file
+        source_date_epoch: The latest timestamp to allow
+
+    Returns: The contents of the normalized .pyc file
+    """
+    if len(data) < 8:
+        return data
+    (magic_number,) = struct.unpack('<H', data[:2])
+    timestamp_offset = 4
+    if PYC_FLAGS_MAGIC_NUMBER <= magic_number < PYTHON2_MIN_MAGIC_NUMBER:
+        # Python 3.7+ has a flags field, which is zero for timestamp based
+        # .pyc files.
+        if len(data) < 12 or data[4:8] != '\0\0\0\0':
+            return data
+        timestamp_offset = 8
+    (timestamp,) = struct.unpack('<I',
+            data[timestamp_offset:timestamp_offset + 4])
+    timestamp = clamp_mtime(timestamp, source_date_epoch)
+    return (data[:timestamp_offset] + struct.pack('<I', timestamp) +
+            data[timestamp_offset + 4:])
+
+
+class _StringReader(object):
+    def __init__(self, data):
+        self._data = data
+        self._offset = 0
+
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self._data) - self._offset
+        chunk = self._data[self._offset:self._offset + size]
+        self._offset += len(chunk)
+        return chunk
+
+
+def open_compressor(fileobj, algorithm, level=9, threads=None,
+        source_date_epoch=None):
+    """Open a file object that compresses what is written to it.
+
+    Args:
+        fileobj: The file object to write compressed data to
+        algorithm: One of COMPRESSION_ALGORITHMS
+        level: The compression level from 1 to 9
+        threads: The number of threads to compress with. This defaults to
+            the number of CPUs.
+        source_date_epoch: The timestamp to record in the compressed data
+            of a reproducible build, or None if the build isn't reproducible
+
+    Returns: A file object with write and close methods. Closing it does not
+        close fileobj.
+    """
+    if threads is None:
+        threads = multiprocessing.cpu_count()
+    if algorithm == 'gzip':
+        return ParallelGzipWriter(fileobj, level, threads, source_date_epoch)
+    elif algorithm == 'xz':
+        if source_date_epoch is not None:
+            # Single threaded xz writes a different format of blocks, so
+            # always use its threaded mode with a fixed block size.
+            threads = max(threads, 2)
+        command = ['xz', '-z', '-c', '-%d' % (level,), '-T%d' % (threads,)]
+        if source_date_epoch is not None:
+            command.append('--block-size=%d' % (XZ_BLOCK_SIZE,))
+        return ExternalCompressorWriter(fileobj, command)
+    elif algorithm == 'none':
+        return _UncompressedWriter(fileobj)
+    raise digg.dev.hackbuilder.errors.Error(
+            'Unknown compression algorithm: %s' % (algorithm,))
+
+
+class _UncompressedWriter(object):
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+
+    def write(self, data):
+        self._fileobj.write(data)
+
+    def close(self):
+        pass
+
+
+class ParallelGzipWriter(object):
+    """A writer of gzip data that compresses blocks on several threads.
+
+    The input is cut into blocks that are deflated independently. Every
+    block but the last ends with a sync flush, so the concatenation of the
+    blocks is a single valid deflate stream. The output is a plain,
+    single member gzip file.
+    """
+    def __init__(self, fileobj, level=9, threads=1, mtime=None):
+        self._fileobj = fileobj
+        self._level = level
+        self._threads = threads
+        self._buffer = []
+        self._buffer_size = 0
+        self._crc = zlib.crc32('') & 0xffffffff
+        self._size = 0
+        self._pending = collections.deque()
+        self._pool = None
+        if threads > 1:
+            self._pool = multiprocessing.pool.ThreadPool(threads)
+
+        if mtime is None:
+            mtime = int(time.time())
+        # Magic, deflate, no flags, mtime, no extra flags, unknown OS.
+        self._fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0,
+                mtime & 0xffffffff, 0, 255))
+
+    def write(self, data):
+        self._buffer.append(data)
+        self._buffer_size += len(data)
+        while self._buffer_size >= GZIP_BLOCK_SIZE:
+            data = ''.join(self._buffer)
+            self._buffer = [data[GZIP_BLOCK_SIZE:]]
+            self._buffer_size = len(self._buffer[0])
+            self._submit_block(data[:GZIP_BLOCK_SIZE], False)
+
+    def close(self):
+        try:
+            self._submit_block(''.join(self._buffer), True)
+            self._buffer = []
+            while self._pending:
+                self._fileobj.write(self._pending.popleft().get())
+        finally:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+        self._fileobj.write(struct.pack('<II', self._crc,
+                self._size & 0xffffffff))
+
+    def _submit_block(self, data, is_last):
+        self._crc = zlib.crc32(data, self._crc) & 0xffffffff
+        self._size += len(data)
+        if self._pool is None:
+            self._fileobj.write(_deflate_block(data, self._level, is_last))
+            return
+
+        self._pending.append(self._pool.apply_async(_deflate_block,
+                (data, self._level, is_last)))
+        # Keep memory use bounded by writing out finished blocks in order.
+        while len(self._pending) > 2 * self._threads:
+            self._fileobj.write(self._pending.popleft().get())
+
+
+def _deflate_block(data, level, is_last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    if is_last:
+        return compressor.compress(data) + compressor.flush(zlib.Z_FINISH)
+    return compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ExternalCompressorWriter(object):
+    """A writer that pipes data through an external compressor command."""
+    def __init__(self, fileobj, command):
+        self._fileobj = fileobj
+        self._command = command
+        try:
+            self._proc = subprocess.Popen(command, stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                    close_fds=True)
+        except OSError, e:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Unable to run compressor (%s): %s' % (command[0], e))
+        self._stderrdata = []
+        self._stdout_thread = threading.Thread(target=self._copy_stdout)
+        self._stdout_thread.daemon = True
+        self._stdout_thread.start()
+        self._stderr_thread = threading.Thread(target=self._read_stderr)
+        self._stderr_thread.daemon = True
+        self._stderr_thread.start()
+
+    def _copy_stdout(self):
+        for chunk in iter(lambda: self._proc.stdout.read(_COPY_CHUNK_SIZE),
+                          ''):
+            self._fileobj.write(chunk)
+
+    def _read_stderr(self):
+        self._stderrdata.append(self._proc.stderr.read())
+
+    def write(self, data):
+        self._proc.stdin.write(data)
+
+    def close(self):
+        self._proc.stdin.close()
+        self._stdout_thread.join()
+        self._stderr_thread.join()
+        retcode = self._proc.wait()
+        if retcode != 0:
+            logging.info('Compressor failed with exit code = %s', retcode)
+            logging.info('Compressor stderr:\n%s', ''.join(self._stderrdata))
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Compressor (%s) failed with exit code %s' %
+                    (self._command[0], retcode))
+
+
+class ArWriter(object):
+    """A writer of ar archives in the format used by Debian packages."""
+    def __init__(self, fileobj, mtime=None):
+        if mtime is None:
+            mtime = int(time.time())
+        self._fileobj = fileobj
+        self._mtime = mtime
+        self._fileobj.write('!<arch>\n')
+
+    def add_member(self, name, data):
+        self._fileobj.write(self._header(name, len(data)))
+        self._fileobj.write(data)
+        self._pad(len(data))
+
+    def add_streamed_member(self, name, write_contents):
+        """Add a member whose contents are streamed into the archive.
+
+        The output file must be seekable, since the size of the member is
+        only known once its contents are written.
+
+        Args:
+            name: The name of the member
+            write_contents: A function that is called with a file object
+                and writes the contents of the member to it
+        """
+        header_offset = self._fileobj.tell()
+        self._fileobj.write(self._header(name, 0))
+        write_contents(self._fileobj)
+        end_offset = self._fileobj.tell()
+        size = end_offset - header_offset - 60
+        self._fileobj.seek(header_offset)
+        self._fileobj.write(self._header(name, size))
+        self._fileobj.seek(end_offset)
+        self._pad(size)
+
+    def _header(self, name, size):
+        header = '%-16s%-12d%-6d%-6d%-8o%-10d`\n' % (name, self._mtime, 0, 0,
+                0100644, size)
+        assert len(header) == 60
+        return header
+
+    def _pad(self, size):
+        if size % 2:
+            self._fileobj.write('\n')
+
+
+def write_deb(output_path, control_manifest, data_manifest,
+        compression='gzip', compression_level=9, compression_threads=None,
+        source_date_epoch=None):
+    """Write a Debian binary package.
+
+    The package is streamed straight from the manifests. Only the finished
+    package is written to disk.
+
+    When source_date_epoch is given, the package is reproducible: the same
+    manifests produce the same bytes regardless of when, where or with how
+    many threads the package is built.
+
+    Args:
+        output_path: The path of the .deb file to write
+        control_manifest: The PackageManifest of the control archive
+        data_manifest: The PackageManifest of the data archive
+        compression: The compression algorithm for the data archive
+        compression_level: The compression level from 1 to 9
+        compression_threads: The number of threads to compress with
+        source_date_epoch: The latest modification time of any entry, or
+            None for a build that isn't reproducible
+    """
+    def write_tar_member(manifest, algorithm):
+        def write_contents(fileobj):
+            compressor = open_compressor(fileobj, algorithm,
+                    compression_level, compression_threads,
+                    source_date_epoch)
+            write_tar(manifest, compressor, source_date_epoch)
+            compressor.close()
+        return write_contents
+
+    temp_path = '%s.%d.tmp' % (output_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as f:
+            ar_writer = ArWriter(f, source_date_epoch)
+            ar_writer.add_member('debian-binary', '2.0\n')
+            ar_writer.add_streamed_member('control.tar.gz',
+                    write_tar_member(control_manifest, 'gzip'))
+            ar_writer.add_streamed_member(
+                    'data.tar' + COMPRESSION_EXTENSIONS[compression],
+                    write_tar_member(data_manifest, compression))
+        os.rename(temp_path, output_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
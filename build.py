@@ -21,8 +21,11 @@ import shutil
 import Queue
 
 import digg.dev.hackbuilder.common
+import digg.dev.hackbuilder.digest
+import digg.dev.hackbuilder.dir_listing_cache
 import digg.dev.hackbuilder.errors
 import digg.dev.hackbuilder.plugins
+import digg.dev.hackbuilder.toolchain
 import digg.dev.hackbuilder.util
 from digg.dev.hackbuilder.plugin_utils import BinaryBuilder
 from digg.dev.hackbuilder.plugin_utils import PackageBuilder
@@ -46,14 +49,20 @@ class BuildFileReader(object):
             return self.cached_build_file_targets[build_file_dirname]
 
         build_file_filename = os.path.join(self.normalizer.repo_root_path,
-                build_file_dirname[1:], 'HACK_BUILD')
+                build_file_dirname[1:],
+                digg.dev.hackbuilder.common.BUILD_FILENAME)
+        listed_dirs = set()
         build_file_locals = (
                 digg.dev.hackbuilder.plugins.get_all_build_file_rules(
-                    build_file_dirname, self.normalizer))
+                    build_file_dirname, self.normalizer, listed_dirs))
         logging.info('loading build file at: %s', build_file_filename)
         execfile(build_file_filename, {}, build_file_locals)
 
         build_file_targets = self._get_all_targets_from_global_queue()
+        # Globs in the build file could have given any of its targets
+        # different files.
+        for build_file_target in build_file_targets:
+            build_file_target.listed_dirs = sorted(listed_dirs)
 
         self.cached_build_file_targets[build_file_dirname] = build_file_targets
         return build_file_targets
@@ -105,13 +114,15 @@ class Build(object):
     def __init__(self, build_target_trees, normalizer,
             source_path=digg.dev.hackbuilder.common.DEFAULT_SOURCE_DIR,
             build_path=digg.dev.hackbuilder.common.DEFAULT_BUILD_DIR,
-            package_path=digg.dev.hackbuilder.common.DEFAULT_PACKAGE_DIR):
+            package_path=digg.dev.hackbuilder.common.DEFAULT_PACKAGE_DIR,
+            cache_path=digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR):
         self.build_target_trees = build_target_trees
         self.normalizer = normalizer
 
         self.source_path = source_path
         self.build_path = build_path
         self.package_path = package_path
+        self.cache_path = cache_path
 
         self.builders = {}
         if build_target_trees is not None:
@@ -125,11 +136,18 @@ class Build(object):
 
     def build(self):
         logging.info('Starting build.')
-        self.create_dirs()
-        self.do_create_source()
-        self.do_create_build_environment()
-        self.do_build_binary()
-        self.do_build_package()
+        try:
+            self.create_dirs()
+            self.do_create_source()
+            self.do_create_build_environment()
+            self.do_build_binary()
+            self.do_build_package()
+        finally:
+            # Digests, probes and the listings that globs in build files
+            # made before a failure are still good.
+            digg.dev.hackbuilder.digest.save_digest_caches()
+            digg.dev.hackbuilder.toolchain.save_toolchain_probes()
+            digg.dev.hackbuilder.dir_listing_cache.save_dir_listing_caches()
         logging.info('Finishing build.')
 
     def create_dirs(self):
@@ -144,6 +162,9 @@ class Build(object):
         logging.info('Creating package directory: %s', self.package_path)
         self._mkdir_in_repo_dir(self.package_path)
 
+        logging.info('Creating cache directory: %s', self.cache_path)
+        self._mkdir_in_repo_dir(self.cache_path)
+
     def _mkdir_in_repo_dir(self, path):
         full_path = os.path.join(self.normalizer.repo_root_path, path)
         logging.debug('Creating absolute directory: %s', full_path)
@@ -161,6 +182,9 @@ class Build(object):
         logging.info('Removing package hierarchy: %s', self.package_path)
         self._rmtree_in_repo_dir(self.package_path)
 
+        logging.info('Removing cache hierarchy: %s', self.cache_path)
+        self._rmtree_in_repo_dir(self.cache_path)
+
     def _rmtree_in_repo_dir(self, path):
         full_path = os.path.join(self.normalizer.repo_root_path, path)
         logging.debug('Removing absolute directory: %s', full_path)
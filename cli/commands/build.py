@@ -16,6 +16,7 @@ import logging
 import os.path
 
 import digg.dev.hackbuilder.build
+import digg.dev.hackbuilder.common
 import digg.dev.hackbuilder.target
 from digg.dev.hackbuilder.util import get_root_of_repo_directory_tree
 
@@ -23,6 +24,16 @@ from digg.dev.hackbuilder.util import get_root_of_repo_directory_tree
 def do_build(args):
     logging.info('Entering build mode.')
 
+    if not args.reproducible:
+        args.source_date_epoch = None
+    else:
+        args.source_date_epoch = (
+                digg.dev.hackbuilder.common.get_source_date_epoch(
+                    args.source_date_epoch))
+    if args.source_date_epoch is not None:
+        logging.info('Building reproducibly with source date epoch: %s',
+                args.source_date_epoch)
+
     repo_root = get_root_of_repo_directory_tree()
     logging.info('Repository root: %s', repo_root)
 
@@ -53,4 +64,11 @@ def init_argparser(parser):
             default=[''],
             help='Targets to operate on.',
             nargs='*')
+    parser.add_argument('--reproducible', action='store_true',
+            help='Build packages that only depend on their inputs: entries '
+                 'are sorted, owned by root, get normalized modes and have '
+                 'their modification times clamped to the source date epoch.')
+    parser.add_argument('--source_date_epoch', default=None, type=int,
+            help='Latest modification time of anything in a reproducible '
+                 'package. (Default: $SOURCE_DATE_EPOCH, or 0)')
     parser.set_defaults(func=do_build)
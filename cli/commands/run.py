@@ -14,6 +14,7 @@
 
 import logging
 import os.path
+import sys
 
 import digg.dev.hackbuilder.build
 import digg.dev.hackbuilder.target
@@ -28,12 +29,37 @@ def do_run(args):
 
     normalizer = digg.dev.hackbuilder.target.Normalizer(repo_root)
 
-    build_file_reader = digg.dev.hackbuilder.build.BuildFileReader(normalizer)
     target_id = digg.dev.hackbuilder.target.TargetID.from_string(args.target)
     target_id = normalizer.normalize_target_id(target_id)
 
     target = digg.dev.hackbuilder.target.RunTarget(normalizer, target_id)
-    target.run(args.args)
+    bin_path = None
+    if not args.no_build:
+        bin_path = target.build(get_build_settings(args))
+    import_profile_path = None
+    if args.import_profile:
+        import_profile_path = os.path.abspath(args.import_profile_path)
+    sys.exit(target.run(args.args, import_profile_path, bin_path))
+
+
+def get_build_settings(args):
+    """Get the settings that builds for a run depend on.
+
+    These are the options that plugins add, which all subcommands share.
+    """
+    return dict((name, value) for name, value in vars(args).iteritems()
+                if name not in RUN_ARG_NAMES)
+
+
+# The options of the run subcommand itself, which don't affect builds.
+RUN_ARG_NAMES = frozenset([
+        'args',
+        'func',
+        'import_profile',
+        'import_profile_path',
+        'no_build',
+        'target',
+        ])
 
 
 def init_argparser(parser):
@@ -47,4 +73,14 @@ def init_argparser(parser):
             type=str,
             help='Command line arguments for the target.',
             nargs='*')
+    parser.add_argument('--no_build', action='store_true',
+            help='Run the binary as it is on disk, without building it '
+                 'first if it is out of date.')
+    parser.add_argument('--import_profile', action='store_true',
+            help='Time the imports of a python binary and report how long '
+                 'the modules of each library took to import.')
+    parser.add_argument('--import_profile_path',
+            default='import_profile.json',
+            help='Where to save the import profile as JSON. '
+                 '(Default: %(default)s)')
     parser.set_defaults(func=do_run)
@@ -12,6 +12,24 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os
+
 DEFAULT_SOURCE_DIR = 'hack-source'
 DEFAULT_BUILD_DIR = 'hack-build'
 DEFAULT_PACKAGE_DIR = 'hack-packages'
+DEFAULT_CACHE_DIR = 'hack-cache'
+BUILD_FILENAME = 'HACK_BUILD'
+
+
+def get_source_date_epoch(source_date_epoch=None):
+    """Get the time that a reproducible build clamps timestamps to.
+
+    Args:
+        source_date_epoch: The source date epoch given for the build, or None
+
+    Returns: source_date_epoch if it was given, otherwise the
+        SOURCE_DATE_EPOCH environment variable, or 0 if that isn't set.
+    """
+    if source_date_epoch is not None:
+        return source_date_epoch
+    return int(os.environ.get('SOURCE_DATE_EPOCH', 0))
@@ -0,0 +1,196 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import os.path
+import threading
+import time
+
+import digg.dev.hackbuilder.util
+
+DIGEST_CACHE_VERSION = 1
+DIGEST_CACHE_FILENAME = 'digest_cache.json'
+# Digests of files modified this recently aren't kept. A file could change
+# again within the resolution of its modification time, leaving its stat
+# data as it was when it was hashed.
+RACY_MTIME_SECONDS = 2
+# Files are hashed on worker threads once a batch has this many files to
+# hash. hashlib releases the GIL while it hashes large buffers.
+PARALLEL_HASH_MIN_FILES = 8
+# Entries used by the current process are always saved. Older entries are
+# dropped beyond this many, so the table doesn't grow without bounds.
+MAX_SAVED_ENTRIES = 200000
+
+_digest_caches = {}
+_digest_caches_lock = threading.Lock()
+
+
+def get_digest_cache(cache_root):
+    """Get the digest cache kept in a cache directory.
+
+    The cache is shared by everything in the process that hashes files, so
+    a file is only hashed once per change no matter how many builders need
+    its digest.
+
+    Args:
+        cache_root: The absolute path of the hack-cache directory
+    """
+    with _digest_caches_lock:
+        if cache_root not in _digest_caches:
+            _digest_caches[cache_root] = DigestCache(os.path.join(cache_root,
+                    DIGEST_CACHE_FILENAME))
+        return _digest_caches[cache_root]
+
+
+def save_digest_caches():
+    """Save every digest cache of the process that has new digests."""
+    with _digest_caches_lock:
+        digest_caches = _digest_caches.values()
+    for digest_cache in digest_caches:
+        digest_cache.save()
+
+
+def get_stat_key(file_stat):
+    """Get the cache key of a file's stat data.
+
+    A file whose device, inode, size and modification time are unchanged is
+    assumed to have unchanged contents.
+    """
+    mtime_ns = getattr(file_stat, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(file_stat.st_mtime * 1000000000)
+    return '%d:%d:%d:%d' % (file_stat.st_dev, file_stat.st_ino,
+            file_stat.st_size, mtime_ns)
+
+
+class DigestCache(object):
+    """A persistent table of file digests keyed by file stat data.
+
+    Digests are keyed by the stat data of the file rather than its path, so
+    hard links to a file share its digests. Files whose stat data doesn't
+    tell a later change apart, because they were modified too recently, are
+    hashed every time.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._used_keys = set()
+        self._dirty = False
+
+    def get_digest(self, path, algorithm='sha256'):
+        """Get the hex digest of a file.
+
+        Args:
+            path: The path of the file
+            algorithm: The name of a hashlib algorithm
+        """
+        return self.get_digests([path], algorithm)[0]
+
+    def get_digests(self, paths, algorithm='sha256', jobs=None):
+        """Get the hex digests of files.
+
+        Files that aren't in the cache are hashed on a pool of worker
+        threads when there are enough of them.
+
+        Args:
+            paths: The paths of the files
+            algorithm: The name of a hashlib algorithm
+            jobs: The number of threads to hash with. This defaults to the
+                number of CPUs.
+
+        Returns: A list of hex digests in the same order as paths.
+        """
+        paths = list(paths)
+        file_stats = [os.stat(path) for path in paths]
+        keys = [get_stat_key(file_stat) for file_stat in file_stats]
+        digests = [None] * len(paths)
+        missing_indexes = []
+        with self._lock:
+            entries = self._load()
+            self._used_keys.update(keys)
+            for index, key in enumerate(keys):
+                digest = entries.get(key, {}).get(algorithm)
+                if digest is None:
+                    missing_indexes.append(index)
+                else:
+                    digests[index] = digest
+
+        if len(missing_indexes) >= PARALLEL_HASH_MIN_FILES:
+            new_digests = digg.dev.hackbuilder.util.run_in_parallel(
+                    lambda index: digg.dev.hackbuilder.util.hash_file(
+                        paths[index], algorithm),
+                    missing_indexes, jobs)
+        else:
+            new_digests = [digg.dev.hackbuilder.util.hash_file(paths[index],
+                                                               algorithm)
+                           for index in missing_indexes]
+
+        racy_mtime = time.time() - RACY_MTIME_SECONDS
+        with self._lock:
+            for index, digest in zip(missing_indexes, new_digests):
+                digests[index] = digest
+                if file_stats[index].st_mtime >= racy_mtime:
+                    continue
+                self._entries.setdefault(keys[index], {})[algorithm] = digest
+                self._dirty = True
+        return digests
+
+    def save(self):
+        """Save the table if any digests were added since it was loaded."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict((key, self._entries[key])
+                           for key in self._used_keys
+                           if key in self._entries)
+            for key, entry in self._entries.iteritems():
+                if len(entries) >= MAX_SAVED_ENTRIES:
+                    break
+                entries.setdefault(key, entry)
+            self._dirty = False
+
+        logging.debug('Saving %d file digests to %s', len(entries), self.path)
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.path))
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': DIGEST_CACHE_VERSION, 'entries': entries},
+                    f, sort_keys=True)
+        os.rename(temp_path, self.path)
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                cache_data = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._entries
+        except ValueError:
+            logging.warning('Ignoring corrupt digest cache: %s', self.path)
+            return self._entries
+        if (isinstance(cache_data, dict) and
+                cache_data.get('version') == DIGEST_CACHE_VERSION):
+            self._entries = dict(
+                    (str(key), dict((str(algorithm), str(digest))
+                                    for algorithm, digest in entry.iteritems()))
+                    for key, entry in cache_data['entries'].iteritems())
+        return self._entries
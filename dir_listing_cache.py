@@ -0,0 +1,240 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import fnmatch
+import json
+import logging
+import os
+import os.path
+import stat
+import time
+
+import digg.dev.hackbuilder.common
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+DIR_LISTING_CACHE_VERSION = 1
+DIR_LISTING_CACHE_FILENAME = 'dir_listing_cache.json'
+# Listings of directories modified this recently aren't saved. A directory
+# could change again within the resolution of its modification time.
+RACY_MTIME_SECONDS = 2
+
+_dir_listing_caches = {}
+
+
+def get_dir_listing_cache(repo_root):
+    """Get the directory listing cache of a repository.
+
+    The cache is shared by everything in the process that lists directories
+    of the repository.
+    """
+    if repo_root not in _dir_listing_caches:
+        _dir_listing_caches[repo_root] = DirListingCache(os.path.join(
+                repo_root, digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR,
+                DIR_LISTING_CACHE_FILENAME))
+    return _dir_listing_caches[repo_root]
+
+
+def save_dir_listing_caches():
+    """Save every directory listing cache of the process."""
+    for dir_listing_cache in _dir_listing_caches.values():
+        dir_listing_cache.save()
+
+
+class DirListingCache(object):
+    """Directory listings, kept until their directory is modified.
+
+    Adding, removing or renaming an entry of a directory updates the
+    modification time of the directory, so a listing is valid for as long
+    as the directory keeps the modification time and inode it was listed
+    with. Checking that takes a stat of the directory, not a read of it.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._entries = None
+        self._dirty = False
+
+    def list_dir(self, dir_path):
+        """List a directory.
+
+        Symlinks are listed like files, so globs don't follow them.
+
+        Args:
+            dir_path: The absolute path of the directory
+
+        Returns: A pair of sorted lists of the names of the files and of the
+            subdirectories in the directory.
+        """
+        dir_stat = os.stat(dir_path)
+        key = [dir_stat.st_mtime, dir_stat.st_ino]
+        entries = self._load()
+        entry = entries.get(dir_path)
+        if entry is not None and entry['key'] == key:
+            return (entry['files'], entry['dirs'])
+
+        files = []
+        dirs = []
+        for name in sorted(os.listdir(dir_path)):
+            if stat.S_ISDIR(os.lstat(os.path.join(dir_path, name)).st_mode):
+                dirs.append(name)
+            else:
+                files.append(name)
+        entries[dir_path] = {
+                'key': key,
+                'files': files,
+                'dirs': dirs,
+                'racy': time.time() - dir_stat.st_mtime < RACY_MTIME_SECONDS,
+                }
+        self._dirty = True
+        return (files, dirs)
+
+    def glob(self, root, include, exclude=(), skip_dirs=frozenset(),
+            listed_dirs=None):
+        """Find the files under a directory that match glob patterns.
+
+        Patterns are relative to root and use / as the separator. "*", "?"
+        and "[...]" match within a path component, and a "**" component
+        matches any number of directories. Like the shell, wildcards only
+        match names starting with a dot if the pattern does too.
+
+        Args:
+            root: The absolute path of the directory to search
+            include: The patterns of the files to find
+            exclude: The patterns of the files to leave out
+            skip_dirs: The absolute paths of directories not to search
+            listed_dirs: None, or a set to add the absolute path of every
+                directory that was listed to. Adding or removing a file in
+                one of them can change the matches.
+
+        Returns: A sorted list of paths relative to root.
+        """
+        if isinstance(include, basestring) or isinstance(exclude, basestring):
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Glob patterns must be given as a list.')
+        matches = set()
+        for pattern in include:
+            matches.update(self._glob_parts(root, '', pattern.split('/'),
+                    skip_dirs, listed_dirs))
+        exclude_parts = [pattern.split('/') for pattern in exclude]
+        return sorted(match for match in matches
+                      if not any(_match_parts(match.split('/'), parts)
+                                 for parts in exclude_parts))
+
+    def _glob_parts(self, root, rel_dir, parts, skip_dirs, listed_dirs):
+        if not rel_dir:
+            if not os.path.isdir(root):
+                return []
+            full_dir = root
+        else:
+            full_dir = os.path.join(root, rel_dir)
+        if full_dir in skip_dirs:
+            return []
+        (files, dirs) = self.list_dir(full_dir)
+        if listed_dirs is not None:
+            listed_dirs.add(full_dir)
+        part = parts[0]
+        rest = parts[1:]
+        if part == '**' and not rest:
+            # A trailing ** matches every file under the directory.
+            rest = ['*']
+            parts = ['**', '*']
+        matches = []
+        if part == '**':
+            matches.extend(self._glob_parts(root, rel_dir, rest, skip_dirs,
+                    listed_dirs))
+            for name in _filter_names(dirs, '*'):
+                matches.extend(self._glob_parts(root,
+                        _join(rel_dir, name), parts, skip_dirs, listed_dirs))
+        elif rest:
+            for name in _filter_names(dirs, part):
+                matches.extend(self._glob_parts(root, _join(rel_dir, name),
+                        rest, skip_dirs, listed_dirs))
+        else:
+            matches.extend(_join(rel_dir, name)
+                           for name in _filter_names(files, part))
+        return matches
+
+    def save(self):
+        """Save the listings if any changed since they were loaded."""
+        if not self._dirty:
+            return
+        entries = dict((dir_path, {
+                           'key': entry['key'],
+                           'files': entry['files'],
+                           'dirs': entry['dirs'],
+                           })
+                       for dir_path, entry in self._entries.iteritems()
+                       if not entry['racy'])
+        logging.debug('Saving %d directory listings to %s', len(entries),
+                self.path)
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.path))
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': DIR_LISTING_CACHE_VERSION,
+                       'entries': entries}, f, sort_keys=True)
+        os.rename(temp_path, self.path)
+        self._dirty = False
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                cache_data = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._entries
+        except ValueError:
+            logging.warning('Ignoring corrupt directory listing cache: %s',
+                    self.path)
+            return self._entries
+        if (isinstance(cache_data, dict) and
+                cache_data.get('version') == DIR_LISTING_CACHE_VERSION):
+            self._entries = dict(
+                    (dir_path.encode('utf-8'), {
+                        'key': entry['key'],
+                        'files': [name.encode('utf-8')
+                                  for name in entry['files']],
+                        'dirs': [name.encode('utf-8')
+                                 for name in entry['dirs']],
+                        'racy': False,
+                        })
+                    for dir_path, entry in cache_data['entries'].iteritems())
+        return self._entries
+
+
+def _join(rel_dir, name):
+    return rel_dir + '/' + name if rel_dir else name
+
+
+def _filter_names(names, pattern):
+    if not pattern.startswith('.'):
+        names = [name for name in names if not name.startswith('.')]
+    return [name for name in names if fnmatch.fnmatchcase(name, pattern)]
+
+
+def _match_parts(path_parts, pattern_parts):
+    """Check if the components of a path match those of a glob pattern."""
+    if not pattern_parts:
+        return not path_parts
+    if pattern_parts[0] == '**':
+        return any(_match_parts(path_parts[i:], pattern_parts[1:])
+                   for i in xrange(len(path_parts) + 1))
+    return (bool(path_parts) and
+            fnmatch.fnmatchcase(path_parts[0], pattern_parts[0]) and
+            _match_parts(path_parts[1:], pattern_parts[1:]))
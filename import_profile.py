@@ -0,0 +1,269 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import collections
+import errno
+import json
+import logging
+import os
+import os.path
+import subprocess
+
+import digg.dev.hackbuilder.util
+
+OUTPUT_PATH_ENV_VAR = 'HACK_IMPORT_PROFILE_OUTPUT'
+
+# Modules that aren't loaded from a file, or from a file no target provides.
+BUILTIN_OWNER = '(builtin)'
+UNKNOWN_OWNER = '(other)'
+
+# The sitecustomize module that times the imports of a python program. It
+# runs under both Python 2 and 3.
+#
+# Every call to __import__ is timed. The modules that a call loads, and that
+# the imports it makes in turn don't, get the time the call took minus the
+# time of those nested imports. When a call loads a package along with its
+# submodule, the submodule gets the time.
+SITECUSTOMIZE_TEXT = r'''# Generated by hack. Times the imports of the program it runs in.
+import atexit
+import json
+import os
+import sys
+import time
+
+try:
+    import builtins
+except ImportError:
+    import __builtin__ as builtins
+
+_timer = getattr(time, 'perf_counter', time.time)
+_original_import = builtins.__import__
+_known_modules = set(sys.modules)
+# A [nested import seconds, loaded modules] pair per import in progress.
+_frames = []
+_records = []
+
+
+def _get_importer(args, kwargs):
+    globals_dict = args[0] if args else kwargs.get('globals')
+    if isinstance(globals_dict, dict):
+        return globals_dict.get('__name__')
+    return None
+
+
+def _take_new_modules():
+    global _known_modules
+    if len(sys.modules) == len(_known_modules):
+        return []
+    modules = set(sys.modules)
+    # Python 2 caches failed relative imports as None.
+    new_modules = [module for module in modules - _known_modules
+                   if sys.modules.get(module) is not None]
+    _known_modules = modules
+    return new_modules
+
+
+def _timed_import(name, *args, **kwargs):
+    # Modules go into sys.modules before they run, so modules that showed up
+    # since the last check belong to an import that is still in progress.
+    new_modules = _take_new_modules()
+    if _frames:
+        _frames[-1][1].extend(new_modules)
+    frame = [0.0, []]
+    _frames.append(frame)
+    start = _timer()
+    try:
+        return _original_import(name, *args, **kwargs)
+    finally:
+        elapsed = _timer() - start
+        _frames.pop()
+        if _frames:
+            _frames[-1][0] += elapsed
+        loaded_modules = sorted(frame[1] + _take_new_modules())
+        # Packages loaded on the way to a submodule get none of the time,
+        # since it can't be told apart from the submodule's.
+        leaf_modules = [module for module in loaded_modules
+                        if not any(other.startswith(module + '.')
+                                   for other in loaded_modules)]
+        importer = _get_importer(args, kwargs)
+        for module in loaded_modules:
+            self_seconds = 0.0
+            if module in leaf_modules:
+                self_seconds = (elapsed - frame[0]) / len(leaf_modules)
+            _records.append([
+                module,
+                getattr(sys.modules.get(module), '__file__', None),
+                importer,
+                self_seconds,
+                elapsed,
+                ])
+
+
+def _save_records(output_path):
+    with open(output_path, 'w') as f:
+        json.dump(_records, f)
+
+
+_output_path = os.environ.pop(%(env_var)r, None)
+# Python programs that this program starts aren't profiled.
+if _output_path is not None:
+    builtins.__import__ = _timed_import
+    atexit.register(_save_records, _output_path)
+''' % {'env_var': OUTPUT_PATH_ENV_VAR}
+
+ImportRecord = collections.namedtuple('ImportRecord',
+        ('module', 'path', 'importer', 'self_seconds', 'cumulative_seconds'))
+
+
+def run_with_import_profile(bin_path, args, profile_dir):
+    """Run a python binary with its imports timed.
+
+    The binary runs with a sitecustomize module that times its imports, so
+    this only works for binaries whose interpreter imports sitecustomize
+    from PYTHONPATH. A sitecustomize of the binary's own is shadowed.
+
+    Args:
+        bin_path: The path of the binary
+        args: The command line arguments for the binary
+        profile_dir: The directory to put the sitecustomize module and the
+            raw timings in
+
+    Returns: A pair of the exit code of the binary and a list of
+        ImportRecords in the order the modules finished loading.
+    """
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(profile_dir)
+    with open(os.path.join(profile_dir, 'sitecustomize.py'), 'w') as f:
+        f.write(SITECUSTOMIZE_TEXT)
+    output_path = os.path.join(profile_dir, 'records.json')
+    if os.path.lexists(output_path):
+        os.remove(output_path)
+
+    env = dict(os.environ)
+    env[OUTPUT_PATH_ENV_VAR] = output_path
+    env['PYTHONPATH'] = os.pathsep.join(
+            [profile_dir] + filter(None, [env.get('PYTHONPATH')]))
+    logging.info('Running %s with import profiling', bin_path)
+    returncode = subprocess.call([bin_path] + list(args), env=env)
+
+    try:
+        with open(output_path) as f:
+            records = [ImportRecord(*record) for record in json.load(f)]
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        logging.warning('%s exited without saving its import timings. '
+                'Was it killed or did it exit with os._exit?', bin_path)
+        records = []
+    return (returncode, records)
+
+
+def get_source_path(path):
+    """Get the path of the module that a module's __file__ stands for."""
+    if path.endswith(('.pyc', '.pyo')):
+        (dirname, filename) = os.path.split(path)
+        if os.path.basename(dirname) == '__pycache__':
+            # PEP 3147 bytecode, as in __pycache__/foo.cpython-37.pyc
+            return os.path.join(os.path.dirname(dirname),
+                    filename.split('.')[0] + '.py')
+        return path[:-1]
+    return path
+
+
+def get_module_owner(record, package_owners, file_owners):
+    """Get the owner of the module of an import record.
+
+    Modules in files that an owner installed belong to it. Other modules
+    belong to the owner of their closest package.
+
+    Args:
+        record: The ImportRecord of the module
+        package_owners: dict of owners keyed by dotted package name
+        file_owners: dict of owners keyed by absolute file path
+    """
+    if record.path is not None:
+        owner = file_owners.get(get_source_path(os.path.abspath(
+            record.path)))
+        if owner is not None:
+            return owner
+
+    name_parts = record.module.split('.')
+    while name_parts:
+        owner = package_owners.get('.'.join(name_parts))
+        if owner is not None:
+            return owner
+        name_parts.pop()
+
+    if record.path is None:
+        return BUILTIN_OWNER
+    return UNKNOWN_OWNER
+
+
+def aggregate_import_profile(records, package_owners, file_owners):
+    """Aggregate import timings by module and by owner.
+
+    Args:
+        records: The ImportRecords of a run
+        package_owners: See get_module_owner
+        file_owners: See get_module_owner
+
+    Returns: A dict with the modules of each owner and the time they took,
+        sorted from slowest to fastest, suitable for JSON.
+    """
+    owners = collections.defaultdict(list)
+    for record in records:
+        owners[get_module_owner(record, package_owners, file_owners)].append(
+                record)
+
+    owner_profiles = []
+    for owner, owner_records in owners.iteritems():
+        owner_records.sort(key=lambda r: (-r.self_seconds, r.module))
+        owner_profiles.append({
+                'owner': owner,
+                'self_seconds': sum(r.self_seconds for r in owner_records),
+                'modules': [{
+                        'module': r.module,
+                        'path': r.path,
+                        'imported_by': r.importer,
+                        'self_seconds': r.self_seconds,
+                        'cumulative_seconds': r.cumulative_seconds,
+                        } for r in owner_records],
+                })
+    owner_profiles.sort(key=lambda p: (-p['self_seconds'], p['owner']))
+    return {
+            'total_seconds': sum(p['self_seconds'] for p in owner_profiles),
+            'owners': owner_profiles,
+            }
+
+
+def format_import_profile(profile, modules_per_owner=10):
+    """Format an aggregated import profile as a report for people.
+
+    Args:
+        profile: The profile from aggregate_import_profile
+        modules_per_owner: The number of slowest modules to list per owner
+    """
+    lines = ['Import time: %.3fs in total' % (profile['total_seconds'],)]
+    for owner_profile in profile['owners']:
+        modules = owner_profile['modules']
+        lines.append('%9.3fs  %s (%d modules)' % (
+                owner_profile['self_seconds'], owner_profile['owner'],
+                len(modules)))
+        for module in modules[:modules_per_owner]:
+            lines.append('    %9.3fs self %9.3fs cumulative  %s' % (
+                    module['self_seconds'], module['cumulative_seconds'],
+                    module['module']))
+        if len(modules) > modules_per_owner:
+            lines.append('    ... %d more' %
+                    (len(modules) - modules_per_owner,))
+    return '\n'.join(lines) + '\n'
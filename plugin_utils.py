@@ -12,11 +12,15 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import errno
+import collections
 import logging
+import os
 import os.path
 
+import digg.dev.hackbuilder.source_mirror
+import digg.dev.hackbuilder.staging
 import digg.dev.hackbuilder.target
+import digg.dev.hackbuilder.util
 
 
 def normal_dep_targets_from_dep_strings(repo_path, normalizer, deps):
@@ -58,41 +62,112 @@ class StartScriptBuilder(BinaryLauncherBuilder):
 
 
 class PackageBuilder(Builder):
-    pass
+    """A builder of packages.
+
+    Binaries and start scripts add their files to a package through the
+    install_* methods. By default, these lay the files out in the package
+    hierarchy at full_package_hierarchy_dir, which subclasses must set.
+    Package builders that don't need a hierarchy on disk may override them.
+
+    Attributes:
+        source_date_epoch: The latest modification time of anything in a
+            reproducible package, or None if the package isn't reproducible
+    """
+    def __init__(self, target):
+        Builder.__init__(self, target)
+        self.source_date_epoch = None
+
+    def install_tree(self, src_root, dest_path, exclude=(),
+            third_party_paths=()):
+        """Install a directory tree into the package.
+
+        Args:
+            src_root: The root of the tree to install
+            dest_path: The absolute path of the tree in the package
+            exclude: Paths relative to src_root to leave out
+            third_party_paths: Paths relative to src_root of the files that
+                third party libraries provide. Package formats that keep
+                those apart from the rest use them; others ignore them.
+        """
+        full_dest_path = self.full_package_hierarchy_dir + dest_path
+        staging_manifest_path = os.path.join(self.target.target_build_dir,
+                'staging_manifests', dest_path.strip('/').replace('/', '_'))
+        digg.dev.hackbuilder.staging.stage_tree(src_root, full_dest_path,
+                staging_manifest_path, self.source_date_epoch, exclude)
+
+    def install_file_contents(self, dest_path, contents, mode=0644):
+        """Install a file with the given contents into the package.
+
+        Args:
+            dest_path: The absolute path of the file in the package
+            contents: The contents of the file
+            mode: The permission bits of the file
+        """
+        full_dest_path = self.full_package_hierarchy_dir + dest_path
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(full_dest_path))
+        with open(full_dest_path, 'w') as f:
+            f.write(contents)
+        os.chmod(full_dest_path, mode)
+        if self.source_date_epoch is not None:
+            os.utime(full_dest_path,
+                    (self.source_date_epoch, self.source_date_epoch))
+
+    def install_symlink(self, dest_path, link_target):
+        """Install a symlink into the package.
+
+        Args:
+            dest_path: The absolute path of the symlink in the package
+            link_target: The path the symlink points to
+        """
+        full_dest_path = self.full_package_hierarchy_dir + dest_path
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(full_dest_path))
+        if os.path.lexists(full_dest_path):
+            os.remove(full_dest_path)
+        os.symlink(link_target, full_dest_path)
+
+    def add_maintainer_script_fragment(self, script_name, fragment):
+        """Add shell code to run when the package is installed or removed.
+
+        Package formats that support maintainer scripts run the fragments
+        of a script in the order they were added. Others ignore them.
+
+        Args:
+            script_name: The Debian name of the script: preinst, postinst,
+                prerm or postrm
+            fragment: The shell code to add to the script
+        """
+        logging.warning('%s does not support %s scripts. Ignoring:\n%s',
+                self.target.target_id, script_name, fragment)
 
 
 class BinaryBuilder(BinaryLauncherBuilder):
     pass
 
 
+class SharedRuntimeBuilder(BinaryBuilder):
+    """A builder of a runtime that binaries in other packages share.
+
+    A runtime is installed by its own package, under the package's name in
+    lib_path. A package that uses the runtime passes it to its binaries as a
+    SharedRuntime in the shared_runtimes keyword argument of
+    do_pre_build_package_binary_install, so that the binaries can leave out
+    whatever the runtime provides.
+    """
+    pass
+
+
+# A shared runtime as seen by the packages that use it. install_path is the
+# absolute path the runtime's package installs it at.
+SharedRuntime = collections.namedtuple('SharedRuntime',
+        ('builder', 'install_path'))
+
+
 class LibraryBuilder(Builder):
     def do_create_source_tree_work(self):
         logging.info('Copying %s into source tree', self.target.target_id)
-        for filename in self.target.all_files:
-            src_filename = os.path.join(self.target.target_working_copy_dir, filename)
-            dest_filename = os.path.join(self.target.target_source_dir, filename)
-
-            try:
-                dest_dirname = os.path.dirname(dest_filename)
-                os.makedirs(dest_dirname)
-                logging.debug('Created directory: %s', dest_dirname)
-            except OSError, e:
-                if not e.errno == errno.EEXIST:
-                    raise
-                else:
-                    logging.debug('Directory already exists: %s', dest_dirname)
-            try:
-                rel_from_path = os.path.relpath(src_filename,
-                        os.path.dirname(dest_filename))
-                os.symlink(rel_from_path, dest_filename)
-                logging.debug('Symlinked %s to %s.', rel_from_path,
-                        dest_filename)
-            except OSError, e:
-                if e.errno != errno.EEXIST:
-                    raise
-                logging.debug('File already existed: %s', dest_filename)
-                if os.readlink(dest_filename) != rel_from_path:
-                    logging.debug('Symlink incorrect. Removing and '
-                            'symlinking %s to %s', rel_from_path, dest_filename)
-                    os.remove(dest_filename)
-                    os.symlink(rel_from_path, dest_filename)
+        digg.dev.hackbuilder.source_mirror.mirror_files(
+                self.target.all_files, self.target.target_working_copy_dir,
+                self.target.target_source_dir,
+                self.target.source_tree_manifest_path)
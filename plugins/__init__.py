@@ -12,8 +12,11 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import os.path
 import Queue
 
+import digg.dev.hackbuilder.common
+import digg.dev.hackbuilder.dir_listing_cache
 import digg.dev.hackbuilder.errors
 
 
@@ -21,6 +24,7 @@ plugin_names = [
         'debian',
         'generic',
         'macosx',
+        'oci',
         'python',
         ]
 
@@ -31,9 +35,36 @@ def _get_all_build_file_rules_generators(plugins):
 
     return build_file_rules_generators
 
-def get_all_build_file_rules(repo_path, normalizer):
-    all_build_file_rules = {}
-    all_build_file_rules_keys = set()
+def build_file_glob(repo_path, normalizer, listed_dirs=None):
+    def glob(include=('**',), exclude=()):
+        """Find the files in the directory of a build file.
+
+        See digg.dev.hackbuilder.dir_listing_cache.DirListingCache.glob for
+        the patterns. The directories hack writes into aren't searched, and
+        the ones that are get added to listed_dirs.
+
+        Returns: A sorted list of paths relative to the build file.
+        """
+        repo_root = normalizer.repo_root_path
+        skip_dirs = frozenset(os.path.join(repo_root, dir_name)
+                for dir_name in (
+                    digg.dev.hackbuilder.common.DEFAULT_SOURCE_DIR,
+                    digg.dev.hackbuilder.common.DEFAULT_BUILD_DIR,
+                    digg.dev.hackbuilder.common.DEFAULT_PACKAGE_DIR,
+                    digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR))
+        dir_listing_cache = (
+                digg.dev.hackbuilder.dir_listing_cache.get_dir_listing_cache(
+                    repo_root))
+        return dir_listing_cache.glob(os.path.join(repo_root, repo_path[1:]),
+                include, exclude, skip_dirs, listed_dirs)
+
+    return glob
+
+
+def get_all_build_file_rules(repo_path, normalizer, listed_dirs=None):
+    all_build_file_rules = {'glob': build_file_glob(repo_path, normalizer,
+            listed_dirs)}
+    all_build_file_rules_keys = set(all_build_file_rules)
     duplicate_keys = set()
     for plugin in plugin_modules:
         build_file_rules = plugin.build_file_rules_generator(repo_path,
@@ -12,41 +12,132 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import collections
 import logging
 import os.path
-import subprocess
 
+import digg.dev.hackbuilder.archive
+import digg.dev.hackbuilder.digest
 import digg.dev.hackbuilder.target
+import digg.dev.hackbuilder.toolchain
 import digg.dev.hackbuilder.plugin_utils
+import digg.dev.hackbuilder.util
 from digg.dev.hackbuilder.plugins import build_file_targets
 from digg.dev.hackbuilder.plugin_utils \
         import normal_dep_targets_from_dep_strings
 from digg.dev.hackbuilder.plugin_utils import BinaryLauncherBuilder
+from digg.dev.hackbuilder.plugin_utils import SharedRuntime
+from digg.dev.hackbuilder.plugin_utils import SharedRuntimeBuilder
+
+MAINTAINER_SCRIPT_NAMES = ('preinst', 'postinst', 'prerm', 'postrm')
+
+
+def add_argparser_arguments(parser):
+    parser.add_argument('--deb_compression', default='gzip',
+            choices=digg.dev.hackbuilder.archive.COMPRESSION_ALGORITHMS,
+            help='Compression algorithm for the data of Debian packages. '
+                 '(Default: gzip)')
+    parser.add_argument('--deb_compression_level', default=9, type=int,
+            choices=range(1, 10),
+            help='Compression level for Debian packages. (Default: 9)')
+    parser.add_argument('--deb_compression_threads', default=None, type=int,
+            help='Number of threads to compress Debian packages with. '
+                 '(Default: number of CPUs)')
 
 
 class DebianPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
+    """A builder of Debian binary packages.
+
+    Rather than laying the package out on disk for dpkg-deb, the contents of
+    the package are collected in manifests and streamed straight into the
+    .deb file.
+    """
     def __init__(self, target):
         digg.dev.hackbuilder.plugin_utils.PackageBuilder.__init__(self, target)
 
-        self.full_package_hierarchy_dir = os.path.join(
-                self.target.target_build_dir, 'dpkg_hierarchy')
+        self.control_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        self.data_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        self.data_manifest.add_directory('/')
+        self.deb_arch = None
+        self.source_date_epoch = ARGS.source_date_epoch
+        self.dpkg_deps = set(self.target.dpkg_deps)
+        self.maintainer_script_fragments = collections.defaultdict(list)
+
+    def install_tree(self, src_root, dest_path, exclude=(),
+            third_party_paths=()):
+        self.data_manifest.add_tree(src_root, dest_path, exclude)
+
+    def install_file_contents(self, dest_path, contents, mode=0644):
+        self.data_manifest.add_data(dest_path, contents, mode)
+
+    def install_symlink(self, dest_path, link_target):
+        self.data_manifest.add_symlink(dest_path, link_target)
+
+    def add_maintainer_script_fragment(self, script_name, fragment):
+        if script_name not in MAINTAINER_SCRIPT_NAMES:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Unknown Debian maintainer script: %s' % (script_name,))
+        # Binaries sharing a virtualenv may add the same fragment.
+        fragments = self.maintainer_script_fragments[script_name]
+        if fragment not in fragments:
+            fragments.append(fragment)
 
     def do_pre_build_package_binary_install(self, builders):
-        logging.info('Copying built binaries to package hierarchy for %s',
+        logging.info('Adding built binaries to package for %s',
                 self.target.target_id)
 
         package_data = {
                 'bin_path': '/usr/bin',
                 'sbin_path': '/usr/sbin',
                 'lib_path': '/usr/lib',
+                'shared_runtimes': self._get_shared_runtimes(builders,
+                    '/usr/lib'),
+                'merge_python_virtualenvs':
+                    self.target.merge_python_virtualenvs,
                 }
 
         for dep_id in self.target.dep_ids:
+            if dep_id == self.target.python_runtime_id:
+                continue
             builder = builders[dep_id]
             if isinstance(builder, BinaryLauncherBuilder):
                 builder.do_pre_build_package_binary_install(builders, self,
                         **package_data)
 
+    def _get_shared_runtimes(self, builders, lib_path):
+        """Get the shared runtimes the binaries of this package can use.
+
+        The runtimes are the ones in the Debian package named by the
+        python_runtime of this package's target. This package depends on
+        exactly the version of that package being built.
+        """
+        runtime_id = self.target.python_runtime_id
+        if runtime_id is None:
+            return []
+
+        runtime_package_builder = builders[runtime_id]
+        if not isinstance(runtime_package_builder, DebianPackageBuilder):
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Python runtime (%s) of %s is not a Debian package.' %
+                    (runtime_id, self.target.target_id))
+
+        runtime_package_target = runtime_package_builder.target
+        install_path = os.path.join(lib_path,
+                runtime_package_target.target_id.name)
+        shared_runtimes = []
+        for dep_id in runtime_package_target.dep_ids:
+            builder = builders[dep_id]
+            if isinstance(builder, SharedRuntimeBuilder):
+                shared_runtimes.append(SharedRuntime(builder, install_path))
+        if not shared_runtimes:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Python runtime package (%s) of %s has no runtimes.' %
+                    (runtime_id, self.target.target_id))
+
+        self.dpkg_deps.add('%s (= %s)' % (runtime_package_target.target_id.name,
+                runtime_package_target.version))
+        return shared_runtimes
+
     def do_build_package_work(self):
         self._create_debian_control_file()
         self._create_debian_binary_package()
@@ -54,29 +145,19 @@ class DebianPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
     def _create_debian_control_file(self):
         logging.info('Creating Debian control file for %s', self.target.target_id)
         logging.info('Getting Debian architecture')
-        deb_arch_proc = subprocess.Popen(
-                ['dpkg-architecture', '-qDEB_BUILD_ARCH'],
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = deb_arch_proc.communicate()
-        retcode = deb_arch_proc.returncode
-        if retcode != 0:
-            logging.info(
-                    'Finding Debian architecture failed with exit code = %s.',
-                    retcode)
-            logging.info('Finding Debian architecture stdout:\n%s',
-                    stdoutdata)
-            logging.info('Finding Debian architecture stderr:\n%s',
-                    stderrdata)
-            raise digg.dev.hackbuilder.errors.Error(
-                    'dpkg-architecture call failed with exitcode %s', retcode)
-        deb_arch = stdoutdata.strip()
+        # dpkg-architecture lets the environment override what it detects.
+        deb_arch = digg.dev.hackbuilder.toolchain.get_toolchain_probes(
+                self.target.cache_root).probe('dpkg-architecture',
+                    ['-qDEB_BUILD_ARCH'],
+                    env_var_names=('DEB_BUILD_ARCH', 'DEB_BUILD_GNU_TYPE',
+                        'DEB_HOST_ARCH')).strip()
         logging.info('Debian architecture: %s', deb_arch)
 
         control_file_text = (
                 'Package: %s\n'
                 'Version: %s\n'
                 'Architecture: %s\n'
+                'Installed-Size: %d\n'
                 'Maintainer: Digg Ops <ops@digg.com>\n'
                 'Depends: %s\n'
                 'Description: %s\n'
@@ -84,56 +165,75 @@ class DebianPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
                 (self.target.target_id.name,
                  self.target.version,
                  deb_arch,
-                 ', '.join(self.target.dpkg_deps),
+                 digg.dev.hackbuilder.archive.get_installed_size(
+                     self.data_manifest),
+                 ', '.join(sorted(self.dpkg_deps)),
                  'stuff',
                  ' More stuff.'
                  ))
         logging.debug('Debian control file text:\n%s', control_file_text)
 
-        logging.info('Writing Debian control file for %s',
+        self.control_manifest.add_directory('/')
+        self.control_manifest.add_data('control', control_file_text)
+        self.control_manifest.add_data('md5sums', self._get_md5sums_text())
+        for script_name, fragments in (
+                self.maintainer_script_fragments.iteritems()):
+            script_text = '#!/bin/sh\nset -e\n\n' + '\n'.join(fragments)
+            logging.debug('Debian %s script text:\n%s', script_name,
+                    script_text)
+            self.control_manifest.add_data(script_name, script_text, 0755)
+        self.deb_arch = deb_arch
+
+    def _get_md5sums_text(self):
+        logging.info('Getting MD5 digests of the files of %s',
                 self.target.target_id)
-        full_dir = os.path.join(self.full_package_hierarchy_dir, 'DEBIAN')
-        full_path = os.path.join(full_dir, 'control')
-        logging.debug('Debian control file absolute path: %s', full_path)
-        os.makedirs(full_dir)
-        with open(full_path, 'w') as deb_control_file:
-            deb_control_file.write(control_file_text)
+        md5sums = digg.dev.hackbuilder.archive.get_md5sums(
+                self.data_manifest,
+                digg.dev.hackbuilder.digest.get_digest_cache(
+                    self.target.cache_root),
+                self.source_date_epoch)
+        return ''.join('%s  %s\n' % (digest, path)
+                       for path, digest in md5sums)
 
     def _create_debian_binary_package(self):
         logging.info('Creating Debian binary package for %s', self.target.target_id)
-        dpkg_deb_proc = subprocess.Popen(
-                    ('dpkg-deb', '-b', self.full_package_hierarchy_dir,
-                     self.target.package_root,
-                     ),
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = dpkg_deb_proc.communicate()
-        retcode = dpkg_deb_proc.returncode
-        if retcode != 0:
-            logging.info('Debian binary package creation failed.')
-            logging.info(
-                    'Debian binary package creation failed with exit code = '
-                    '%s', retcode)
-            logging.info('Debian binary package creation stdout:\n%s',
-                    stdoutdata)
-            logging.info('Debian binary package creation stderr:\n%s',
-                    stderrdata)
-            raise digg.dev.hackbuilder.errors.Error(
-                    'dpkg-deb call failed with exitcode %s', retcode)
-
-        package_file_path = stdoutdata.split()[5][1:-2]
+        package_file_path = os.path.join(self.target.package_root,
+                '%s_%s_%s.deb' % (self.target.target_id.name,
+                                  self.target.version, self.deb_arch))
+        digg.dev.hackbuilder.archive.write_deb(package_file_path,
+                self.control_manifest, self.data_manifest,
+                compression=ARGS.deb_compression,
+                compression_level=ARGS.deb_compression_level,
+                compression_threads=ARGS.deb_compression_threads,
+                source_date_epoch=self.source_date_epoch)
         logging.info('Package build at: %s', package_file_path)
 
+        (digest, changed) = digg.dev.hackbuilder.util.write_checksum_file(
+                package_file_path,
+                digg.dev.hackbuilder.digest.get_digest_cache(
+                    self.target.cache_root))
+        logging.info('Package SHA-256 (%s): %s',
+                'changed' if changed else 'unchanged', digest)
+
 
 class DebianPackageBuildTarget(
         digg.dev.hackbuilder.target.PackageBuildTarget):
     builder_class = DebianPackageBuilder
 
     def __init__(self, normalizer, target_id, dep_ids=None, version=None,
-            extra_dpkg_deps=None):
+            extra_dpkg_deps=None, python_runtime_id=None,
+            merge_python_virtualenvs=False):
         digg.dev.hackbuilder.target.PackageBuildTarget.__init__(self,
                 normalizer, target_id, dep_ids=dep_ids, version=version)
 
+        self.merge_python_virtualenvs = merge_python_virtualenvs
+
+        # The runtime package is built along with this package.
+        self.python_runtime_id = python_runtime_id
+        if python_runtime_id is not None:
+            self.dep_ids = set(self.dep_ids or ())
+            self.dep_ids.add(python_runtime_id)
+
         self.dpkg_deps = set([
                 'libc6 (>= 2.7-1)',
                 'python'
@@ -143,14 +243,21 @@ class DebianPackageBuildTarget(
 
 
 def build_file_debian_pkg(repo_path, normalizer):
-    def debian_pkg(name, deps=(), version=None, extra_dpkg_deps=None):
+    def debian_pkg(name, deps=(), version=None, extra_dpkg_deps=None,
+            python_runtime=None, merge_python_virtualenvs=False):
         logging.debug('Build file target, Debian package: %s', name)
         target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
         dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
                 normalizer, deps)
+        python_runtime_id = None
+        if python_runtime is not None:
+            (python_runtime_id,) = normal_dep_targets_from_dep_strings(
+                    repo_path, normalizer, [python_runtime])
         debian_pkg_target = DebianPackageBuildTarget(normalizer, target_id,
                 dep_ids=dep_target_ids, version=version,
-                extra_dpkg_deps=extra_dpkg_deps)
+                extra_dpkg_deps=extra_dpkg_deps,
+                python_runtime_id=python_runtime_id,
+                merge_python_virtualenvs=merge_python_virtualenvs)
         build_file_targets.put(debian_pkg_target)
 
     return debian_pkg
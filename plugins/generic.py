@@ -15,6 +15,7 @@
 import logging
 import os.path
 import pipes
+import re
 
 import digg.dev.hackbuilder.target
 import digg.dev.hackbuilder.plugin_utils
@@ -24,6 +25,73 @@ from digg.dev.hackbuilder.plugin_utils \
 from digg.dev.hackbuilder.plugin_utils import StartScriptBuilder
 from digg.dev.hackbuilder.errors import Error
 
+# The instances value that runs one instance per CPU of the host.
+INSTANCES_PER_CPU = 'cpus'
+
+# Placeholders in service args that differ between instances.
+ARG_PLACEHOLDER_RE = re.compile(r'\{(instance|port)\}')
+
+# Characters that systemd command lines don't need quoted.
+SYSTEMD_SAFE_WORD_RE = re.compile(r'^[\w@+=:,./-]+$')
+
+
+def get_shell_command(binary_full_path, args, placeholder_values):
+    """Get a shell command line that runs a binary with some args.
+
+    Args:
+        binary_full_path: The absolute path of the binary
+        args: The args of the binary, with {instance} and {port}
+            placeholders
+        placeholder_values: dict of shell words to put in place of the
+            placeholders, keyed by placeholder name, or None to pass the args
+            as they are
+    """
+    words = [pipes.quote(binary_full_path)]
+    for arg in args:
+        if placeholder_values is None:
+            words.append(pipes.quote(arg))
+            continue
+        pieces = []
+        for index, part in enumerate(ARG_PLACEHOLDER_RE.split(arg)):
+            if index % 2:
+                pieces.append(placeholder_values[part])
+            elif part:
+                #TODO(wt) pipe.quote->shlex.quote when transitioning to
+                # python 3.3+
+                pieces.append(pipes.quote(part))
+        words.append(''.join(pieces) or "''")
+    return ' '.join(words)
+
+
+def get_instance_script_lines(target, binary_full_path):
+    """Get the shell script that runs one instance of a service.
+
+    The script expects the number of the instance in $INSTANCE and sets
+    $PORT to the port of the instance when the args use it.
+
+    Returns: A list of lines.
+    """
+    lines = []
+    if target.uses_port:
+        lines.append('PORT=$((%d + INSTANCE))' % (target.base_port,))
+    lines.append('exec ' + get_shell_command(binary_full_path, target.args,
+            {'instance': '"$INSTANCE"', 'port': '"$PORT"'}))
+    return lines
+
+
+def get_instances_shell_expression(target):
+    if target.instances == INSTANCES_PER_CPU:
+        return '$(nproc)'
+    return str(target.instances)
+
+
+def systemd_quote(word):
+    """Quote a word of a systemd command line."""
+    if SYSTEMD_SAFE_WORD_RE.match(word):
+        return word
+    return '"%s"' % (word.replace('\\', '\\\\').replace('"', '\\"')
+            .replace('%', '%%').replace('$', '$$'),)
+
 
 class UpstartScriptBuilder(
         digg.dev.hackbuilder.plugin_utils.StartScriptBuilder):
@@ -40,84 +108,355 @@ class UpstartScriptBuilder(
         binary_full_path = os.path.join(bin_path,
                 self.target.binary_target_id.name)
 
-        #TODO(wt) pipe.quote->shlex.quote when transitioning to python 3.3+
-        escaped_args = [pipes.quote(arg) for arg in self.target.args]
-        args_str = "'%s'" % "'".join(escaped_args)
-
-        script_dir = os.path.abspath(
-                os.path.sep.join((package_builder.full_package_hierarchy_dir,
-                                  self.target.upstart_script_dir)))
-
-        logging.info('Creating dir: %s', script_dir)
-        os.makedirs(script_dir)
-
-        upstart_script_text = (
-                'description "{description}"\n'
-                '\n'
-                'start on filesystem\n'
-                'stop on runlevel [!2345]\n'
-                '\n'
-                'umask 022\n'
-                '\n'
-                'exec {binary_full_path} {args_str}').format(
-                        description=self.target.service_name,
-                        binary_full_path=binary_full_path,
-                        args_str=args_str)
+        if self.target.instances is None:
+            self._install_job(package_builder, self.target.service_name,
+                    ['start on filesystem',
+                     'stop on runlevel [!2345]'],
+                    ['exec ' + get_shell_command(binary_full_path,
+                        self.target.args, self.target.single_instance_args)],
+                    respawn=self.target.respawn)
+            return
+
+        # A job without a process of its own starts the instances when it
+        # starts, and they stop when it stops.
+        instance_job_name = self.target.service_name + '-instance'
+        self._install_job(package_builder, self.target.service_name,
+                ['start on filesystem',
+                 'stop on runlevel [!2345]'],
+                ['pre-start script',
+                 '    INSTANCES=%s' %
+                    (get_instances_shell_expression(self.target),),
+                 '    i=0',
+                 '    while [ $i -lt $INSTANCES ]; do',
+                 '        start %s INSTANCE=$i || true' %
+                    (instance_job_name,),
+                 '        i=$((i + 1))',
+                 '    done',
+                 'end script'])
+        self._install_job(package_builder, instance_job_name,
+                ['stop on stopping %s' % (self.target.service_name,),
+                 'instance $INSTANCE'],
+                ['script'] +
+                ['    ' + line for line in get_instance_script_lines(
+                    self.target, binary_full_path)] +
+                ['end script'],
+                respawn=self.target.respawn)
+
+    def _install_job(self, package_builder, job_name, event_lines,
+            process_lines, respawn=False):
+        stanzas = [
+                ['description "%s"' % (job_name,)],
+                event_lines,
+                ]
+        # Only a job with a main process can respawn it.
+        if respawn:
+            respawn_lines = ['respawn']
+            if self.target.respawn_limit is not None:
+                respawn_lines.append('respawn limit %d %d' %
+                        tuple(self.target.respawn_limit))
+            stanzas.append(respawn_lines)
+        stanzas.append(['umask 022'])
+        stanzas.append(process_lines)
+        upstart_script_text = '\n\n'.join('\n'.join(lines)
+                for lines in stanzas) + '\n'
         logging.debug('Upstart script script text:\n%s', upstart_script_text)
 
-        full_path = os.path.join(script_dir,
-                '{0}.conf'.format(self.target.service_name))
-        logging.debug('Upstart script file absolute path: %s', full_path)
-        with open(full_path, 'w') as upstart_script_file:
-            upstart_script_file.write(upstart_script_text)
+        script_path = os.path.join(self.target.upstart_script_dir,
+                '{0}.conf'.format(job_name))
+        logging.debug('Upstart script package path: %s', script_path)
+        package_builder.install_file_contents(script_path,
+                upstart_script_text)
 
 
-class UpstartScriptBuildTarget(
-        digg.dev.hackbuilder.target.StartScriptBuildTarget):
-    builder_class = UpstartScriptBuilder
+class SystemdServiceBuilder(
+        digg.dev.hackbuilder.plugin_utils.StartScriptBuilder):
+    """A builder of systemd units that run a binary as a service.
 
-    upstart_script_dir = '/etc/init'
+    With instances, the service is a template unit with an instance per
+    number. The package's maintainer scripts enable the instances when the
+    package is installed, since how many there are can depend on the host.
+    """
+    def __init__(self, target):
+        digg.dev.hackbuilder.plugin_utils.StartScriptBuilder.__init__(self,
+                target)
+
+    def do_pre_build_package_binary_install(self, builders, package_builder,
+            bin_path, **kwargs):
+        logging.info('Adding systemd units for %s to package %s',
+                self.target.target_id, package_builder.target.target_id)
+
+        binary_full_path = os.path.join(bin_path,
+                self.target.binary_target_id.name)
+        service_name = self.target.service_name
+        socket_unit = '%s.socket' % (service_name,)
+
+        if self.target.instances is None:
+            unit_name = '%s.service' % (service_name,)
+            description = service_name
+            environment_lines = []
+            args = self.target.args
+            if self.target.single_instance_args is not None:
+                args = [ARG_PLACEHOLDER_RE.sub(
+                            lambda match: self.target.single_instance_args[
+                                match.group(1)], arg)
+                        for arg in args]
+            exec_start = ' '.join(systemd_quote(word) for word in
+                    [binary_full_path] + args)
+            instance_units = [unit_name]
+        else:
+            unit_name = '%s@.service' % (service_name,)
+            description = '%s instance %%i' % (service_name,)
+            environment_lines = ['Environment=INSTANCE=%i']
+            exec_start = '/bin/sh -c ' + systemd_quote('; '.join(
+                    get_instance_script_lines(self.target, binary_full_path)))
+            instance_units = None
+
+        unit_lines = ['Description=%s' % (description,)]
+        service_lines = list(environment_lines)
+        if self.target.socket is not None:
+            unit_lines.extend(['Requires=%s' % (socket_unit,),
+                               'After=%s' % (socket_unit,)])
+            service_lines.append('Sockets=%s' % (socket_unit,))
+        if self.target.respawn_limit is not None:
+            (burst, interval) = self.target.respawn_limit
+            unit_lines.extend(['StartLimitIntervalSec=%d' % (interval,),
+                               'StartLimitBurst=%d' % (burst,)])
+        service_lines.append('ExecStart=%s' % (exec_start,))
+        if self.target.respawn:
+            service_lines.append('Restart=always')
+        service_lines.append('UMask=0022')
+        self._install_unit(package_builder, unit_name, [
+                ('Unit', unit_lines),
+                ('Service', service_lines),
+                ('Install', ['WantedBy=multi-user.target']),
+                ])
 
+        if self.target.socket is not None:
+            socket_lines = ['ListenStream=%s' % (self.target.socket,)]
+            if self.target.instances is not None:
+                # Connections before the instances are up start the first.
+                socket_lines.append('Service=%s@0.service' % (service_name,))
+            self._install_unit(package_builder, socket_unit, [
+                    ('Unit', ['Description=%s socket' % (service_name,)]),
+                    ('Socket', socket_lines),
+                    ('Install', ['WantedBy=sockets.target']),
+                    ])
+
+        self._add_maintainer_script_fragments(package_builder,
+                instance_units)
+
+    def _install_unit(self, package_builder, unit_name, sections):
+        unit_text = '\n'.join('[%s]\n%s\n' % (section, '\n'.join(lines))
+                for section, lines in sections)
+        logging.debug('Systemd unit %s text:\n%s', unit_name, unit_text)
+        package_builder.install_file_contents(
+                os.path.join(self.target.systemd_unit_dir, unit_name),
+                unit_text)
+
+    def _add_maintainer_script_fragments(self, package_builder,
+            instance_units):
+        """Enable and start the service on install and stop it on removal.
+
+        Args:
+            instance_units: The names of the units to enable, or None to
+                enable an instance of the template unit per instance
+        """
+        service_name = self.target.service_name
+        units = []
+        if self.target.socket is not None:
+            units.append('%s.socket' % (service_name,))
+
+        if instance_units is None:
+            def for_each_instance(command):
+                return [
+                        'INSTANCES=%s' %
+                            (get_instances_shell_expression(self.target),),
+                        'i=0',
+                        'while [ $i -lt $INSTANCES ]; do',
+                        '    %s %s@$i.service' % (command, service_name),
+                        '    i=$((i + 1))',
+                        'done',
+                        ]
+            stop_units = ["'%s@*.service'" % (service_name,)] + units
+            enabled_units_glob = '%s@*.service' % (service_name,)
+        else:
+            def for_each_instance(command):
+                return ['%s %s' % (command, unit) for unit in instance_units]
+            stop_units = instance_units + units
+            enabled_units_glob = ' '.join(instance_units)
+
+        postinst_lines = ['if [ "$1" = configure ]; then']
+        postinst_lines.extend('    systemctl enable %s' % (unit,)
+                for unit in units)
+        postinst_lines.extend('    ' + line for line in
+                for_each_instance('systemctl enable'))
+        postinst_lines.extend([
+                '    if [ -d /run/systemd/system ]; then',
+                '        systemctl daemon-reload',
+                ])
+        postinst_lines.extend('        systemctl restart %s' % (unit,)
+                for unit in units)
+        postinst_lines.extend('        ' + line for line in
+                for_each_instance('systemctl restart'))
+        postinst_lines.extend(['    fi', 'fi'])
+        package_builder.add_maintainer_script_fragment('postinst',
+                '\n'.join(postinst_lines) + '\n')
+
+        prerm_lines = [
+                'if [ -d /run/systemd/system ]; then',
+                '    systemctl stop %s || true' % (' '.join(stop_units),),
+                'fi',
+                'if [ "$1" = remove ]; then',
+                '    for unit in /etc/systemd/system/multi-user.target.wants/'
+                    '%s; do' % (enabled_units_glob,),
+                '        if [ -L "$unit" ]; then',
+                '            systemctl disable "${unit##*/}" || true',
+                '        fi',
+                '    done',
+                ]
+        prerm_lines.extend('    systemctl disable %s || true' % (unit,)
+                for unit in units)
+        prerm_lines.append('fi')
+        package_builder.add_maintainer_script_fragment('prerm',
+                '\n'.join(prerm_lines) + '\n')
+
+
+class ServiceBuildTarget(digg.dev.hackbuilder.target.StartScriptBuildTarget):
+    """A target of a binary run as a service by an init system.
+
+    Attributes:
+        instances: None to run a single process, or how many instances of
+            the service to run: a number, or INSTANCES_PER_CPU for one per
+            CPU of the host.
+        base_port: The port of the first instance. Instance n gets the
+            port base_port + n, passed to it through {port} in its args.
+            Args only have {instance} and {port} placeholders when
+            instances or base_port is given, and are passed as they are
+            otherwise.
+        respawn: Whether to restart the service when it exits
+        respawn_limit: None, or a (count, interval) pair. The service isn't
+            respawned any more once it has been respawned count times
+            within interval seconds.
+        single_instance_args: The values of the arg placeholders of a
+            service without instances, or None when its args have none
+    """
     def __init__(self, normalizer, target_id, dep_ids=None, service_name=None,
-            binary_target_id=None, args=None):
+            binary_target_id=None, args=None, instances=None, base_port=None,
+            respawn=False, respawn_limit=None):
         digg.dev.hackbuilder.target.StartScriptBuildTarget.__init__(self,
                 normalizer, target_id, dep_ids)
 
         if service_name is None:
-            raise Error('No service name specified for upstart target (%s)',
-                    self.target_id)
+            raise Error('No service name specified for service target (%s)' %
+                    (self.target_id,))
         self.service_name = service_name
 
         if binary_target_id is None:
-            raise Error('No binary name specified for upstart target (%s)',
-                    self.binary_target_id)
+            raise Error('No binary name specified for service target (%s)' %
+                    (self.target_id,))
         self.binary_target_id = binary_target_id
 
         if args is None:
             args = []
         self.args = args
 
+        if instances is not None and instances != INSTANCES_PER_CPU and (
+                not isinstance(instances, int) or
+                isinstance(instances, bool) or instances < 1):
+            raise Error('Instances of service target (%s) must be a '
+                    'positive number or %r.' %
+                    (self.target_id, INSTANCES_PER_CPU))
+        self.instances = instances
+
+        has_placeholders = instances is not None or base_port is not None
+        self.uses_port = has_placeholders and any('{port}' in arg
+                for arg in args)
+        if self.uses_port and base_port is None:
+            raise Error('Args of service target (%s) use {port} without a '
+                    'base_port.' % (self.target_id,))
+        self.base_port = base_port
+        if instances is None and has_placeholders:
+            self.single_instance_args = {'instance': '0',
+                                         'port': str(base_port)}
+        else:
+            self.single_instance_args = None
+
+        if respawn_limit is not None:
+            if not respawn:
+                raise Error('Service target (%s) has a respawn_limit but '
+                        'does not respawn.' % (self.target_id,))
+            if len(respawn_limit) != 2:
+                raise Error('Respawn_limit of service target (%s) must be '
+                        'a (count, interval) pair.' % (self.target_id,))
+        self.respawn = respawn
+        self.respawn_limit = respawn_limit
+
+
+class UpstartScriptBuildTarget(ServiceBuildTarget):
+    builder_class = UpstartScriptBuilder
+
+    upstart_script_dir = '/etc/init'
+
+
+class SystemdServiceBuildTarget(ServiceBuildTarget):
+    builder_class = SystemdServiceBuilder
+
+    systemd_unit_dir = '/lib/systemd/system'
+
+    def __init__(self, normalizer, target_id, socket=None, **kwargs):
+        ServiceBuildTarget.__init__(self, normalizer, target_id, **kwargs)
+
+        # Every instance gets the listening socket, so they share the
+        # connections to it.
+        self.socket = socket
+
+
+def _get_binary_target_id(normalizer, binary):
+    binary_target_id = digg.dev.hackbuilder.target.TargetID.from_string(
+            binary)
+    return normalizer.normalize_target_id(binary_target_id)
+
 
 def build_file_upstart_script(repo_path, normalizer):
     def upstart_script(name, deps=(), service_name=None, binary=None,
-            args=None):
+            args=None, instances=None, base_port=None, respawn=False,
+            respawn_limit=None):
         logging.debug('Build file target, Upstart script: %s', name)
         target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
         dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
                 normalizer, deps)
-        binary_target_id = digg.dev.hackbuilder.target.TargetID.from_string(
-                binary)
-        normal_binary_target_id = normalizer.normalize_target_id(binary_target_id)
         upstart_script_target = UpstartScriptBuildTarget(normalizer, target_id,
                 dep_ids=dep_target_ids, service_name=service_name,
-                binary_target_id=normal_binary_target_id, args=args)
+                binary_target_id=_get_binary_target_id(normalizer, binary),
+                args=args, instances=instances, base_port=base_port,
+                respawn=respawn, respawn_limit=respawn_limit)
         build_file_targets.put(upstart_script_target)
 
     return upstart_script
 
 
+def build_file_systemd_service(repo_path, normalizer):
+    def systemd_service(name, deps=(), service_name=None, binary=None,
+            args=None, instances=None, base_port=None, respawn=False,
+            respawn_limit=None, socket=None):
+        logging.debug('Build file target, systemd service: %s', name)
+        target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
+        dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
+                normalizer, deps)
+        systemd_service_target = SystemdServiceBuildTarget(normalizer,
+                target_id, dep_ids=dep_target_ids, service_name=service_name,
+                binary_target_id=_get_binary_target_id(normalizer, binary),
+                args=args, instances=instances, base_port=base_port,
+                respawn=respawn, respawn_limit=respawn_limit, socket=socket)
+        build_file_targets.put(systemd_service_target)
+
+    return systemd_service
+
+
 def build_file_rules_generator(repo_path, normalizer):
     build_file_rules = {
+            'systemd_service': build_file_systemd_service(repo_path,
+                normalizer),
             'upstart_script': build_file_upstart_script(repo_path, normalizer),
             }
     return build_file_rules
@@ -17,8 +17,10 @@ import logging
 import os.path
 import subprocess
 
+import digg.dev.hackbuilder.digest
 import digg.dev.hackbuilder.target
 import digg.dev.hackbuilder.plugin_utils
+import digg.dev.hackbuilder.util
 from digg.dev.hackbuilder.plugins import build_file_targets
 from digg.dev.hackbuilder.plugin_utils \
         import normal_dep_targets_from_dep_strings
@@ -31,6 +33,7 @@ class MacPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
 
         self.full_package_hierarchy_dir = os.path.join(
                 self.target.target_build_dir, 'macosx_hierarchy')
+        self.source_date_epoch = ARGS.source_date_epoch
 
     def do_pre_build_package_binary_install(self, builders):
         logging.info('Copying built binaries to package hierarchy for %s',
@@ -40,6 +43,8 @@ class MacPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
                 'bin_path': '/bin',
                 'sbin_path': '/sbin',
                 'lib_path': '/Library',
+                'merge_python_virtualenvs':
+                    self.target.merge_python_virtualenvs,
                 }
 
         for dep_id in self.target.dep_ids:
@@ -81,16 +86,25 @@ class MacPackageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
 
         logging.info('Package build at: %s', package_file_path)
 
+        (digest, changed) = digg.dev.hackbuilder.util.write_checksum_file(
+                package_file_path,
+                digg.dev.hackbuilder.digest.get_digest_cache(
+                    self.target.cache_root))
+        logging.info('Package SHA-256 (%s): %s',
+                'changed' if changed else 'unchanged', digest)
+
 
 class MacPackageBuildTarget(
         digg.dev.hackbuilder.target.PackageBuildTarget):
     builder_class = MacPackageBuilder
 
     def __init__(self, normalizer, target_id, pkg_filebase, dep_ids=None,
-            version=None):
+            version=None, merge_python_virtualenvs=False):
         digg.dev.hackbuilder.target.PackageBuildTarget.__init__(self,
                 normalizer, target_id, dep_ids=dep_ids, version=version)
 
+        self.merge_python_virtualenvs = merge_python_virtualenvs
+
         if os.path.basename(pkg_filebase) != pkg_filebase:
             raise digg.dev.hackbuilder.errors.Error(
                     'Pkg_filebase in target (%s) cannot contain a path '
@@ -101,7 +115,8 @@ class MacPackageBuildTarget(
 
 
 def build_file_mac_pkg(repo_path, normalizer):
-    def mac_pkg(name, deps=(), version=None, pkg_filebase=None):
+    def mac_pkg(name, deps=(), version=None, pkg_filebase=None,
+            merge_python_virtualenvs=False):
         logging.debug('Build file target, Mac package: %s', name)
         target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
         dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
@@ -114,7 +129,8 @@ def build_file_mac_pkg(repo_path, normalizer):
 
         mac_pkg_target = MacPackageBuildTarget(normalizer, target_id,
                 dep_ids=dep_target_ids, version=version,
-                pkg_filebase=pkg_filebase)
+                pkg_filebase=pkg_filebase,
+                merge_python_virtualenvs=merge_python_virtualenvs)
         build_file_targets.put(mac_pkg_target)
 
     return mac_pkg
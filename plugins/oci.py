@@ -0,0 +1,478 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import platform
+
+import digg.dev.hackbuilder.archive
+import digg.dev.hackbuilder.common
+import digg.dev.hackbuilder.digest
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.target
+import digg.dev.hackbuilder.plugin_utils
+import digg.dev.hackbuilder.util
+from digg.dev.hackbuilder.plugins import build_file_targets
+from digg.dev.hackbuilder.plugin_utils \
+        import normal_dep_targets_from_dep_strings
+from digg.dev.hackbuilder.plugin_utils import BinaryLauncherBuilder
+
+OCI_LAYOUT_VERSION = '1.0.0'
+MANIFEST_MEDIA_TYPE = 'application/vnd.oci.image.manifest.v1+json'
+CONFIG_MEDIA_TYPE = 'application/vnd.oci.image.config.v1+json'
+LAYER_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+REF_NAME_ANNOTATION = 'org.opencontainers.image.ref.name'
+
+# Layers from the least to the most often changed. Third party libraries
+# change less often than first party code, which changes less often than
+# the launchers and configuration that name its version.
+LAYER_NAMES = ('third_party', 'first_party', 'launchers')
+
+# Bump this when a change to how layers are written changes their bytes.
+LAYER_FORMAT_VERSION = 1
+LAYER_CACHE_VERSION = 1
+
+DEFAULT_PATH = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin'
+
+# OCI architecture names of machine types that differ from them.
+OCI_ARCHITECTURES = {
+        'x86_64': 'amd64',
+        'aarch64': 'arm64',
+        'armv7l': 'arm',
+        'i386': '386',
+        'i686': '386',
+        }
+
+
+def add_argparser_arguments(parser):
+    parser.add_argument('--oci_compression_level', default=9, type=int,
+            choices=range(1, 10),
+            help='Compression level for the layers of OCI images. '
+                 '(Default: 9)')
+    parser.add_argument('--oci_compression_threads', default=None, type=int,
+            help='Number of threads to compress OCI image layers with. '
+                 '(Default: number of CPUs)')
+
+
+class OciImageBuilder(digg.dev.hackbuilder.plugin_utils.PackageBuilder):
+    """A builder of OCI container images.
+
+    The image is written as an OCI image layout directory, which container
+    tools such as skopeo can copy to a registry or daemon, so no container
+    daemon is needed to build it. The files of the image are split into
+    layers by how often they change.
+
+    Layers are always written reproducibly, and each one is keyed by a
+    fingerprint of its contents. A layer whose fingerprint is unchanged
+    since the last build is reused as it is, rather than being compressed
+    again, so it keeps the digest that registries and hosts already have.
+    """
+    def __init__(self, target):
+        digg.dev.hackbuilder.plugin_utils.PackageBuilder.__init__(self, target)
+
+        self.layer_manifests = dict(
+                (layer_name, digg.dev.hackbuilder.archive.PackageManifest())
+                for layer_name in LAYER_NAMES)
+        # A layer can only be reused if it comes out the same every time.
+        self.source_date_epoch = (
+                digg.dev.hackbuilder.common.get_source_date_epoch(
+                    ARGS.source_date_epoch))
+
+    def install_tree(self, src_root, dest_path, exclude=(),
+            third_party_paths=()):
+        third_party_paths = frozenset(third_party_paths)
+        third_party_dirs = set()
+        for rel_path in third_party_paths:
+            rel_dir = os.path.dirname(rel_path)
+            while rel_dir and rel_dir not in third_party_dirs:
+                third_party_dirs.add(rel_dir)
+                rel_dir = os.path.dirname(rel_dir)
+
+        tree_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        tree_manifest.add_tree(src_root, dest_path, exclude)
+        dest_prefix = os.path.normpath(dest_path).strip('/') + '/'
+        for path, entry in tree_manifest.entries.iteritems():
+            rel_path = path[len(dest_prefix):]
+            if not path.startswith(dest_prefix):
+                layer_name = 'first_party'
+            elif rel_path in third_party_paths or (entry.kind == 'd' and
+                    rel_path in third_party_dirs):
+                layer_name = 'third_party'
+            else:
+                layer_name = 'first_party'
+            self.layer_manifests[layer_name].add_entry(path, entry)
+
+    def install_file_contents(self, dest_path, contents, mode=0644):
+        self.layer_manifests['launchers'].add_data(dest_path, contents, mode)
+
+    def install_symlink(self, dest_path, link_target):
+        self.layer_manifests['launchers'].add_symlink(dest_path, link_target)
+
+    def do_pre_build_package_binary_install(self, builders):
+        logging.info('Adding built binaries to image for %s',
+                self.target.target_id)
+
+        package_data = {
+                'bin_path': '/usr/bin',
+                'sbin_path': '/usr/sbin',
+                'lib_path': '/usr/lib',
+                'merge_python_virtualenvs':
+                    self.target.merge_python_virtualenvs,
+                }
+
+        for dep_id in self.target.dep_ids:
+            builder = builders[dep_id]
+            if isinstance(builder, BinaryLauncherBuilder):
+                builder.do_pre_build_package_binary_install(builders, self,
+                        **package_data)
+
+    def do_build_package_work(self):
+        logging.info('Creating OCI image for %s', self.target.target_id)
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(self.blobs_dir)
+
+        (layers, base_config) = self._import_base_image()
+        config = {
+                'architecture': self.target.architecture,
+                'os': 'linux',
+                'config': {'Env': ['PATH=' + DEFAULT_PATH]},
+                'rootfs': {'type': 'layers', 'diff_ids': []},
+                'history': [],
+                }
+        if base_config is not None:
+            config['architecture'] = base_config['architecture']
+            config['config'] = base_config.get('config') or {}
+            config['rootfs']['diff_ids'] = list(
+                    base_config['rootfs']['diff_ids'])
+            config['history'] = list(base_config.get('history', ()))
+            if self.target.architecture not in (None,
+                    config['architecture']):
+                raise digg.dev.hackbuilder.errors.Error(
+                        'Base image of %s is for %s, not %s.' %
+                        (self.target.target_id, config['architecture'],
+                         self.target.architecture))
+        elif self.target.architecture is None:
+            machine = platform.machine()
+            config['architecture'] = OCI_ARCHITECTURES.get(machine, machine)
+        if self.target.entrypoint is not None:
+            config['config']['Entrypoint'] = list(self.target.entrypoint)
+            config['config'].pop('Cmd', None)
+
+        old_layer_cache = self._load_layer_cache()
+        layer_cache = {}
+        for layer_name in LAYER_NAMES:
+            manifest = self.layer_manifests[layer_name]
+            if not any(manifest.entries):
+                continue
+            fingerprint = self._get_layer_fingerprint(manifest)
+            layer = old_layer_cache.get(fingerprint)
+            if layer is not None and self._has_blob(layer['digest'],
+                    layer['size']):
+                logging.info('Reusing unchanged %s layer of %s: %s',
+                        layer_name, self.target.target_id, layer['digest'])
+            else:
+                layer = self._write_layer(layer_name, manifest)
+            layer_cache[fingerprint] = layer
+            layers.append({
+                    'mediaType': LAYER_MEDIA_TYPE,
+                    'digest': layer['digest'],
+                    'size': layer['size'],
+                    })
+            config['rootfs']['diff_ids'].append(layer['diff_id'])
+            config['history'].append({
+                    'created_by': 'hack: %s layer of %s' %
+                        (layer_name, self.target.target_id),
+                    })
+        self._save_layer_cache(layer_cache)
+
+        config_descriptor = self._write_json_blob(config, CONFIG_MEDIA_TYPE)
+        image_manifest_descriptor = self._write_json_blob({
+                'schemaVersion': 2,
+                'mediaType': MANIFEST_MEDIA_TYPE,
+                'config': config_descriptor,
+                'layers': layers,
+                }, MANIFEST_MEDIA_TYPE)
+        image_manifest_descriptor['annotations'] = {
+                REF_NAME_ANNOTATION: self.target.version,
+                }
+
+        self._write_layout_file('oci-layout',
+                {'imageLayoutVersion': OCI_LAYOUT_VERSION})
+        self._write_layout_file('index.json', {
+                'schemaVersion': 2,
+                'manifests': [image_manifest_descriptor],
+                })
+        self._remove_unused_blobs([config_descriptor,
+                image_manifest_descriptor] + layers)
+        logging.info('Image built at: %s (%s)', self.target.oci_layout_dir,
+                image_manifest_descriptor['digest'])
+
+    @property
+    def blobs_dir(self):
+        return os.path.join(self.target.oci_layout_dir, 'blobs', 'sha256')
+
+    def _get_blob_path(self, digest):
+        (algorithm, hex_digest) = digest.split(':', 1)
+        if algorithm != 'sha256':
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Unsupported digest algorithm in OCI image: %s' %
+                    (digest,))
+        return os.path.join(self.blobs_dir, hex_digest)
+
+    def _has_blob(self, digest, size):
+        try:
+            return os.stat(self._get_blob_path(digest)).st_size == size
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    def _get_layer_fingerprint(self, manifest):
+        """Get a digest of everything that goes into the bytes of a layer.
+
+        File contents are taken from the digest cache, so an unchanged
+        layer costs a stat of each of its files rather than a read.
+        """
+        src_paths = sorted(set(entry.src_path
+                for entry in manifest.entries.itervalues()
+                if entry.src_path is not None))
+        digest_cache = digg.dev.hackbuilder.digest.get_digest_cache(
+                self.target.cache_root)
+        file_digests = dict(zip(src_paths,
+                digest_cache.get_digests(src_paths)))
+
+        fingerprint = hashlib.sha256()
+        fingerprint.update('%r\n' % ((LAYER_FORMAT_VERSION,
+                self.source_date_epoch, ARGS.oci_compression_level),))
+        for path in sorted(manifest.entries):
+            entry = manifest.entries[path]
+            contents = None
+            mtime = None
+            if entry.src_path is not None:
+                contents = file_digests[entry.src_path]
+                mtime = digg.dev.hackbuilder.archive.clamp_mtime(
+                        int(os.stat(entry.src_path).st_mtime),
+                        self.source_date_epoch)
+            elif entry.data is not None:
+                contents = hashlib.sha256(entry.data).hexdigest()
+            fingerprint.update('%r\n' % ((path, entry.kind,
+                    digg.dev.hackbuilder.archive.normalize_mode(entry.kind,
+                        entry.mode),
+                    entry.link_target, contents, mtime),))
+        return fingerprint.hexdigest()
+
+    def _write_layer(self, layer_name, manifest):
+        logging.info('Writing %s layer of %s', layer_name,
+                self.target.target_id)
+        temp_path = os.path.join(self.blobs_dir,
+                '.%s.%d.tmp' % (layer_name, os.getpid()))
+        try:
+            with open(temp_path, 'wb') as f:
+                blob_writer = _DigestWriter(f)
+                compressor = digg.dev.hackbuilder.archive.open_compressor(
+                        blob_writer, 'gzip', ARGS.oci_compression_level,
+                        ARGS.oci_compression_threads, self.source_date_epoch)
+                tar_writer = _DigestWriter(compressor)
+                digg.dev.hackbuilder.archive.write_tar(manifest, tar_writer,
+                        self.source_date_epoch)
+                compressor.close()
+            layer = {
+                    'digest': blob_writer.get_digest(),
+                    'size': blob_writer.size,
+                    'diff_id': tar_writer.get_digest(),
+                    }
+            os.rename(temp_path, self._get_blob_path(layer['digest']))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        logging.info('Wrote %s layer of %s: %s (%d bytes)', layer_name,
+                self.target.target_id, layer['digest'], layer['size'])
+        return layer
+
+    def _write_json_blob(self, data, media_type):
+        blob = json.dumps(data, sort_keys=True, separators=(',', ':'))
+        digest = 'sha256:' + hashlib.sha256(blob).hexdigest()
+        if not self._has_blob(digest, len(blob)):
+            self._write_file(self._get_blob_path(digest), blob)
+        return {'mediaType': media_type, 'digest': digest, 'size': len(blob)}
+
+    def _write_layout_file(self, filename, data):
+        self._write_file(os.path.join(self.target.oci_layout_dir, filename),
+                json.dumps(data, sort_keys=True, indent=4) + '\n')
+
+    def _write_file(self, path, contents):
+        temp_path = '%s.%d.tmp' % (path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            f.write(contents)
+        os.rename(temp_path, path)
+
+    def _import_base_image(self):
+        """Copy the blobs of the base image into the image layout.
+
+        Returns: A pair of the list of layer descriptors of the base image
+            and its config, or of an empty list and None without a base
+            image.
+        """
+        base_dir = self.target.base_image_path
+        if base_dir is None:
+            return ([], None)
+
+        logging.info('Using base image at %s for %s', base_dir,
+                self.target.target_id)
+        index = _load_json(os.path.join(base_dir, 'index.json'))
+        descriptors = index.get('manifests', [])
+        if self.target.base_image_ref is not None:
+            descriptors = [descriptor for descriptor in descriptors
+                    if descriptor.get('annotations', {}).get(
+                        REF_NAME_ANNOTATION) == self.target.base_image_ref]
+        if len(descriptors) != 1:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Base image layout (%s) of %s has %d images named %s, '
+                    'not 1.' % (base_dir, self.target.target_id,
+                        len(descriptors), self.target.base_image_ref))
+        if descriptors[0].get('mediaType') != MANIFEST_MEDIA_TYPE:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Base image of %s is not an OCI image manifest: %s' %
+                    (self.target.target_id, descriptors[0].get('mediaType')))
+
+        image_manifest = _load_json(_get_layout_blob_path(base_dir,
+                descriptors[0]['digest']))
+        config = _load_json(_get_layout_blob_path(base_dir,
+                image_manifest['config']['digest']))
+        for layer in image_manifest['layers']:
+            self._import_blob(base_dir, layer)
+        return (list(image_manifest['layers']), config)
+
+    def _import_blob(self, base_dir, descriptor):
+        if self._has_blob(descriptor['digest'], descriptor['size']):
+            return
+        src_path = _get_layout_blob_path(base_dir, descriptor['digest'])
+        dest_path = self._get_blob_path(descriptor['digest'])
+        temp_path = '%s.%d.tmp' % (dest_path, os.getpid())
+        # Blobs are never modified, so they can share storage.
+        digg.dev.hackbuilder.util.link_or_copy_file(src_path, temp_path)
+        os.rename(temp_path, dest_path)
+
+    def _remove_unused_blobs(self, descriptors):
+        used_blob_paths = set(self._get_blob_path(descriptor['digest'])
+                for descriptor in descriptors)
+        for filename in os.listdir(self.blobs_dir):
+            blob_path = os.path.join(self.blobs_dir, filename)
+            if blob_path not in used_blob_paths:
+                logging.debug('Removing unused blob: %s', blob_path)
+                os.remove(blob_path)
+
+    def _load_layer_cache(self):
+        try:
+            layer_cache = _load_json(self.target.layer_cache_path)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        except ValueError:
+            logging.warning('Ignoring corrupt layer cache: %s',
+                    self.target.layer_cache_path)
+            return {}
+        if (not isinstance(layer_cache, dict) or
+                layer_cache.get('version') != LAYER_CACHE_VERSION):
+            return {}
+        return layer_cache['layers']
+
+    def _save_layer_cache(self, layers):
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.target.layer_cache_path))
+        self._write_file(self.target.layer_cache_path,
+                json.dumps({'version': LAYER_CACHE_VERSION, 'layers': layers},
+                    sort_keys=True, indent=4))
+
+
+class _DigestWriter(object):
+    """A file object that hashes and counts what is written through it."""
+    def __init__(self, fileobj):
+        self._fileobj = fileobj
+        self._hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self._hash.update(data)
+        self.size += len(data)
+        self._fileobj.write(data)
+
+    def get_digest(self):
+        return 'sha256:' + self._hash.hexdigest()
+
+
+def _get_layout_blob_path(layout_dir, digest):
+    return os.path.join(layout_dir, 'blobs', *digest.split(':', 1))
+
+
+def _load_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+class OciImageBuildTarget(digg.dev.hackbuilder.target.PackageBuildTarget):
+    builder_class = OciImageBuilder
+
+    def __init__(self, normalizer, target_id, dep_ids=None, version=None,
+            base_image=None, base_image_ref=None, entrypoint=None,
+            architecture=None, merge_python_virtualenvs=False):
+        digg.dev.hackbuilder.target.PackageBuildTarget.__init__(self,
+                normalizer, target_id, dep_ids=dep_ids, version=version)
+
+        self.merge_python_virtualenvs = merge_python_virtualenvs
+        self.base_image_path = None
+        if base_image is not None:
+            self.base_image_path = os.path.join(self.target_working_copy_dir,
+                    base_image)
+        self.base_image_ref = base_image_ref
+        if isinstance(entrypoint, basestring):
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Entrypoint of OCI image (%s) must be a list.' %
+                    (target_id,))
+        self.entrypoint = entrypoint
+        self.architecture = architecture
+
+        self.oci_layout_dir = os.path.join(self.package_root,
+                '%s.oci' % (self.target_id.name,))
+        self.layer_cache_path = os.path.join(self.target_build_dir,
+                'oci_layers.json')
+
+
+def build_file_oci_image(repo_path, normalizer):
+    def oci_image(name, deps=(), version=None, base_image=None,
+            base_image_ref=None, entrypoint=None, architecture=None,
+            merge_python_virtualenvs=False):
+        logging.debug('Build file target, OCI image: %s', name)
+        target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
+        dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
+                normalizer, deps)
+        oci_image_target = OciImageBuildTarget(normalizer, target_id,
+                dep_ids=dep_target_ids, version=version,
+                base_image=base_image, base_image_ref=base_image_ref,
+                entrypoint=entrypoint, architecture=architecture,
+                merge_python_virtualenvs=merge_python_virtualenvs)
+        build_file_targets.put(oci_image_target)
+
+    return oci_image
+
+
+def build_file_rules_generator(repo_path, normalizer):
+    build_file_rules = {
+            'oci_image': build_file_oci_image(repo_path, normalizer),
+            }
+    return build_file_rules
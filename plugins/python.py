@@ -12,15 +12,28 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import collections
 import cStringIO as stringio
 import errno
+import glob
+import hashlib
+import json
 import logging
 import os.path
+import pipes
 import shutil
+import stat
 import subprocess
 
 import digg.dev.hackbuilder.target
+import digg.dev.hackbuilder.digest
 import digg.dev.hackbuilder.plugin_utils
+import digg.dev.hackbuilder.python_bytecode
+import digg.dev.hackbuilder.python_virtualenv
+import digg.dev.hackbuilder.python_wheel
+import digg.dev.hackbuilder.python_zipapp
+import digg.dev.hackbuilder.source_mirror
+import digg.dev.hackbuilder.toolchain
 import digg.dev.hackbuilder.util
 from digg.dev.hackbuilder.plugins import build_file_targets
 from digg.dev.hackbuilder.plugin_utils \
@@ -28,64 +41,255 @@ from digg.dev.hackbuilder.plugin_utils \
 
 DEFAULT_PYTHON = 'python'
 DEFAULT_VIRTUALENV_VERSION = '1.10'
+# Bump this when a change to how wheels are built makes cached wheels stale.
+WHEEL_CACHE_VERSION = 1
 VIRTUALENV_REPO_PATH = os.path.join(
         'third_party', 'py', 'virtualenv',
         'virtualenv-' + DEFAULT_VIRTUALENV_VERSION)
+VIRTUALENV_ARGS = ('--no-site-packages', '--never-download', '--distribute')
+# The ways to launch a packaged python binary. "bash" runs a wrapper script
+# that finds the binary's virtualenv relative to itself. "symlink" links to
+# the virtualenv's console script. "python" runs the console script straight
+# from the virtualenv's interpreter.
+PYTHON_LAUNCHERS = ('bash', 'python', 'symlink')
+# Linux kernels before 5.1 truncate #! lines after 127 characters.
+MAX_SHEBANG_LENGTH = 127
+# The ways to lay out first party packages for setuptools. "mirror" symlinks
+# the files of every python_lib into the source tree. "package_dir" points
+# setuptools straight at the working copy.
+PYTHON_SOURCE_STAGES = ('mirror', 'package_dir')
+
+# Setup script code that installs exactly the modules hack lists for each
+# package, wherever their files are.
+PACKAGE_DIR_SETUP_PY_TEXT = (
+        'import setuptools.command.build_py\n'
+        '\n'
+        'PACKAGE_MODULES = %s\n'
+        '\n'
+        '\n'
+        'class BuildPy(setuptools.command.build_py.build_py):\n'
+        '    def find_package_modules(self, package, package_dir):\n'
+        '        return [(package, module, path) for module, path in\n'
+        '                sorted(PACKAGE_MODULES.get(package, {}).items())]\n'
+        '\n'
+        '\n')
 
 
 def add_argparser_arguments(parser):
     parser.add_argument('--python_install_method', default='install',
-            choices=['install', 'develop'], nargs='?',
+            choices=['install', 'develop', 'link'], nargs='?',
             help='Choose method for python package installation. The '
                  '"install" method copies over files. The "develop" method '
                  'installs a package in develop mode so mode so that source '
                  'changes are picked up without reinstalling the package. '
+                 'The "link" method skips setuptools and points the '
+                 'virtualenv at the source tree with a .pth file, so '
+                 'rebuilding after a source change runs no installer. '
                  'Working packages can only be built with the "install" '
                  'method. (Default: install)')
+    parser.add_argument('--python_source_stage', default='mirror',
+            choices=PYTHON_SOURCE_STAGES,
+            help='Choose how first party python packages are staged for '
+                 'setuptools. The "mirror" stage symlinks their files into '
+                 'the source tree. The "package_dir" stage maps packages '
+                 'to their directories in the working copy and skips the '
+                 'source tree, which only works with the "install" method. '
+                 '(Default: mirror)')
+    parser.add_argument('--python_install_jobs', default=None, type=int,
+            help='Maximum number of third party python libraries to install '
+                 'into a virtualenv at once. (Default: number of CPUs)')
+    parser.add_argument('--python_compile_jobs', default=None, type=int,
+            help='Number of processes to compile python bytecode with. '
+                 '(Default: number of CPUs)')
+
+
+def get_virtualenv_template(normalizer, cache_dir):
+    """Get the virtualenv template that binaries are created from."""
+    virtualenv_tool_path = os.path.join(normalizer.repo_root_path,
+            VIRTUALENV_REPO_PATH, 'virtualenv.py')
+    return digg.dev.hackbuilder.python_virtualenv.get_template(
+            DEFAULT_PYTHON, virtualenv_tool_path, cache_dir, VIRTUALENV_ARGS)
+
+
+def get_third_party_library_install_plan(builders, dep_ids):
+    """Get the order in which to install third party libraries.
+
+    Every third party library in the transitive closure of dep_ids shows up
+    exactly once in the plan, no matter how many paths lead to it. The
+    libraries are grouped into stages. A library only depends on libraries
+    in earlier stages, so the libraries of one stage can be installed at the
+    same time.
+
+    Args:
+        builders: dict of all builders keyed by target id
+        dep_ids: The target ids of the direct dependencies to install
+
+    Returns: A list of stages, each of which is a list of
+        PythonThirdPartyLibraryBuilders.
+    """
+    install_levels = {}
+    for dep_id in dep_ids:
+        builder = builders[dep_id]
+        if isinstance(builder, PythonLibraryBuilder):
+            builder.get_third_party_install_level(builders, install_levels)
+
+    stages = collections.defaultdict(list)
+    for target_id, install_level in install_levels.iteritems():
+        builder = builders[target_id]
+        if isinstance(builder, PythonThirdPartyLibraryBuilder):
+            stages[install_level].append(builder)
+
+    return [sorted(stages[install_level],
+                   key=lambda b: b.target.target_id.id_string)
+            for install_level in sorted(stages)]
+
+
+def install_third_party_libraries(install_plan, target, virtualenv_root,
+        python_bin_path):
+    """Install the third party libraries of a plan into a virtualenv.
+
+    Args:
+        install_plan: The plan from get_third_party_library_install_plan
+        target: The target the libraries are installed for. Its
+            install_records_dir gets an install record of every library.
+        virtualenv_root: The root of the virtualenv to install into
+        python_bin_path: The python interpreter of the virtualenv
+    """
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(
+            target.install_records_dir)
+    for stage_number, stage in enumerate(install_plan):
+        logging.info('Installing stage %s of third party libs for %s: %s',
+                stage_number, target.target_id,
+                ', '.join(str(b.target.target_id) for b in stage))
+        digg.dev.hackbuilder.util.run_in_parallel(
+                lambda builder: builder.do_library_install(target,
+                    virtualenv_root, python_bin_path),
+                stage, ARGS.python_install_jobs)
+
+
+def get_interpreter_info(target, python_bin_path):
+    """Get the details of an interpreter, probing it once per change to it.
+
+    Args:
+        target: The target the interpreter is used for. The probe is cached
+            in its cache_root.
+        python_bin_path: The path of the interpreter
+    """
+    return digg.dev.hackbuilder.python_wheel.get_interpreter_info(
+            python_bin_path,
+            digg.dev.hackbuilder.toolchain.get_toolchain_probes(
+                target.cache_root))
+
+
+def get_python_launcher_text(python_bin_path, console_script):
+    """Get the text of a launcher that runs a console script directly.
+
+    The launcher names the interpreter of the virtualenv in its #! line and
+    imports the console script's entry point itself, so starting it takes
+    no processes besides the interpreter.
+
+    Args:
+        python_bin_path: The absolute path of the virtualenv's interpreter
+            once installed
+        console_script: The entry point to run, as in module:function
+    """
+    shebang = '#!%s' % (python_bin_path,)
+    if len(shebang) > MAX_SHEBANG_LENGTH:
+        raise digg.dev.hackbuilder.errors.Error(
+                'Interpreter path %s is too long for a #! line.' %
+                (python_bin_path,))
+    (module_name, attribute_path) = console_script.split(':', 1)
+    attribute_names = attribute_path.split('.')
+    return (
+            '%s\n'
+            '# Generated by hack. Runs %s.\n'
+            'import sys\n'
+            '\n'
+            'from %s import %s\n'
+            '\n'
+            "if __name__ == '__main__':\n"
+            '    sys.exit(%s())\n' %
+            (shebang, console_script, module_name, attribute_names[0],
+             attribute_path))
+
+
+def _write_file_if_changed(path, contents, mode):
+    """Write a file unless it already has the given contents.
+
+    The file is replaced rather than written through, since virtualenv files
+    may be hard links into a template.
+    """
+    try:
+        with open(path) as f:
+            if f.read() == contents:
+                return
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+    temp_path = '%s.%d' % (path, os.getpid())
+    with open(temp_path, 'w') as f:
+        f.write(contents)
+    os.chmod(temp_path, mode)
+    os.rename(temp_path, path)
 
 
 class PythonBinaryBuilder(digg.dev.hackbuilder.plugin_utils.BinaryBuilder):
     def __init__(self, target):
         digg.dev.hackbuilder.plugin_utils.BinaryBuilder.__init__(self,
                 target)
-
-        self.virtualenv_tool_path = os.path.join(
-                self.normalizer.repo_root_path,
-                VIRTUALENV_REPO_PATH, 'virtualenv.py')
+        self._slim_files = set()
+        self._console_scripts = {}
 
     def do_pre_create_source_tree_work(self, builders):
         logging.info('Creating %s-setup.py for %s',
                 self.target.target_id.name, self.target.target_id)
 
-        packages = set()
-        current_package = ''
-        for path_part in (
-                self.target.target_id.path[1:].split(os.path.sep)[:-1]):
-            current_package = '.'.join([current_package, path_part])
-            packages.add(current_package[1:])
-
-        data_files = {}
+        package_dir_setup_py_text = ''
+        package_dir_setup_args = ''
+        if ARGS.python_source_stage == 'package_dir':
+            if ARGS.python_install_method in ('develop', 'link'):
+                raise digg.dev.hackbuilder.errors.Error(
+                        'The package_dir source stage can not be used with '
+                        'the %s install method.' %
+                        (ARGS.python_install_method,))
+            package_modules = self.get_package_modules(builders)
+            self._create_init_py_files(package_modules)
+            package_dir_setup_py_text = PACKAGE_DIR_SETUP_PY_TEXT % (
+                    repr(package_modules),)
+            package_dir_setup_args = (
+                    '    package_dir=%s,\n'
+                    "    cmdclass={'build_py': BuildPy},\n" %
+                    (repr(self.get_package_dirs(builders)),))
+
+        packages = self.get_python_packages(builders)
+        data_files = self.get_python_package_data(builders)
         entry_points = {}
         for dep_id in self.target.dep_ids:
             builder = builders[dep_id]
             if isinstance(builder, PythonLibraryBuilder):
-                packages.update(builder.get_transitive_python_packages(
-                    builders))
                 entry_points.update(
                         builder.get_transitive_python_package_entry_points(
                             builders))
-                data_files.update(builder.get_transitive_python_package_data(
-                    builders))
 
         packages_string = ''
         if packages:
             packages_string = "'%s'" % "','".join(packages)
 
+        self._console_scripts = {}
+        if self.target.console_script:
+            self._console_scripts[self.target.target_id.name] = (
+                    self.target.console_script)
+        for entry_point in entry_points.get('console_scripts', ()):
+            (name, console_script) = entry_point.split('=', 1)
+            self._console_scripts.setdefault(name.strip(),
+                    console_script.strip())
+
         entry_point_string = self._entry_point_string_from_entry_points(
                 entry_points, indent_spaces=8)
 
         setup_py_text = (
                 'import setuptools\n'
+                '%s'
                 '\n'
                 'setuptools.setup(\n'
                 "    name='%s',\n"
@@ -97,63 +301,232 @@ class PythonBinaryBuilder(digg.dev.hackbuilder.plugin_utils.BinaryBuilder):
                 '%s'
                 '    },\n'
                 '    package_data=%s,\n'
+                '%s'
                 ')' %
-                (self.target.target_id.name,
+                (package_dir_setup_py_text,
+                 self.target.target_id.name,
                  packages_string,
                  self.target.target_id.name,
                  self.target.console_script,
                  entry_point_string,
-                 repr(data_files)))
+                 repr(data_files),
+                 package_dir_setup_args))
         logging.debug('Setup script contents:\n%s' % setup_py_text)
 
         logging.debug('Absolute setup script path: %s',
                 self.target.setup_py_path)
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.target.setup_py_path))
         with open(self.target.setup_py_path, 'w') as f:
             f.write(setup_py_text)
 
+    def get_python_packages(self, builders):
+        """Get the first party python packages of this binary.
+
+        Returns: A set of dotted package names.
+        """
+        packages = set()
+        current_package = ''
+        for path_part in (
+                self.target.target_id.path[1:].split(os.path.sep)[:-1]):
+            current_package = '.'.join([current_package, path_part])
+            packages.add(current_package[1:])
+
+        for dep_id in self.target.dep_ids:
+            builder = builders[dep_id]
+            if isinstance(builder, PythonLibraryBuilder):
+                packages.update(builder.get_transitive_python_packages(
+                    builders))
+        return packages
+
+    def get_package_dirs(self, builders):
+        """Get the directories of this binary's first party packages.
+
+        Packages are found in the source tree, or in the working copy with
+        the package_dir source stage. Packages without a directory in the
+        working copy are found where their __init__.py is synthesized.
+
+        Returns: A dict of absolute directory paths keyed by dotted package
+            name.
+        """
+        package_dirs = {}
+        for package in self.get_python_packages(builders):
+            rel_dir = os.path.join(*package.split('.'))
+            if ARGS.python_source_stage == 'mirror':
+                package_dirs[package] = os.path.join(self.target.source_root,
+                        rel_dir)
+                continue
+            package_dir = os.path.join(self.target.working_copy_root, rel_dir)
+            if not os.path.isdir(package_dir):
+                package_dir = os.path.join(self.target.init_py_dir, rel_dir)
+            package_dirs[package] = package_dir
+        return package_dirs
+
+    def get_package_modules(self, builders):
+        """Get the modules of this binary's first party packages.
+
+        With the package_dir source stage, the modules are the sources of
+        the binary's python_libs, plus an empty __init__.py for every
+        package that none of them provides.
+
+        Returns: A dict keyed by dotted package name of dicts of absolute
+            module paths keyed by module name.
+        """
+        package_modules = {}
+        if ARGS.python_source_stage == 'mirror':
+            for package, package_dir in (
+                    self.get_package_dirs(builders).iteritems()):
+                modules = package_modules[package] = {}
+                for filename in os.listdir(package_dir):
+                    full_path = os.path.join(package_dir, filename)
+                    if filename.endswith('.py') and os.path.isfile(full_path):
+                        modules[filename[:-len('.py')]] = full_path
+            return package_modules
+
+        package_modules = dict((package, {})
+                for package in self.get_python_packages(builders))
+        for dep_id in self.target.dep_ids:
+            builder = builders[dep_id]
+            if not isinstance(builder, PythonLibraryBuilder):
+                continue
+            for rel_path, full_path in (
+                    builder.get_transitive_python_source_files(
+                        builders).iteritems()):
+                (rel_dir, filename) = os.path.split(rel_path)
+                package = rel_dir.replace(os.path.sep, '.')
+                if filename.endswith('.py') and package in package_modules:
+                    package_modules[package][filename[:-len('.py')]] = (
+                            full_path)
+        for package, modules in package_modules.iteritems():
+            if '__init__' not in modules:
+                modules['__init__'] = os.path.join(self.target.init_py_dir,
+                        *(package.split('.') + ['__init__.py']))
+        return package_modules
+
+    def _create_init_py_files(self, package_modules):
+        for modules in package_modules.itervalues():
+            init_py_path = modules['__init__']
+            if (init_py_path.startswith(self.target.init_py_dir + os.path.sep)
+                    and not os.path.exists(init_py_path)):
+                logging.debug('Creating empty file: %s', init_py_path)
+                digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                        os.path.dirname(init_py_path))
+                with open(init_py_path, 'w') as f:
+                    # just need to create the file
+                    pass
+
+    def get_python_package_data(self, builders):
+        """Get the data files of this binary's first party packages.
+
+        Returns: A dict of lists of paths relative to the package directory,
+            keyed by dotted package name.
+        """
+        data_files = {}
+        for dep_id in self.target.dep_ids:
+            builder = builders[dep_id]
+            if isinstance(builder, PythonLibraryBuilder):
+                data_files.update(builder.get_transitive_python_package_data(
+                    builders))
+        return data_files
+
+    def get_module_owners(self, builders):
+        """Get the libraries that provide the modules of this binary.
+
+        First party modules belong to the library that lists their package.
+        Third party modules belong to the library that installed their file.
+
+        Returns: A pair of dicts of target id strings, the first keyed by
+            dotted package name and the second by absolute file path.
+        """
+        library_builders = {}
+        pending_ids = list(self.target.dep_ids)
+        while pending_ids:
+            dep_id = pending_ids.pop()
+            builder = builders[dep_id]
+            if (dep_id not in library_builders and
+                    isinstance(builder, PythonLibraryBuilder)):
+                library_builders[dep_id] = builder
+                pending_ids.extend(builder.target.dep_ids)
+
+        package_owners = {}
+        for dep_id, builder in sorted(library_builders.iteritems(),
+                key=lambda item: item[0].id_string):
+            if isinstance(builder, PythonThirdPartyLibraryBuilder):
+                continue
+            for package in builder.target.packages or ():
+                package_owners.setdefault(package, dep_id.id_string)
+
+        file_owners = {}
+        for stage in self._get_third_party_library_install_plan(builders):
+            for builder in stage:
+                record_path = os.path.join(self.target.install_records_dir,
+                        builder.target.install_record_filename)
+                try:
+                    with open(record_path) as f:
+                        paths = f.read().splitlines()
+                except IOError, e:
+                    if e.errno != errno.ENOENT:
+                        raise
+                    logging.warning('%s has not been installed for %s.',
+                            builder.target.target_id, self.target.target_id)
+                    continue
+                for path in paths:
+                    file_owners[path] = builder.target.target_id.id_string
+        return (package_owners, file_owners)
+
     def do_create_build_environment_work(self):
         logging.info('Creating virtualenv for %s', self.target.target_id)
         logging.debug('Absolute path for virtualenv: %s',
                 self.target.virtualenv_root)
-        logging.debug('Absolute path for virtualenv tool: %s',
-                self.virtualenv_tool_path)
-
-        local_env=dict(os.environ)
-        local_env['PYTHONPATH'] = self.target.virtualenv_root
-        virtualenv_proc = subprocess.Popen(
-                    (DEFAULT_PYTHON, '-B', self.virtualenv_tool_path,
-                     '--no-site-packages', '--never-download', '--distribute',
-                     self.target.virtualenv_root
-                     ),
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = virtualenv_proc.communicate()
-        retcode = virtualenv_proc.returncode
-        if retcode != 0:
-            logging.info('Virtualenv creation failed with exit code = %s',
-                    retcode)
-            logging.info('Virtualenv creation stdout:\n%s', stdoutdata)
-            logging.info('Virtualenv creation stderr:\n%s', stderrdata)
-            raise digg.dev.hackbuilder.errors.Error(
-                    'Virtualenv creation failed.')
+
+        template = get_virtualenv_template(self.normalizer,
+                self.target.virtualenv_template_cache_dir)
+        # What one install method leaves in site-packages would shadow or
+        # break another, so a virtualenv is only reused by the same method.
+        template_key = '%s %s' % (template.key, ARGS.python_install_method)
+
+        try:
+            with open(self.target.virtualenv_template_key_path) as f:
+                existing_key = f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            existing_key = None
+        if (existing_key == template_key and
+                os.path.isdir(self.target.virtualenv_root)):
+            logging.info('Virtualenv for %s is already up to date.',
+                    self.target.target_id)
+            return
+
+        if os.path.lexists(self.target.virtualenv_root):
+            shutil.rmtree(self.target.virtualenv_root)
+        digg.dev.hackbuilder.python_virtualenv.clone_template(template,
+                self.target.virtualenv_root)
+        with open(self.target.virtualenv_template_key_path, 'w') as f:
+            f.write(template_key)
 
     def do_pre_build_binary_library_install(self, builders):
         logging.info('Installing libs for binary build for %s',
                 self.target.target_id)
+        install_third_party_libraries(
+                self._get_third_party_library_install_plan(builders),
+                self.target, self.target.virtualenv_root,
+                self.target.python_bin_path)
 
-        for dep_id in self.target.dep_ids:
-            builder = builders[dep_id]
-            if isinstance(builder, PythonLibraryBuilder):
-                builder.do_pre_build_binary_library_install(builders, self)
+    def _get_third_party_library_install_plan(self, builders):
+        return get_third_party_library_install_plan(builders,
+                self.target.dep_ids)
 
     def do_build_binary_work(self):
+        if ARGS.python_install_method == 'link':
+            self._link_install()
+            return
+
         logging.info('Installing libs into virtualenv for %s',
                 self.target.target_id)
 
-        python_bin_path = os.path.join(self.target.virtualenv_root,
-                'bin', 'python')
         installer_proc = subprocess.Popen(
-                (python_bin_path, '-B', self.target.setup_py_path,
+                (self.target.python_bin_path, '-B', self.target.setup_py_path,
                     ARGS.python_install_method),
                 cwd=self.target.source_root,
                 stdin=subprocess.PIPE, stdout=subprocess.PIPE,
@@ -168,61 +541,321 @@ class PythonBinaryBuilder(digg.dev.hackbuilder.plugin_utils.BinaryBuilder):
             raise digg.dev.hackbuilder.errors.Error(
                     'Install failed.')
 
-    def do_pre_build_package_binary_install(self, builders, package_builder,
-            bin_path, lib_path, **kwargs):
-        logging.info('Copying binary for %s to package %s',
-                self.target.target_id, package_builder.target.target_id)
+    def _link_install(self):
+        """Point the virtualenv at the source tree without setuptools.
 
-        full_virtualenv_dest_path = os.path.join(
-                package_builder.full_package_hierarchy_dir + lib_path,
-                package_builder.target.target_id.name,
-                '-'.join((self.target.target_id.name, 'virtualenv')))
-        shutil.copytree(self.target.virtualenv_root, full_virtualenv_dest_path,
-                True)
+        A .pth file puts the source tree on the path of the virtualenv, and
+        every console script gets a stub that imports its entry point. Both
+        only change when the binary's packages or entry points do, so
+        source changes are picked up without running anything.
+        """
+        logging.info('Linking source tree into virtualenv for %s',
+                self.target.target_id)
+        site_packages_dirs = glob.glob(os.path.join(
+                self.target.virtualenv_root, 'lib', 'python*',
+                'site-packages'))
+        if len(site_packages_dirs) != 1:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Expected one site-packages directory in %s, found %d.' %
+                    (self.target.virtualenv_root, len(site_packages_dirs)))
+
+        _write_file_if_changed(
+                os.path.join(site_packages_dirs[0],
+                    'hack-%s.pth' % (self.target.target_id.name,)),
+                self.target.source_root + '\n', 0644)
+        for name, console_script in sorted(
+                self._console_scripts.iteritems()):
+            _write_file_if_changed(
+                    os.path.join(self.target.virtualenv_root, 'bin', name),
+                    get_python_launcher_text(self.target.python_bin_path,
+                        console_script),
+                    0755)
 
-        logging.info('Creating wrapper script for %s for package %s',
+    def do_pre_build_package_binary_install(self, builders, package_builder,
+            bin_path, lib_path, shared_runtimes=(),
+            merge_python_virtualenvs=False, **kwargs):
+        logging.info('Copying binary for %s to package %s',
                 self.target.target_id, package_builder.target.target_id)
-        full_console_script_wrapper_dir = (
-                package_builder.full_package_hierarchy_dir) + bin_path
-        digg.dev.hackbuilder.util.mkdir_if_not_exists(
-                full_console_script_wrapper_dir)
-        full_console_script_wrapper_path = os.path.join(
-                full_console_script_wrapper_dir, self.target.target_id.name)
 
+        python_runtimes = [runtime for runtime in shared_runtimes
+                if isinstance(runtime.builder, PythonRuntimeBuilder)]
+        if merge_python_virtualenvs:
+            virtualenv_dest_path = os.path.join(lib_path,
+                    package_builder.target.target_id.name,
+                    'python-virtualenv')
+            merged_builders = self._get_package_python_binary_builders(
+                    builders, package_builder)
+            # The first binary installs the virtualenv for all of them.
+            if merged_builders[0] is self:
+                merged_virtualenv_root = os.path.join(
+                        package_builder.target.target_build_dir,
+                        'merged_python_virtualenv')
+                digg.dev.hackbuilder.python_virtualenv.merge_virtualenvs(
+                        [(builder.target.virtualenv_root,
+                          builder._get_package_exclude(builders,
+                              python_runtimes))
+                         for builder in merged_builders],
+                        merged_virtualenv_root)
+                third_party_paths = set()
+                for builder in merged_builders:
+                    third_party_paths.update(
+                            builder._get_third_party_files(builders))
+                package_builder.install_tree(merged_virtualenv_root,
+                        virtualenv_dest_path,
+                        third_party_paths=third_party_paths)
+        else:
+            virtualenv_dest_path = os.path.join(lib_path,
+                    package_builder.target.target_id.name,
+                    '-'.join((self.target.target_id.name, 'virtualenv')))
+            package_builder.install_tree(self.target.virtualenv_root,
+                    virtualenv_dest_path,
+                    self._get_package_exclude(builders, python_runtimes),
+                    self._get_third_party_files(builders))
+
+        interpreter_info = (
+                get_interpreter_info(self.target,
+                    self.target.python_bin_path))
+        site_packages_dir = os.path.relpath(
+                digg.dev.hackbuilder.python_wheel.get_site_packages_dir(
+                    self.target.virtualenv_root, interpreter_info),
+                self.target.virtualenv_root)
+        for runtime in python_runtimes:
+            logging.info('Using shared python runtime at %s for %s',
+                    runtime.install_path, self.target.target_id)
+            # addsitedir processes the .pth files of the runtime too.
+            pth_path = os.path.join(virtualenv_dest_path, site_packages_dir,
+                    'hack-runtime-%s.pth' %
+                    (os.path.basename(runtime.install_path),))
+            package_builder.install_file_contents(pth_path,
+                    'import site; site.addsitedir(%r)\n' %
+                    (runtime.builder.get_site_packages_path(
+                        runtime.install_path),))
+
+        if self.target.compile_bytecode_on_install:
+            self._add_compile_bytecode_maintainer_scripts(package_builder,
+                    virtualenv_dest_path, site_packages_dir)
+
+        self._install_launcher(package_builder, bin_path,
+                virtualenv_dest_path)
+
+    def _install_launcher(self, package_builder, bin_path,
+            virtualenv_dest_path):
+        logging.info('Creating %s launcher for %s for package %s',
+                self.target.launcher, self.target.target_id,
+                package_builder.target.target_id)
+        launcher_path = os.path.join(bin_path, self.target.target_id.name)
         console_script_exec_target = os.path.join(
-                os.path.relpath(full_virtualenv_dest_path,
-                    full_console_script_wrapper_dir), 'bin',
+                os.path.relpath(virtualenv_dest_path, bin_path), 'bin',
                 self.target.target_id.name)
-
-        with open(full_console_script_wrapper_path, 'w') as f:
-            f.write('#!/usr/bin/env bash\n')
-            f.write('\n')
-            f.write('set -e\n')
-            f.write('\n')
-            f.write('DIR="$( cd -P "$( dirname "$0" )" && pwd )"\n')
-            f.write('exec ${DIR}/%s "$@"' % (console_script_exec_target,))
-        os.chmod(full_console_script_wrapper_path, 0755)
+        if self.target.launcher == 'symlink':
+            # The relocatable console script finds its virtualenv through
+            # the real path of the script.
+            package_builder.install_symlink(launcher_path,
+                    console_script_exec_target)
+        elif self.target.launcher == 'python':
+            package_builder.install_file_contents(launcher_path,
+                    get_python_launcher_text(
+                        os.path.join(virtualenv_dest_path, 'bin', 'python'),
+                        self.target.console_script),
+                    0755)
+        else:
+            console_script_wrapper_text = (
+                    '#!/usr/bin/env bash\n'
+                    '\n'
+                    'set -e\n'
+                    '\n'
+                    'DIR="$( cd -P "$( dirname "$0" )" && pwd )"\n'
+                    'exec ${DIR}/%s "$@"' % (console_script_exec_target,))
+            package_builder.install_file_contents(launcher_path,
+                    console_script_wrapper_text, 0755)
+
+    def _add_compile_bytecode_maintainer_scripts(self, package_builder,
+            virtualenv_dest_path, site_packages_dir):
+        """Compile the installed virtualenv's modules when it is installed.
+
+        The bytecode isn't part of the package, so it is removed again before
+        the package is removed.
+        """
+        python_path = pipes.quote(os.path.join(virtualenv_dest_path, 'bin',
+                'python'))
+        site_packages_path = pipes.quote(os.path.join(virtualenv_dest_path,
+                site_packages_dir))
+        package_builder.add_maintainer_script_fragment('postinst',
+                'if [ "$1" = configure ]; then\n'
+                '    %s -m compileall -q %s >/dev/null || true\n'
+                'fi\n' % (python_path, site_packages_path))
+        package_builder.add_maintainer_script_fragment('prerm',
+                'find %s -name "*.py[co]" -delete\n'
+                'find %s -depth -name __pycache__ -type d -empty -delete\n' %
+                (site_packages_path, site_packages_path))
+
+    def _get_package_python_binary_builders(self, builders, package_builder):
+        python_binary_builders = [builders[dep_id]
+                for dep_id in package_builder.target.dep_ids
+                if isinstance(builders[dep_id], PythonBinaryBuilder)]
+        return sorted(python_binary_builders,
+                key=lambda b: b.target.target_id.id_string)
+
+    def _get_package_exclude(self, builders, python_runtimes):
+        """Get the files of this binary's virtualenv to leave out of packages.
+
+        Returns: A set of paths relative to the virtualenv root.
+        """
+        return self._slim_files | self._get_files_provided_by_runtimes(
+                builders, python_runtimes)
+
+    def _get_files_provided_by_runtimes(self, builders, python_runtimes):
+        """Get the files of this binary's virtualenv that runtimes provide.
+
+        These are the files that the third party libraries the binary shares
+        with the runtimes installed into site-packages. Scripts and data files
+        stay in the binary's virtualenv.
+
+        Args:
+            builders: dict of all builders keyed by target id
+            python_runtimes: The SharedRuntimes of PythonRuntimeBuilders
+
+        Returns: A set of paths relative to the virtualenv root.
+        """
+        if not python_runtimes:
+            return set()
+
+        provided_library_ids = set()
+        for runtime in python_runtimes:
+            provided_library_ids.update(
+                    runtime.builder.get_provided_library_ids(builders))
+        interpreter_info = (
+                get_interpreter_info(self.target,
+                    self.target.python_bin_path))
+        site_packages_dir = (
+                digg.dev.hackbuilder.python_wheel.get_site_packages_dir(
+                    self.target.virtualenv_root, interpreter_info))
+
+        provided_files = set()
+        for stage in self._get_third_party_library_install_plan(builders):
+            for builder in stage:
+                if builder.target.target_id not in provided_library_ids:
+                    continue
+                record_path = os.path.join(self.target.install_records_dir,
+                        builder.target.install_record_filename)
+                with open(record_path) as f:
+                    for path in f.read().splitlines():
+                        if path.startswith(site_packages_dir + os.path.sep):
+                            provided_files.add(os.path.relpath(path,
+                                self.target.virtualenv_root))
+        return provided_files
+
+    def _get_third_party_files(self, builders):
+        """Get the files of this binary's virtualenv that come from third
+        party libraries.
+
+        These are the files in the install records of the libraries, along
+        with the bytecode compiled from their modules.
+
+        Returns: A set of paths relative to the virtualenv root.
+        """
+        third_party_files = set()
+        for stage in self._get_third_party_library_install_plan(builders):
+            for builder in stage:
+                record_path = os.path.join(self.target.install_records_dir,
+                        builder.target.install_record_filename)
+                with open(record_path) as f:
+                    for path in f.read().splitlines():
+                        if path.startswith(
+                                self.target.virtualenv_root + os.path.sep):
+                            third_party_files.add(os.path.relpath(path,
+                                self.target.virtualenv_root))
+
+        pycache_dirs = set()
+        for rel_path in list(third_party_files):
+            if rel_path.endswith('.py'):
+                third_party_files.add(rel_path + 'c')
+                pycache_dirs.add(os.path.join(os.path.dirname(rel_path),
+                        '__pycache__'))
+        for rel_dir in pycache_dirs:
+            full_dir = os.path.join(self.target.virtualenv_root, rel_dir)
+            if not os.path.isdir(full_dir):
+                continue
+            for filename in os.listdir(full_dir):
+                # Bytecode is named <module>.<cache tag>[.opt-N].pyc.
+                module_path = os.path.join(os.path.dirname(rel_dir),
+                        filename.split('.')[0] + '.py')
+                if module_path in third_party_files:
+                    third_party_files.add(os.path.join(rel_dir, filename))
+        return third_party_files
 
     def do_build_package_work(self):
         logging.info('Making built virtualenv relocatable for %s',
                 self.target.target_id)
-        virtualenv_proc = subprocess.Popen(
-                    (DEFAULT_PYTHON, '-B', self.virtualenv_tool_path,
-                     '--relocatable', self.target.virtualenv_root
-                     ),
-                    stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = virtualenv_proc.communicate()
-        retcode = virtualenv_proc.returncode
-        if retcode != 0:
-            logging.info('Making virtualenv relocatable failed with exit code = %s',
-                    e.returncode)
-            logging.info('Making virtualenv relocatable stdout:\n%s',
-                    stdoutdata)
-            logging.info('Making virtualenv relocatable stderr:\n%s',
-                    stderrdata)
-            raise digg.dev.hackbuilder.errors.Error(
-                    'Making virtualenv relocatable failed.')
+        interpreter_info = (
+                get_interpreter_info(self.target,
+                    self.target.python_bin_path))
+        digg.dev.hackbuilder.python_virtualenv.make_relocatable(
+                self.target.virtualenv_root, interpreter_info['version'],
+                self.target.relocation_state_path)
+
+        if self.target.compile_bytecode or self.target.slim_bytecode_only:
+            self._compile_site_packages(interpreter_info)
+        if self.target.slim:
+            self._find_slim_files()
+
+    def _find_slim_files(self):
+        logging.info('Finding files to leave out of slim virtualenv for %s',
+                self.target.target_id)
+        self._slim_files = (
+                digg.dev.hackbuilder.python_virtualenv.find_slim_files(
+                    self.target.virtualenv_root, self.target.slim_patterns,
+                    self.target.slim_bytecode_only))
+
+        saved_bytes = self._get_slim_saved_bytes_by_library()
+        logging.info('Slim virtualenv for %s saves %d bytes in total',
+                self.target.target_id, sum(saved_bytes.itervalues()))
+        for library, size in sorted(saved_bytes.iteritems(),
+                key=lambda item: (-item[1], item[0])):
+            logging.info('    %10d bytes: %s', size, library)
+        with open(self.target.slim_report_path, 'w') as f:
+            json.dump(saved_bytes, f, sort_keys=True, indent=4)
+
+    def _compile_site_packages(self, interpreter_info):
+        logging.info('Compiling bytecode for %s', self.target.target_id)
+        site_packages_dir = (
+                digg.dev.hackbuilder.python_wheel.get_site_packages_dir(
+                    self.target.virtualenv_root, interpreter_info))
+        digg.dev.hackbuilder.python_bytecode.compile_tree(
+                self.target.python_bin_path, site_packages_dir,
+                self.target.compile_script_path,
+                os.path.relpath(site_packages_dir,
+                    self.target.virtualenv_root),
+                ARGS.python_compile_jobs)
+
+    def _get_slim_saved_bytes_by_library(self):
+        """Attribute the size of the left out files to libraries.
+
+        Files are attributed to the third party library whose install record
+        lists them. The rest comes with the virtualenv itself or with the
+        binary's own libraries.
+
+        Returns: A dict of saved bytes keyed by library.
+        """
+        libraries_by_path = {}
+        if os.path.isdir(self.target.install_records_dir):
+            for record_filename in os.listdir(
+                    self.target.install_records_dir):
+                with open(os.path.join(self.target.install_records_dir,
+                        record_filename)) as f:
+                    for path in f.read().splitlines():
+                        libraries_by_path[path] = (
+                                os.path.splitext(record_filename)[0])
+
+        saved_bytes = collections.defaultdict(int)
+        for rel_path in self._slim_files:
+            full_path = os.path.join(self.target.virtualenv_root, rel_path)
+            file_stat = os.lstat(full_path)
+            if not stat.S_ISREG(file_stat.st_mode):
+                continue
+            library = libraries_by_path.get(full_path, '(virtualenv)')
+            saved_bytes[library] += file_stat.st_size
+        return dict(saved_bytes)
 
     def _entry_point_string_from_entry_points(self, entry_points,
             indent_spaces=0):
@@ -244,17 +877,47 @@ class PythonBinaryBuilder(digg.dev.hackbuilder.plugin_utils.BinaryBuilder):
 class PythonBinaryBuildTarget(digg.dev.hackbuilder.target.BinaryBuildTarget):
     builder_class = PythonBinaryBuilder
 
-    def __init__(self, normalizer, target_id, dep_ids, console_script=None):
+    def __init__(self, normalizer, target_id, dep_ids, console_script=None,
+            slim=False, slim_patterns=None, slim_bytecode_only=False,
+            compile_bytecode=True, compile_bytecode_on_install=False,
+            launcher='bash'):
         digg.dev.hackbuilder.target.BinaryBuildTarget.__init__(self,
                 normalizer, target_id, dep_ids)
+        if launcher not in PYTHON_LAUNCHERS:
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Unknown launcher %s for %s. Choose one of: %s' %
+                    (launcher, target_id, ', '.join(PYTHON_LAUNCHERS)))
         self.console_script = console_script
+        self.launcher = launcher
+        self.compile_bytecode = compile_bytecode
+        self.compile_bytecode_on_install = compile_bytecode_on_install
+        self.compile_script_path = os.path.join(self.target_build_dir,
+                'compile_bytecode.py')
+        self.slim = slim or bool(slim_patterns) or slim_bytecode_only
+        self.slim_patterns = (
+                digg.dev.hackbuilder.python_virtualenv.SLIM_EXCLUDE_PATTERNS +
+                tuple(slim_patterns or ()))
+        self.slim_bytecode_only = slim_bytecode_only
+        self.slim_report_path = os.path.join(self.target_build_dir,
+                'slim_report.json')
         self.virtualenv_root = os.path.join(self.target_build_dir,
                 'python_virtualenv')
         self.bin_path = os.path.join(self.virtualenv_root, 'bin',
                 self.target_id.name)
+        self.python_bin_path = os.path.join(self.virtualenv_root, 'bin',
+                'python')
         self.setup_py_path = os.path.join(
                 self.target_source_dir,
                 'setup-%s.py' % self.target_id.name)
+        self.install_records_dir = os.path.join(self.target_build_dir,
+                'install_records')
+        self.init_py_dir = os.path.join(self.target_build_dir, 'init_py')
+        self.virtualenv_template_key_path = os.path.join(
+                self.target_build_dir, 'python_virtualenv.template_key')
+        self.relocation_state_path = os.path.join(self.target_build_dir,
+                'python_virtualenv.relocation')
+        self.virtualenv_template_cache_dir = os.path.join(self.cache_root,
+                'python_virtualenv_templates')
 
 
 class PythonTestBuilder(PythonBinaryBuilder):
@@ -265,6 +928,263 @@ class PythonTestBuildTarget(PythonBinaryBuildTarget):
     builder_class = PythonTestBuilder
 
 
+class PythonZipAppBuilder(digg.dev.hackbuilder.plugin_utils.BinaryBuilder):
+    """A builder of a python binary as a single executable zip file.
+
+    The zipapp holds the first party packages and third party libraries of a
+    python_bin, with bytecode compiled ahead of time by the binary's
+    interpreter. Deploying it means copying one file.
+    """
+    def __init__(self, target):
+        digg.dev.hackbuilder.plugin_utils.BinaryBuilder.__init__(self,
+                target)
+        self._binary_target = None
+
+    def do_pre_create_source_tree_work(self, builders):
+        pass
+
+    def do_pre_build_binary_library_install(self, builders):
+        binary_builder = builders[self.target.binary_id]
+        if not isinstance(binary_builder, PythonBinaryBuilder):
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Zipapp %s needs a python binary, not %s.' %
+                    (self.target.target_id, self.target.binary_id))
+        self._binary_target = binary_builder.target
+
+        logging.info('Collecting files for zipapp %s', self.target.target_id)
+        files = self._get_first_party_files(binary_builder, builders)
+        files.update(self._get_third_party_files(binary_builder, builders))
+
+        if os.path.lexists(self.target.zipapp_root):
+            shutil.rmtree(self.target.zipapp_root)
+        for rel_path, src_path in files.iteritems():
+            dest_path = os.path.join(self.target.zipapp_root, rel_path)
+            digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                    os.path.dirname(dest_path))
+            digg.dev.hackbuilder.util.link_or_copy_file(src_path, dest_path)
+
+    def _get_first_party_files(self, binary_builder, builders):
+        """Get the modules and data files of the binary's own packages.
+
+        Like setuptools, only the modules directly in each package are
+        included; subpackages are packages of their own.
+
+        Returns: A dict of source paths keyed by path in the zipapp.
+        """
+        files = {}
+        for package, modules in (
+                binary_builder.get_package_modules(builders).iteritems()):
+            package_dir = os.path.join(*package.split('.'))
+            for module, full_path in modules.iteritems():
+                files[os.path.join(package_dir, module + '.py')] = (
+                        os.path.realpath(full_path))
+
+        package_dirs = binary_builder.get_package_dirs(builders)
+        for package, patterns in (
+                binary_builder.get_python_package_data(builders).iteritems()):
+            if package not in package_dirs:
+                continue
+            full_package_dir = package_dirs[package]
+            for pattern in patterns:
+                for full_path in glob.glob(os.path.join(full_package_dir,
+                        pattern)):
+                    files[os.path.join(os.path.join(*package.split('.')),
+                        os.path.relpath(full_path, full_package_dir))] = (
+                                os.path.realpath(full_path))
+        return files
+
+    def _get_third_party_files(self, binary_builder, builders):
+        """Get the files third party libraries installed into site-packages.
+
+        Scripts and data files installed elsewhere are left out, as is
+        bytecode, which the zipapp compiles itself.
+
+        Returns: A dict of source paths keyed by path in the zipapp.
+        """
+        binary_target = binary_builder.target
+        interpreter_info = (
+                get_interpreter_info(binary_target,
+                    binary_target.python_bin_path))
+        site_packages_dir = (
+                digg.dev.hackbuilder.python_wheel.get_site_packages_dir(
+                    binary_target.virtualenv_root, interpreter_info))
+
+        files = {}
+        for stage in get_third_party_library_install_plan(builders,
+                binary_target.dep_ids):
+            for library_builder in stage:
+                record_path = os.path.join(binary_target.install_records_dir,
+                        library_builder.target.install_record_filename)
+                with open(record_path) as f:
+                    for path in f.read().splitlines():
+                        if not path.startswith(
+                                site_packages_dir + os.path.sep):
+                            continue
+                        rel_path = os.path.relpath(path, site_packages_dir)
+                        if rel_path.endswith(('.pyc', '.pyo')):
+                            continue
+                        if rel_path.endswith('.pth'):
+                            logging.warning('Zipapp %s leaves out %s, since '
+                                    'zipimport ignores .pth files.',
+                                    self.target.target_id, rel_path)
+                            continue
+                        files[rel_path] = path
+        return files
+
+    def do_build_binary_work(self):
+        logging.info('Compiling bytecode for zipapp %s',
+                self.target.target_id)
+        # Modules in the zipapp can't change, so their bytecode doesn't
+        # need to be checked against them.
+        digg.dev.hackbuilder.python_bytecode.compile_tree(
+                self._binary_target.python_bin_path, self.target.zipapp_root,
+                self.target.compile_script_path, '', ARGS.python_compile_jobs,
+                legacy_layout=True, check_source=False)
+
+        interpreter = self.target.interpreter
+        if interpreter is None:
+            interpreter_info = (
+                    get_interpreter_info(self._binary_target,
+                        self._binary_target.python_bin_path))
+            interpreter = '/usr/bin/env python' + interpreter_info['version']
+        digg.dev.hackbuilder.python_zipapp.write_zipapp(
+                self.target.bin_path, self.target.zipapp_root,
+                self._binary_target.console_script, interpreter,
+                digg.dev.hackbuilder.digest.get_digest_cache(
+                    self.target.cache_root))
+
+    def do_pre_build_package_binary_install(self, builders, package_builder,
+            bin_path, **kwargs):
+        logging.info('Copying zipapp %s to package %s',
+                self.target.target_id, package_builder.target.target_id)
+        with open(self.target.bin_path, 'rb') as f:
+            package_builder.install_file_contents(
+                    os.path.join(bin_path, self.target.target_id.name),
+                    f.read(), 0755)
+
+
+class PythonZipAppBuildTarget(digg.dev.hackbuilder.target.BinaryBuildTarget):
+    builder_class = PythonZipAppBuilder
+
+    def __init__(self, normalizer, target_id, binary_id, interpreter=None):
+        digg.dev.hackbuilder.target.BinaryBuildTarget.__init__(self,
+                normalizer, target_id, set([binary_id]))
+        self.binary_id = binary_id
+        self.interpreter = interpreter
+        self.zipapp_root = os.path.join(self.target_build_dir,
+                'zipapp_root')
+        self.compile_script_path = os.path.join(self.target_build_dir,
+                'compile_bytecode.py')
+        self.bin_path = os.path.join(self.target_build_dir,
+                self.target_id.name + '.pyz')
+
+
+class PythonRuntimeBuilder(
+        digg.dev.hackbuilder.plugin_utils.SharedRuntimeBuilder):
+    """A builder of third party libraries shared by several packages.
+
+    The libraries are installed into a site-packages directory of their own,
+    which a package installs under its lib path. Binaries in packages that
+    use the runtime leave out the libraries it provides.
+    """
+    def do_pre_create_source_tree_work(self, builders):
+        pass
+
+    def do_pre_build_binary_library_install(self, builders):
+        logging.info('Installing libs for python runtime %s',
+                self.target.target_id)
+        template = get_virtualenv_template(self.normalizer,
+                self.target.virtualenv_template_cache_dir)
+        python_bin_path = os.path.join(template.root, 'bin', 'python')
+        install_plan = get_third_party_library_install_plan(builders,
+                self.target.dep_ids)
+        # Like the virtualenv of a binary, the runtime is kept for as long as
+        # the libraries to install into it are the same.
+        install_key = self._get_install_key(template, install_plan,
+                python_bin_path)
+        try:
+            with open(self.target.install_key_path) as f:
+                existing_key = f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            existing_key = None
+        if (existing_key == install_key and
+                os.path.isdir(self.target.runtime_root)):
+            logging.info('Python runtime %s is already up to date.',
+                    self.target.target_id)
+            return
+
+        # A runtime that is only partly installed must not look up to date.
+        if existing_key is not None:
+            os.remove(self.target.install_key_path)
+        if os.path.lexists(self.target.runtime_root):
+            shutil.rmtree(self.target.runtime_root)
+        install_third_party_libraries(install_plan, self.target,
+                self.target.runtime_root, python_bin_path)
+        with open(self.target.install_key_path, 'w') as f:
+            f.write(install_key)
+
+    def _get_install_key(self, template, install_plan, python_bin_path):
+        interpreter_info = get_interpreter_info(self.target, python_bin_path)
+        key_data = json.dumps([
+                template.key,
+                [[builder.target.target_id.id_string,
+                  builder.get_wheel_cache_key(interpreter_info)]
+                 for stage in install_plan for builder in stage],
+                ], sort_keys=True)
+        return hashlib.sha1(key_data).hexdigest()
+
+    def get_provided_library_ids(self, builders):
+        """Get the target ids of the third party libraries in the runtime."""
+        return set(builder.target.target_id
+                   for stage in get_third_party_library_install_plan(builders,
+                       self.target.dep_ids)
+                   for builder in stage)
+
+    def get_site_packages_path(self, install_path):
+        """Get the path of the runtime's site-packages once installed.
+
+        Args:
+            install_path: The absolute path the runtime is installed at
+        """
+        return os.path.join(install_path, 'site-packages')
+
+    def do_pre_build_package_binary_install(self, builders, package_builder,
+            lib_path, **kwargs):
+        logging.info('Copying python runtime %s to package %s',
+                self.target.target_id, package_builder.target.target_id)
+        template = get_virtualenv_template(self.normalizer,
+                self.target.virtualenv_template_cache_dir)
+        interpreter_info = (
+                get_interpreter_info(self.target,
+                    os.path.join(template.root, 'bin', 'python')))
+        site_packages_dir = (
+                digg.dev.hackbuilder.python_wheel.get_site_packages_dir(
+                    self.target.runtime_root, interpreter_info))
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(site_packages_dir)
+        package_builder.install_tree(site_packages_dir,
+                self.get_site_packages_path(os.path.join(lib_path,
+                    package_builder.target.target_id.name)))
+
+
+class PythonRuntimeBuildTarget(
+        digg.dev.hackbuilder.target.BinaryBuildTarget):
+    builder_class = PythonRuntimeBuilder
+
+    def __init__(self, normalizer, target_id, dep_ids):
+        digg.dev.hackbuilder.target.BinaryBuildTarget.__init__(self,
+                normalizer, target_id, dep_ids)
+        self.runtime_root = os.path.join(self.target_build_dir,
+                'python_runtime')
+        self.install_key_path = os.path.join(self.target_build_dir,
+                'python_runtime.install_key')
+        self.install_records_dir = os.path.join(self.target_build_dir,
+                'install_records')
+        self.virtualenv_template_cache_dir = os.path.join(self.cache_root,
+                'python_virtualenv_templates')
+
+
 class PythonLibraryBuilder(digg.dev.hackbuilder.plugin_utils.LibraryBuilder):
     def get_transitive_python_packages(self, builders):
         packages = set(self.target.packages)
@@ -276,6 +1196,26 @@ class PythonLibraryBuilder(digg.dev.hackbuilder.plugin_utils.LibraryBuilder):
 
         return packages
 
+    def get_transitive_python_source_files(self, builders):
+        """Get the source files of this library and its dependencies.
+
+        Returns: A dict of absolute working copy paths keyed by path relative
+            to the repository root.
+        """
+        rel_dir = self.target.target_id.path[1:]
+        source_files = dict(
+                (os.path.normpath(os.path.join(rel_dir, source_file)),
+                 os.path.join(self.target.target_working_copy_dir,
+                     source_file))
+                for source_file in self.target.source_files or ())
+        for dep_id in self.target.dep_ids:
+            builder = builders[dep_id]
+            if isinstance(builder, PythonLibraryBuilder):
+                source_files.update(
+                        builder.get_transitive_python_source_files(builders))
+
+        return source_files
+
     def get_transitive_python_package_entry_points(self, builders):
         python_package_entry_points = self.target.entry_points
         for dep_id in self.target.dep_ids:
@@ -299,14 +1239,45 @@ class PythonLibraryBuilder(digg.dev.hackbuilder.plugin_utils.LibraryBuilder):
 
         return python_package_data
 
-    def do_pre_build_binary_library_install(self, builders, binary_builder):
+    def get_third_party_install_level(self, builders, install_levels):
+        """Get the install level of the third party libs under this lib.
+
+        Third party libraries without third party dependencies have install
+        level 0. Every other third party library is one level above the
+        highest level in its dependencies.
+
+        Args:
+            builders: dict of all builders keyed by target id
+            install_levels: dict of already computed install levels keyed by
+                target id. This is updated with the levels of this library
+                and everything it depends on.
+
+        Returns: The highest install level in the transitive closure of this
+            library, or -1 if there are no third party libraries in it.
+        """
+        if self.target.target_id in install_levels:
+            return install_levels[self.target.target_id]
+
+        install_level = self._get_dep_third_party_install_level(builders,
+                install_levels)
+        install_levels[self.target.target_id] = install_level
+        return install_level
+
+    def _get_dep_third_party_install_level(self, builders, install_levels):
+        install_level = -1
         for dep_id in self.target.dep_ids:
             builder = builders[dep_id]
             if isinstance(builder, PythonLibraryBuilder):
-                builder.do_pre_build_binary_library_install(builders,
-                        binary_builder)
+                install_level = max(install_level,
+                        builder.get_third_party_install_level(builders,
+                            install_levels))
+        return install_level
 
     def do_create_source_tree_work(self):
+        if ARGS.python_source_stage == 'package_dir':
+            logging.info('Binaries read %s from the working copy, skipping '
+                    'its source tree.', self.target.target_id)
+            return
         digg.dev.hackbuilder.plugin_utils.LibraryBuilder.do_create_source_tree_work(
                 self)
         self._create_init_py_files()
@@ -366,44 +1337,119 @@ class PythonLibraryBuildTarget(digg.dev.hackbuilder.target.LibraryBuildTarget):
         self.all_files = self.source_files + self.data_files
         self.packages = packages
 
+    def get_input_paths(self):
+        (input_files, input_dirs) = (
+                digg.dev.hackbuilder.target.BuildTarget.get_input_paths(self))
+        input_files.extend(os.path.join(self.target_working_copy_dir, path)
+                for path in self.all_files)
+        return (input_files, input_dirs)
+
 
 class PythonThirdPartyLibraryBuilder(PythonLibraryBuilder):
+    def __init__(self, target):
+        PythonLibraryBuilder.__init__(self, target)
+        self._source_tree_hash = None
+
     def get_transitive_python_packages(self, builders):
         return set()
 
+    def get_transitive_python_source_files(self, builders):
+        return {}
+
     def get_transitive_python_package_entry_points(self, builders):
         return {}
 
     def get_transitive_python_package_data(self, builders):
         return {}
 
-    def do_pre_build_binary_library_install(self, builders, binary_builder):
-        for dep_id in self.target.dep_ids:
-            builder = builders[dep_id]
-            if isinstance(builder, PythonLibraryBuilder):
-                builder.do_pre_build_binary_library_install(builders,
-                        binary_builder)
-
-        logging.info('Installing %s in %s binary build directory' %
-                (self.target.target_id, binary_builder.target.target_id))
-        python_bin_path = os.path.join(binary_builder.target.virtualenv_root,
-                'bin', 'python')
-        full_target_path = os.path.join(self.target.target_source_dir,
+    def get_third_party_install_level(self, builders, install_levels):
+        if self.target.target_id in install_levels:
+            return install_levels[self.target.target_id]
+
+        install_level = 1 + self._get_dep_third_party_install_level(builders,
+                install_levels)
+        install_levels[self.target.target_id] = install_level
+        return install_level
+
+    def do_library_install(self, target, virtualenv_root, python_bin_path):
+        """Install this library into a virtualenv.
+
+        The library is installed by unpacking its wheel, so no installer runs
+        and several libraries can be installed into the same virtualenv at
+        once.
+
+        Args:
+            target: The target the library is installed for. The install
+                record goes into its install_records_dir.
+            virtualenv_root: The root of the virtualenv to install into
+            python_bin_path: The python interpreter to build the wheel with
+        """
+        logging.info('Installing %s in %s build directory' %
+                (self.target.target_id, target.target_id))
+        interpreter_info = (
+                get_interpreter_info(self.target,
+                    python_bin_path))
+        wheel_path = self.get_wheel(python_bin_path, interpreter_info)
+        record_path = os.path.join(target.install_records_dir,
+                self.target.install_record_filename)
+        digg.dev.hackbuilder.python_wheel.install_wheel(wheel_path,
+                virtualenv_root, interpreter_info, record_path)
+
+    def get_wheel(self, python_bin_path, interpreter_info):
+        """Get a wheel of this library, building it if needed.
+
+        Wheels are cached by the hash of the library's source tree and the
+        details of the interpreter they are built for. A library is only
+        compiled once per interpreter, no matter how many binaries use it.
+
+        Args:
+            python_bin_path: The path of a python interpreter that has
+                setuptools and matches interpreter_info
+            interpreter_info: The interpreter details from
+                digg.dev.hackbuilder.python_wheel.get_interpreter_info
+
+        Returns: The path of the wheel.
+        """
+        wheel_dir = os.path.join(self.target.wheel_cache_dir,
+                self.get_wheel_cache_key(interpreter_info))
+        wheel_path = digg.dev.hackbuilder.python_wheel.find_wheel(wheel_dir)
+        if wheel_path is not None:
+            logging.info('Using cached wheel for %s: %s',
+                    self.target.target_id, wheel_path)
+            return wheel_path
+
+        logging.info('Building wheel for %s', self.target.target_id)
+        full_setup_py_dir = os.path.join(self.target.target_source_dir,
                 self.target.setup_py_dir)
-        installer_proc = subprocess.Popen(
-                (python_bin_path, '-B', 'setup.py', 'install'),
-                cwd=full_target_path,
-                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE)
-        (stdoutdata, stderrdata) = installer_proc.communicate()
-        retcode = installer_proc.returncode
-        if retcode != 0:
-            logging.info('Library install failed with exit code = %s',
-                    retcode)
-            logging.info('Library install stdout:\n%s', stdoutdata)
-            logging.info('Library install stderr:\n%s', stderrdata)
-            raise digg.dev.hackbuilder.errors.Error(
-                    'Library install failed.')
+        return digg.dev.hackbuilder.python_wheel.build_wheel(python_bin_path,
+                full_setup_py_dir, wheel_dir, interpreter_info)
+
+    def get_wheel_cache_key(self, interpreter_info):
+        """Get the key that the wheel of this library is cached by.
+
+        The key changes whenever the library's source tree or the details of
+        the interpreter do.
+
+        Args:
+            interpreter_info: The interpreter details from
+                digg.dev.hackbuilder.python_wheel.get_interpreter_info
+        """
+        if self._source_tree_hash is None:
+            full_src_path = os.path.join(self.target.target_working_copy_dir,
+                    self.target.lib_dir)
+            self._source_tree_hash = (
+                    digg.dev.hackbuilder.util.hash_directory_tree(
+                        full_src_path,
+                        digg.dev.hackbuilder.digest.get_digest_cache(
+                            self.target.cache_root)))
+
+        key_data = json.dumps([
+                WHEEL_CACHE_VERSION,
+                self._source_tree_hash,
+                os.path.relpath(self.target.setup_py_dir, self.target.lib_dir),
+                interpreter_info,
+                ], sort_keys=True)
+        return hashlib.sha1(key_data).hexdigest()
 
     def do_create_source_tree_work(self):
         logging.info('Copying %s into source tree using source lib_dir (%s)',
@@ -412,9 +1458,8 @@ class PythonThirdPartyLibraryBuilder(PythonLibraryBuilder):
                 self.target.lib_dir)
         full_target_path = os.path.join(self.target.target_source_dir,
                 self.target.lib_dir)
-        digg.dev.hackbuilder.util.mirror_filesystem_hierarchy(
-                full_src_path,
-                full_target_path)
+        digg.dev.hackbuilder.source_mirror.mirror_tree(full_src_path,
+                full_target_path, self.target.source_tree_manifest_path)
 
 
 class PythonThirdPartyLibraryBuildTarget(
@@ -431,16 +1476,34 @@ class PythonThirdPartyLibraryBuildTarget(
             self.setup_py_dir = lib_dir
         self.normal_lib_dir = self.normalizer.normalize_path_in_build_file(
                 lib_dir, self.target_id.path)
+        self.wheel_cache_dir = os.path.join(self.cache_root, 'python_wheels')
+        self.install_record_filename = '%s.txt' % (
+                self.target_id.to_filename(),)
+
+    def get_input_paths(self):
+        (input_files, input_dirs) = (
+                digg.dev.hackbuilder.target.BuildTarget.get_input_paths(self))
+        input_dirs.append(os.path.join(self.target_working_copy_dir,
+                self.lib_dir))
+        return (input_files, input_dirs)
 
 
 def build_file_python_bin(repo_path, normalizer):
-    def python_bin(name, deps=(), console_script=None):
+    def python_bin(name, deps=(), console_script=None, slim=False,
+            slim_patterns=None, slim_bytecode_only=False,
+            compile_bytecode=True, compile_bytecode_on_install=False,
+            launcher='bash'):
         logging.debug('Build file target, Python bin: %s', name)
         target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
         dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
                 normalizer, deps)
         python_bin_target = PythonBinaryBuildTarget(normalizer, target_id,
-                dep_ids=dep_target_ids, console_script=console_script)
+                dep_ids=dep_target_ids, console_script=console_script,
+                slim=slim, slim_patterns=slim_patterns,
+                slim_bytecode_only=slim_bytecode_only,
+                compile_bytecode=compile_bytecode,
+                compile_bytecode_on_install=compile_bytecode_on_install,
+                launcher=launcher)
         build_file_targets.put(python_bin_target)
 
     return python_bin
@@ -459,6 +1522,32 @@ def build_file_python_test(repo_path, normalizer):
     return python_test
 
 
+def build_file_python_zipapp(repo_path, normalizer):
+    def python_zipapp(name, binary, interpreter=None):
+        logging.debug('Build file target, Python zipapp: %s', name)
+        target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
+        (binary_id,) = normal_dep_targets_from_dep_strings(repo_path,
+                normalizer, [binary])
+        python_zipapp_target = PythonZipAppBuildTarget(normalizer, target_id,
+                binary_id=binary_id, interpreter=interpreter)
+        build_file_targets.put(python_zipapp_target)
+
+    return python_zipapp
+
+
+def build_file_python_runtime(repo_path, normalizer):
+    def python_runtime(name, deps=()):
+        logging.debug('Build file target, Python runtime: %s', name)
+        target_id = digg.dev.hackbuilder.target.TargetID(repo_path, name)
+        dep_target_ids = normal_dep_targets_from_dep_strings(repo_path,
+                normalizer, deps)
+        python_runtime_target = PythonRuntimeBuildTarget(normalizer,
+                target_id, dep_ids=dep_target_ids)
+        build_file_targets.put(python_runtime_target)
+
+    return python_runtime
+
+
 def build_file_python_lib(repo_path, normalizer):
     def python_lib(name, deps=(), srcs=None, packages=None, entry_points=None,
             files=None):
@@ -494,6 +1583,8 @@ def build_file_rules_generator(repo_path, normalizer):
             'python_bin': build_file_python_bin(repo_path, normalizer),
             'python_test': build_file_python_test(repo_path, normalizer),
             'python_lib': build_file_python_lib(repo_path, normalizer),
+            'python_runtime': build_file_python_runtime(repo_path, normalizer),
+            'python_zipapp': build_file_python_zipapp(repo_path, normalizer),
             'python_third_party_lib':
             build_file_python_third_party_lib(repo_path, normalizer),
             }
@@ -0,0 +1,144 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import collections
+import os
+import subprocess
+import unittest
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.target
+from digg.dev.hackbuilder.target import TargetID
+from digg.dev.hackbuilder.plugins.generic import SystemdServiceBuildTarget
+from digg.dev.hackbuilder.plugins.generic import UpstartScriptBuildTarget
+from digg.dev.hackbuilder.plugins.generic import get_instance_script_lines
+
+
+class FakePackageBuilder(object):
+    def __init__(self):
+        self.target = collections.namedtuple('Target', 'target_id')('/pkg')
+        self.files = {}
+        self.fragments = collections.defaultdict(list)
+
+    def install_file_contents(self, dest_path, contents, mode=0644):
+        self.files[dest_path] = contents
+
+    def add_maintainer_script_fragment(self, script_name, fragment):
+        self.fragments[script_name].append(fragment)
+
+
+class ServiceTests(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = digg.dev.hackbuilder.target.Normalizer('/repo')
+
+    def _build(self, target_class, **kwargs):
+        target = target_class(self.normalizer, TargetID('/svc', 'svc'),
+                service_name='svc', binary_target_id=TargetID('/bin', 'app'),
+                **kwargs)
+        package_builder = FakePackageBuilder()
+        target.builder_class(target).do_pre_build_package_binary_install({},
+                package_builder, '/usr/bin')
+        return (target, package_builder)
+
+    def test_single_upstart_job(self):
+        (_, package_builder) = self._build(UpstartScriptBuildTarget,
+                args=['--name', 'a b', '--port={port}'], base_port=8000)
+        self.assertEqual(package_builder.files, {
+                '/etc/init/svc.conf':
+                    'description "svc"\n'
+                    '\n'
+                    'start on filesystem\n'
+                    'stop on runlevel [!2345]\n'
+                    '\n'
+                    'umask 022\n'
+                    '\n'
+                    "exec /usr/bin/app --name 'a b' --port=8000\n"})
+
+    def test_upstart_instances(self):
+        (target, package_builder) = self._build(UpstartScriptBuildTarget,
+                args=['--port={port}', 'log {instance}'], base_port=8000,
+                instances='cpus', respawn=True, respawn_limit=(10, 5))
+        self.assertEqual(sorted(package_builder.files),
+                ['/etc/init/svc-instance.conf', '/etc/init/svc.conf'])
+        self.assertTrue('INSTANCES=$(nproc)\n' in
+                package_builder.files['/etc/init/svc.conf'])
+        instance_job = package_builder.files['/etc/init/svc-instance.conf']
+        self.assertTrue('stop on stopping svc\ninstance $INSTANCE\n' in
+                instance_job)
+        self.assertTrue('respawn\nrespawn limit 10 5\n' in instance_job)
+        self.assertFalse('respawn' in
+                package_builder.files['/etc/init/svc.conf'])
+
+        script = '\n'.join(get_instance_script_lines(target, '/bin/echo'))
+        env = dict(os.environ, INSTANCE='3')
+        self.assertEqual(subprocess.check_output(['/bin/sh', '-c', script],
+                env=env), '--port=8003 log 3\n')
+
+    def test_systemd_template_with_socket(self):
+        (_, package_builder) = self._build(SystemdServiceBuildTarget,
+                args=['--port={port}'], base_port=8000, instances=4,
+                respawn=True, socket='8080')
+        self.assertEqual(package_builder.files[
+                '/lib/systemd/system/svc@.service'],
+                '[Unit]\n'
+                'Description=svc instance %i\n'
+                'Requires=svc.socket\n'
+                'After=svc.socket\n'
+                '\n'
+                '[Service]\n'
+                'Environment=INSTANCE=%i\n'
+                'Sockets=svc.socket\n'
+                'ExecStart=/bin/sh -c "PORT=$$((8000 + INSTANCE)); '
+                    'exec /usr/bin/app --port=\\"$$PORT\\""\n'
+                'Restart=always\n'
+                'UMask=0022\n'
+                '\n'
+                '[Install]\n'
+                'WantedBy=multi-user.target\n')
+        self.assertTrue('ListenStream=8080\nService=svc@0.service\n' in
+                package_builder.files['/lib/systemd/system/svc.socket'])
+        for script_name in ('postinst', 'prerm'):
+            (fragment,) = package_builder.fragments[script_name]
+            subprocess.check_call(['/bin/sh', '-n', '-c', fragment])
+        self.assertTrue('systemctl enable svc@$i.service' in
+                package_builder.fragments['postinst'][0])
+
+    def test_args_without_instances_or_base_port_are_literal(self):
+        (_, package_builder) = self._build(UpstartScriptBuildTarget,
+                args=['--format={port}/{instance}'], respawn=True)
+        self.assertTrue("respawn\n\numask 022\n\n"
+                "exec /usr/bin/app '--format={port}/{instance}'\n" in
+                package_builder.files['/etc/init/svc.conf'])
+
+        (_, package_builder) = self._build(SystemdServiceBuildTarget,
+                args=['--format={port}'])
+        self.assertTrue('ExecStart=/usr/bin/app "--format={port}"\n' in
+                package_builder.files['/lib/systemd/system/svc.service'])
+
+    def test_port_needs_base_port(self):
+        self.assertRaises(digg.dev.hackbuilder.errors.Error, self._build,
+                SystemdServiceBuildTarget, args=['--port={port}'],
+                instances=2)
+
+    def test_instances_must_be_a_number(self):
+        for instances in (0, True, '2'):
+            self.assertRaises(digg.dev.hackbuilder.errors.Error, self._build,
+                    UpstartScriptBuildTarget, instances=instances)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import os.path
+import shutil
+import tarfile
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.plugins.oci
+import digg.dev.hackbuilder.target
+from digg.dev.hackbuilder.target import TargetID
+from digg.dev.hackbuilder.plugins.oci import OciImageBuildTarget
+
+
+class OciImageTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        self.normalizer = digg.dev.hackbuilder.target.Normalizer(
+                self.repo_root)
+        self.venv_root = os.path.join(self.repo_root, 'venv')
+        self._write_file('lib/site-packages/thirdparty/__init__.py', 'tp')
+        self._write_file('lib/site-packages/firstparty/__init__.py', 'fp 1')
+        self.original_args = getattr(digg.dev.hackbuilder.plugins.oci,
+                'ARGS', None)
+        digg.dev.hackbuilder.plugins.oci.ARGS = argparse.Namespace(
+                source_date_epoch=None, oci_compression_level=6,
+                oci_compression_threads=2)
+
+    def tearDown(self):
+        digg.dev.hackbuilder.plugins.oci.ARGS = self.original_args
+        shutil.rmtree(self.repo_root)
+
+    def _write_file(self, rel_path, contents, mtime=1000000000):
+        path = os.path.join(self.venv_root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.exists(path):
+            os.remove(path)
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+
+    def _build_image(self):
+        target = OciImageBuildTarget(self.normalizer,
+                TargetID('/images', 'app'), dep_ids=set(), version='1.0',
+                entrypoint=['/usr/bin/app'], architecture='amd64')
+        builder = target.builder_class(target)
+        builder.install_tree(self.venv_root, '/usr/lib/app/venv',
+                third_party_paths=[
+                    'lib/site-packages/thirdparty/__init__.py'])
+        builder.install_file_contents('/usr/bin/app', '#!/bin/sh\n', 0755)
+        builder.do_build_package_work()
+        return target.oci_layout_dir
+
+    def _read_blob(self, layout_dir, descriptor):
+        path = os.path.join(layout_dir, 'blobs',
+                *descriptor['digest'].split(':'))
+        with open(path, 'rb') as f:
+            data = f.read()
+        self.assertEqual(len(data), descriptor['size'])
+        self.assertEqual('sha256:' + hashlib.sha256(data).hexdigest(),
+                descriptor['digest'])
+        return data
+
+    def _read_image(self, layout_dir):
+        with open(os.path.join(layout_dir, 'oci-layout')) as f:
+            self.assertEqual(json.load(f), {'imageLayoutVersion': '1.0.0'})
+        with open(os.path.join(layout_dir, 'index.json')) as f:
+            (descriptor,) = json.load(f)['manifests']
+        image_manifest = json.loads(self._read_blob(layout_dir, descriptor))
+        config = json.loads(self._read_blob(layout_dir,
+                image_manifest['config']))
+        return (image_manifest, config)
+
+    def _get_layer_names(self, layout_dir, layer, diff_id):
+        layer_path = os.path.join(layout_dir, 'blobs',
+                *layer['digest'].split(':'))
+        with gzip.open(layer_path) as f:
+            tar_data = f.read()
+        self.assertEqual('sha256:' + hashlib.sha256(tar_data).hexdigest(),
+                diff_id)
+        with tarfile.open(layer_path) as tar:
+            return [info.name for info in tar.getmembers() if info.isfile()]
+
+    def test_layers_split_and_verifiable(self):
+        layout_dir = self._build_image()
+        (image_manifest, config) = self._read_image(layout_dir)
+        self.assertEqual(config['config']['Entrypoint'], ['/usr/bin/app'])
+        self.assertEqual(config['architecture'], 'amd64')
+        self.assertEqual(
+                [self._get_layer_names(layout_dir, layer, diff_id)
+                 for layer, diff_id in zip(image_manifest['layers'],
+                     config['rootfs']['diff_ids'])],
+                [['./usr/lib/app/venv/lib/site-packages/thirdparty/'
+                  '__init__.py'],
+                 ['./usr/lib/app/venv/lib/site-packages/firstparty/'
+                  '__init__.py'],
+                 ['./usr/bin/app']])
+
+    def test_unchanged_layers_reused(self):
+        layout_dir = self._build_image()
+        (old_image_manifest, _) = self._read_image(layout_dir)
+        blob_stats = dict((layer['digest'], os.stat(os.path.join(layout_dir,
+                'blobs', *layer['digest'].split(':'))))
+                for layer in old_image_manifest['layers'])
+
+        self._write_file('lib/site-packages/firstparty/__init__.py', 'fp 2',
+                1000000001)
+        layout_dir = self._build_image()
+        (image_manifest, _) = self._read_image(layout_dir)
+        (old_third_party, old_first_party, old_launchers) = (
+                old_image_manifest['layers'])
+        (third_party, first_party, launchers) = image_manifest['layers']
+        self.assertEqual(third_party, old_third_party)
+        self.assertEqual(launchers, old_launchers)
+        self.assertNotEqual(first_party, old_first_party)
+        # Reused layers aren't written again, and unused ones are removed.
+        self.assertEqual(os.stat(os.path.join(layout_dir, 'blobs',
+                *third_party['digest'].split(':'))).st_ino,
+                blob_stats[third_party['digest']].st_ino)
+        self.assertFalse(os.path.exists(os.path.join(layout_dir, 'blobs',
+                *old_first_party['digest'].split(':'))))
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
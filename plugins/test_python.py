@@ -0,0 +1,427 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import collections
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.plugins.debian
+import digg.dev.hackbuilder.plugins.python
+import digg.dev.hackbuilder.python_wheel
+import digg.dev.hackbuilder.target
+from digg.dev.hackbuilder.target import TargetID
+from digg.dev.hackbuilder.plugin_utils import SharedRuntime
+from digg.dev.hackbuilder.plugins.debian import DebianPackageBuildTarget
+from digg.dev.hackbuilder.plugins.python import PythonBinaryBuildTarget
+from digg.dev.hackbuilder.plugins.python import PythonLibraryBuildTarget
+from digg.dev.hackbuilder.plugins.python import PythonRuntimeBuildTarget
+from digg.dev.hackbuilder.plugins.python \
+        import PythonThirdPartyLibraryBuildTarget
+from digg.dev.hackbuilder.plugins.python import get_python_launcher_text
+from digg.dev.hackbuilder.plugins.python \
+        import get_third_party_library_install_plan
+
+
+class InstallPlanTests(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = digg.dev.hackbuilder.target.Normalizer('/repo')
+        self.builders = {}
+
+    def _add_target(self, target):
+        self.builders[target.target_id] = target.builder_class(target)
+        return target
+
+    def _add_lib(self, name, deps=()):
+        return self._add_target(PythonLibraryBuildTarget(self.normalizer,
+                TargetID('/lib', name), set(TargetID.from_string(d)
+                    for d in deps), source_files=[], packages=[]))
+
+    def _add_third_party_lib(self, name, deps=()):
+        return self._add_target(PythonThirdPartyLibraryBuildTarget(
+                self.normalizer, TargetID('/third_party', name),
+                set(TargetID.from_string(d) for d in deps), lib_dir=name))
+
+    def _get_plan(self, deps):
+        plan = get_third_party_library_install_plan(self.builders,
+                set(TargetID.from_string(d) for d in deps))
+        return [[b.target.target_id.name for b in stage] for stage in plan]
+
+    def test_diamond_installs_shared_lib_once(self):
+        self._add_third_party_lib('base')
+        self._add_third_party_lib('left', deps=['/third_party:base'])
+        self._add_third_party_lib('right', deps=['/third_party:base'])
+        self._add_lib('lib', deps=['/third_party:left',
+                                   '/third_party:right'])
+        self.assertEqual(self._get_plan(['/lib:lib']),
+                [['base'], ['left', 'right']])
+
+    def test_levels_through_first_party_libs(self):
+        self._add_third_party_lib('base')
+        self._add_lib('middle', deps=['/third_party:base'])
+        self._add_third_party_lib('top', deps=['/lib:middle'])
+        self._add_third_party_lib('other')
+        self.assertEqual(self._get_plan(['/third_party:top',
+                                         '/third_party:other']),
+                [['base', 'other'], ['top']])
+
+    def test_no_third_party_libs(self):
+        self._add_lib('lib')
+        self.assertEqual(self._get_plan(['/lib:lib']), [])
+
+
+class PythonLauncherTests(unittest.TestCase):
+    def test_launcher_imports_entry_point(self):
+        launcher_text = get_python_launcher_text(
+                '/usr/lib/pkg/bin-virtualenv/bin/python',
+                'pkg.cli:Tool.main')
+        self.assertTrue(launcher_text.startswith(
+                '#!/usr/lib/pkg/bin-virtualenv/bin/python\n'))
+        self.assertTrue('from pkg.cli import Tool\n' in launcher_text)
+        self.assertTrue('sys.exit(Tool.main())' in launcher_text)
+        compile(launcher_text, 'launcher', 'exec')
+
+    def test_long_interpreter_path_rejected(self):
+        self.assertRaises(digg.dev.hackbuilder.errors.Error,
+                get_python_launcher_text,
+                '/' + 'x' * 200 + '/bin/python', 'pkg.cli:main')
+
+
+class PackageDirSourceStageTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        self.normalizer = digg.dev.hackbuilder.target.Normalizer(
+                self.repo_root)
+        self.original_args = getattr(digg.dev.hackbuilder.plugins.python,
+                'ARGS', None)
+        digg.dev.hackbuilder.plugins.python.ARGS = argparse.Namespace(
+                python_install_method='install',
+                python_source_stage='package_dir')
+        for rel_path in ('pkg/mod.py', 'pkg/extra.py', 'pkg/sub/inner.py',
+                'pkg/sub/__init__.py'):
+            full_path = os.path.join(self.repo_root, rel_path)
+            if not os.path.isdir(os.path.dirname(full_path)):
+                os.makedirs(os.path.dirname(full_path))
+            with open(full_path, 'w') as f:
+                f.write('NAME = %r\n' % (rel_path,))
+
+        lib_target = PythonLibraryBuildTarget(self.normalizer,
+                TargetID('/pkg', 'lib'), set(),
+                source_files=['mod.py', 'sub/inner.py', 'sub/__init__.py'],
+                packages=['pkg', 'pkg.sub'])
+        self.bin_target = PythonBinaryBuildTarget(self.normalizer,
+                TargetID('/pkg/app', 'app'), set([lib_target.target_id]),
+                console_script='pkg.mod:main')
+        self.builders = dict((target.target_id, target.builder_class(target))
+                for target in (lib_target, self.bin_target))
+        self.bin_builder = self.builders[self.bin_target.target_id]
+
+    def tearDown(self):
+        digg.dev.hackbuilder.plugins.python.ARGS = self.original_args
+        shutil.rmtree(self.repo_root)
+
+    def test_modules_read_from_working_copy(self):
+        package_modules = self.bin_builder.get_package_modules(self.builders)
+        self.assertEqual(package_modules, {
+                'pkg': {
+                    '__init__': os.path.join(self.bin_target.init_py_dir,
+                        'pkg', '__init__.py'),
+                    'mod': os.path.join(self.repo_root, 'pkg', 'mod.py'),
+                    },
+                'pkg.sub': {
+                    '__init__': os.path.join(self.repo_root, 'pkg', 'sub',
+                        '__init__.py'),
+                    'inner': os.path.join(self.repo_root, 'pkg', 'sub',
+                        'inner.py'),
+                    },
+                })
+
+    def test_setup_script_builds_listed_modules(self):
+        self.bin_builder.do_pre_create_source_tree_work(self.builders)
+        self.builders[TargetID('/pkg', 'lib')].do_create_source_tree_work()
+        self.assertFalse(os.path.exists(os.path.join(self.repo_root,
+                'hack-source', 'pkg', 'mod.py')))
+
+        build_lib = os.path.join(self.repo_root, 'build_lib')
+        subprocess.check_call([sys.executable, '-B',
+                self.bin_target.setup_py_path, '-q', 'build_py',
+                '--build-lib', build_lib], cwd=self.bin_target.source_root)
+        built_files = []
+        for dirpath, subdirs, filenames in os.walk(build_lib):
+            built_files.extend(os.path.relpath(os.path.join(dirpath, f),
+                build_lib) for f in filenames)
+        self.assertEqual(sorted(built_files), [
+                os.path.join('pkg', '__init__.py'),
+                os.path.join('pkg', 'mod.py'),
+                os.path.join('pkg', 'sub', '__init__.py'),
+                os.path.join('pkg', 'sub', 'inner.py'),
+                ])
+
+    def test_develop_install_method_rejected(self):
+        digg.dev.hackbuilder.plugins.python.ARGS.python_install_method = (
+                'develop')
+        self.assertRaises(digg.dev.hackbuilder.errors.Error,
+                self.bin_builder.do_pre_create_source_tree_work,
+                self.builders)
+
+
+class LinkInstallTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        normalizer = digg.dev.hackbuilder.target.Normalizer(self.repo_root)
+        self.original_args = getattr(digg.dev.hackbuilder.plugins.python,
+                'ARGS', None)
+        digg.dev.hackbuilder.plugins.python.ARGS = argparse.Namespace(
+                python_install_method='link', python_source_stage='mirror')
+
+        lib_target = PythonLibraryBuildTarget(normalizer,
+                TargetID('/pkg', 'lib'), set(), source_files=[],
+                packages=['pkg'], entry_points={
+                    'console_scripts': ['tool = pkg.tool:main']})
+        self.bin_target = PythonBinaryBuildTarget(normalizer,
+                TargetID('/pkg/app', 'app'), set([lib_target.target_id]),
+                console_script='pkg.app:main')
+        self.builders = dict((target.target_id, target.builder_class(target))
+                for target in (lib_target, self.bin_target))
+        self.site_packages_dir = os.path.join(
+                self.bin_target.virtualenv_root, 'lib', 'python2.7',
+                'site-packages')
+        os.makedirs(self.site_packages_dir)
+        os.makedirs(os.path.join(self.bin_target.virtualenv_root, 'bin'))
+
+    def tearDown(self):
+        digg.dev.hackbuilder.plugins.python.ARGS = self.original_args
+        shutil.rmtree(self.repo_root)
+
+    def test_link_install_writes_pth_and_stubs(self):
+        builder = self.builders[self.bin_target.target_id]
+        builder.do_pre_create_source_tree_work(self.builders)
+        builder.do_build_binary_work()
+
+        with open(os.path.join(self.site_packages_dir, 'hack-app.pth')) as f:
+            self.assertEqual(f.read(), self.bin_target.source_root + '\n')
+        for name, console_script in (('app', 'pkg.app:main'),
+                ('tool', 'pkg.tool:main')):
+            stub_path = os.path.join(self.bin_target.virtualenv_root, 'bin',
+                    name)
+            with open(stub_path) as f:
+                self.assertEqual(f.read(), get_python_launcher_text(
+                    self.bin_target.python_bin_path, console_script))
+            self.assertTrue(os.access(stub_path, os.X_OK))
+
+
+INTERPRETER_INFO = {
+        'version': '2.7',
+        'implementation': 'CPython',
+        'platform': 'linux-x86_64',
+        'maxunicode': 0x10ffff,
+        'prefix': '/usr',
+        }
+
+
+class RecordingPackageBuilder(object):
+    def __init__(self, target_id):
+        self.target = collections.namedtuple('Target', 'target_id')(
+                target_id)
+        self.trees = {}
+        self.files = {}
+        self.fragments = collections.defaultdict(list)
+
+    def install_tree(self, src_root, dest_path, exclude=(),
+            third_party_paths=()):
+        self.trees[dest_path] = (src_root, set(exclude))
+
+    def install_file_contents(self, dest_path, contents, mode=0644):
+        self.files[dest_path] = contents
+
+    def install_symlink(self, dest_path, link_target):
+        self.files[dest_path] = link_target
+
+    def add_maintainer_script_fragment(self, script_name, fragment):
+        self.fragments[script_name].append(fragment)
+
+
+class FakeVirtualenvTemplate(object):
+    def __init__(self, root):
+        self.root = root
+        self.key = 'template'
+
+
+class PythonRuntimeTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        self.normalizer = digg.dev.hackbuilder.target.Normalizer(
+                self.repo_root)
+        self.original_args = getattr(digg.dev.hackbuilder.plugins.python,
+                'ARGS', None)
+        digg.dev.hackbuilder.plugins.python.ARGS = argparse.Namespace(
+                python_install_method='install',
+                python_source_stage='mirror', python_install_jobs=1)
+        self.original_debian_args = getattr(
+                digg.dev.hackbuilder.plugins.debian, 'ARGS', None)
+        digg.dev.hackbuilder.plugins.debian.ARGS = argparse.Namespace(
+                source_date_epoch=None)
+        self.original_get_virtualenv_template = (
+                digg.dev.hackbuilder.plugins.python.get_virtualenv_template)
+        self.template = FakeVirtualenvTemplate(os.path.join(self.repo_root,
+                'template'))
+        digg.dev.hackbuilder.plugins.python.get_virtualenv_template = (
+                lambda normalizer, cache_dir: self.template)
+        for name in ('shared', 'own'):
+            self._write_file('third_party/%s/%s/__init__.py' % (name, name),
+                    'VERSION = 1\n')
+        self.installs = []
+        self._make_builders()
+        self.interpreter_paths = [self.bin_target.python_bin_path,
+                os.path.join(self.template.root, 'bin', 'python')]
+        for python_bin_path in self.interpreter_paths:
+            digg.dev.hackbuilder.python_wheel._interpreter_info_cache[
+                    python_bin_path] = INTERPRETER_INFO
+
+    def tearDown(self):
+        digg.dev.hackbuilder.plugins.python.ARGS = self.original_args
+        digg.dev.hackbuilder.plugins.debian.ARGS = self.original_debian_args
+        digg.dev.hackbuilder.plugins.python.get_virtualenv_template = (
+                self.original_get_virtualenv_template)
+        for python_bin_path in self.interpreter_paths:
+            del digg.dev.hackbuilder.python_wheel._interpreter_info_cache[
+                    python_bin_path]
+        shutil.rmtree(self.repo_root)
+
+    def _write_file(self, rel_path, contents):
+        full_path = os.path.join(self.repo_root, rel_path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as f:
+            f.write(contents)
+
+    def _make_builders(self):
+        targets = [PythonThirdPartyLibraryBuildTarget(self.normalizer,
+                TargetID('/third_party', name), set(), lib_dir=name)
+                for name in ('shared', 'own')]
+        self.runtime_target = PythonRuntimeBuildTarget(self.normalizer,
+                TargetID('/runtime', 'runtime'),
+                set([TargetID('/third_party', 'shared')]))
+        self.bin_target = PythonBinaryBuildTarget(self.normalizer,
+                TargetID('/app', 'app'),
+                set([TargetID('/third_party', 'shared'),
+                     TargetID('/third_party', 'own')]),
+                console_script='app:main')
+        self.runtime_package_target = DebianPackageBuildTarget(
+                self.normalizer, TargetID('/runtime', 'runtime-pkg'),
+                set([self.runtime_target.target_id]), version='1.2')
+        self.package_target = DebianPackageBuildTarget(self.normalizer,
+                TargetID('/app', 'app-pkg'), set([self.bin_target.target_id]),
+                version='3.4',
+                python_runtime_id=self.runtime_package_target.target_id)
+        targets.extend([self.runtime_target, self.bin_target,
+                self.runtime_package_target, self.package_target])
+        self.builders = dict((target.target_id, target.builder_class(target))
+                for target in targets)
+        for name in ('shared', 'own'):
+            builder = self.builders[TargetID('/third_party', name)]
+            builder.do_library_install = self._make_recording_install(name)
+
+    def _make_recording_install(self, name):
+        def do_library_install(target, virtualenv_root, python_bin_path):
+            self.installs.append((name, target.target_id.name))
+            site_packages_dir = os.path.join(virtualenv_root, 'lib',
+                    'python2.7', 'site-packages')
+            paths = [os.path.join(site_packages_dir, name, '__init__.py'),
+                     os.path.join(virtualenv_root, 'bin', name + '-tool')]
+            for path in paths:
+                if not os.path.isdir(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                with open(path, 'w') as f:
+                    f.write(name)
+            record_path = os.path.join(target.install_records_dir,
+                    '%s.txt' % (TargetID('/third_party',
+                        name).to_filename(),))
+            with open(record_path, 'w') as f:
+                f.writelines('%s\n' % (path,) for path in paths)
+        return do_library_install
+
+    def _get_runtime_builder(self):
+        return self.builders[self.runtime_target.target_id]
+
+    def test_runtime_installed_once_per_install_plan(self):
+        self._get_runtime_builder().do_pre_build_binary_library_install(
+                self.builders)
+        self.assertEqual(self.installs, [('shared', 'runtime')])
+        self._make_builders()
+        self._get_runtime_builder().do_pre_build_binary_library_install(
+                self.builders)
+        self.assertEqual(self.installs, [('shared', 'runtime')])
+
+        self._write_file('third_party/shared/shared/__init__.py',
+                'VERSION = 2\n')
+        self._make_builders()
+        self._get_runtime_builder().do_pre_build_binary_library_install(
+                self.builders)
+        self.assertEqual(self.installs,
+                [('shared', 'runtime'), ('shared', 'runtime')])
+
+    def test_runtime_package(self):
+        runtime_builder = self._get_runtime_builder()
+        runtime_builder.do_pre_build_binary_library_install(self.builders)
+        package_builder = RecordingPackageBuilder(
+                self.runtime_package_target.target_id)
+        runtime_builder.do_pre_build_package_binary_install(self.builders,
+                package_builder, lib_path='/usr/lib')
+        self.assertEqual(package_builder.trees, {
+                '/usr/lib/runtime-pkg/site-packages': (os.path.join(
+                    self.runtime_target.runtime_root, 'lib', 'python2.7',
+                    'site-packages'), set()),
+                })
+
+    def test_binary_uses_runtime(self):
+        bin_builder = self.builders[self.bin_target.target_id]
+        bin_builder.do_pre_build_binary_library_install(self.builders)
+        package_builder = RecordingPackageBuilder(
+                self.package_target.target_id)
+        shared_runtimes = self.builders[
+                self.package_target.target_id]._get_shared_runtimes(
+                    self.builders, '/usr/lib')
+        self.assertEqual(shared_runtimes, [SharedRuntime(
+                self._get_runtime_builder(), '/usr/lib/runtime-pkg')])
+        self.assertTrue('runtime-pkg (= 1.2)' in
+                self.builders[self.package_target.target_id].dpkg_deps)
+
+        bin_builder.do_pre_build_package_binary_install(self.builders,
+                package_builder, '/usr/bin', '/usr/lib',
+                shared_runtimes=shared_runtimes)
+        virtualenv_dest_path = '/usr/lib/app-pkg/app-virtualenv'
+        (_, exclude) = package_builder.trees[virtualenv_dest_path]
+        # Only the runtime's site-packages files are left out.
+        self.assertEqual(exclude,
+                set(['lib/python2.7/site-packages/shared/__init__.py']))
+        self.assertEqual(package_builder.files[os.path.join(
+                virtualenv_dest_path, 'lib/python2.7/site-packages',
+                'hack-runtime-runtime-pkg.pth')],
+                "import site; "
+                "site.addsitedir('/usr/lib/runtime-pkg/site-packages')\n")
+        self.assertTrue('/usr/bin/app' in package_builder.files)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
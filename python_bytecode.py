@@ -0,0 +1,199 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import json
+import logging
+import multiprocessing
+import os
+import os.path
+import subprocess
+
+import digg.dev.hackbuilder.errors
+
+# The script that compiles modules with the interpreter of a virtualenv. It
+# runs under both Python 2 and 3 and reads a JSON object from stdin with the
+# list of [source path, display path] pairs to compile and the options to
+# compile them with.
+#
+# Existing bytecode files are removed rather than overwritten, since they may
+# be hard links shared with a virtualenv template or a package hierarchy.
+COMPILE_SCRIPT = r'''
+import functools
+import json
+import multiprocessing
+import os
+import py_compile
+import struct
+import sys
+
+try:
+    import importlib.util
+    CACHE_FROM_SOURCE = importlib.util.cache_from_source
+    MAGIC_NUMBER = importlib.util.MAGIC_NUMBER
+except (ImportError, AttributeError):
+    import imp
+    CACHE_FROM_SOURCE = None
+    MAGIC_NUMBER = imp.get_magic()
+
+try:
+    INVALIDATION_MODES = {
+        True: py_compile.PycInvalidationMode.CHECKED_HASH,
+        False: py_compile.PycInvalidationMode.UNCHECKED_HASH,
+        }
+except AttributeError:
+    INVALIDATION_MODES = None
+
+
+def get_bytecode_path(path, legacy_layout):
+    if CACHE_FROM_SOURCE is not None and not legacy_layout:
+        return CACHE_FROM_SOURCE(path)
+    return path + 'c'
+
+
+def is_up_to_date(path, bytecode_path):
+    if INVALIDATION_MODES is not None:
+        return False
+    try:
+        with open(bytecode_path, 'rb') as f:
+            header = f.read(8)
+    except IOError:
+        return False
+    mtime = int(os.stat(path).st_mtime) & 0xffffffff
+    return header == MAGIC_NUMBER + struct.pack('<I', mtime)
+
+
+def compile_module(options, paths):
+    (path, display_path) = paths
+    bytecode_path = get_bytecode_path(path, options['legacy_layout'])
+    if is_up_to_date(path, bytecode_path):
+        return 0
+    if os.path.lexists(bytecode_path):
+        os.remove(bytecode_path)
+    kwargs = {}
+    if INVALIDATION_MODES is not None:
+        kwargs['invalidation_mode'] = (
+            INVALIDATION_MODES[options['check_source']])
+    try:
+        py_compile.compile(path, bytecode_path, display_path, True, **kwargs)
+    except py_compile.PyCompileError as e:
+        sys.stderr.write('%s\n' % (e.msg,))
+        return 0
+    return 1
+
+
+if __name__ == '__main__':
+    request = json.load(sys.stdin)
+    pool = multiprocessing.Pool(int(sys.argv[1]))
+    try:
+        compiled_count = sum(pool.map(
+            functools.partial(compile_module, request['options']),
+            request['modules'], 64))
+    finally:
+        pool.close()
+        pool.join()
+    sys.stdout.write('%d\n' % (compiled_count,))
+'''
+
+# Directories that only hold bytecode.
+EXCLUDED_DIRECTORY_NAMES = frozenset(['__pycache__'])
+
+
+def find_modules(root):
+    """Find the python modules in a directory tree.
+
+    Symlinked modules are left out, since their bytecode would be written
+    next to the symlink rather than the module.
+
+    Returns: A sorted list of module paths relative to root.
+    """
+    modules = []
+    for dirpath, subdirs, filenames in os.walk(root):
+        subdirs[:] = [subdir for subdir in subdirs
+                      if subdir not in EXCLUDED_DIRECTORY_NAMES]
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if filename.endswith('.py') and not os.path.islink(full_path):
+                modules.append(os.path.relpath(full_path, root))
+    return sorted(modules)
+
+
+def compile_tree(python_bin_path, root, script_path, display_root=None,
+        jobs=None, legacy_layout=False, check_source=True):
+    """Compile the python modules in a directory tree ahead of time.
+
+    The modules are compiled by the given interpreter, on a pool of
+    processes. Interpreters that support it (Python 3.7+) write
+    deterministic, hash based bytecode. Bytecode that is already up to date
+    is left alone.
+
+    Modules that fail to compile, such as Python 3 only modules in a
+    Python 2 virtualenv, are skipped, like "python -m compileall" does.
+
+    Args:
+        python_bin_path: The interpreter to compile with
+        root: The root of the tree to compile
+        script_path: Where to write the compile script
+        display_root: The path of root that tracebacks show. This defaults
+            to a path relative to the directory the interpreter runs in.
+        jobs: The number of processes to compile with. This defaults to the
+            number of CPUs.
+        legacy_layout: Whether to write bytecode next to its module, where
+            zipimport looks for it, rather than into __pycache__
+        check_source: Whether hash based bytecode is checked against its
+            module when imported. Bytecode of modules that can't change,
+            like those in a zip file, doesn't need to be.
+
+    Returns: The number of modules compiled.
+    """
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    if display_root is None:
+        display_root = ''
+
+    modules = [(os.path.join(root, rel_path),
+                os.path.join(display_root, rel_path))
+               for rel_path in find_modules(root)]
+    if not modules:
+        return 0
+
+    with open(script_path, 'w') as f:
+        f.write(COMPILE_SCRIPT)
+
+    compile_proc = subprocess.Popen(
+            (python_bin_path, script_path, str(jobs)),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    request = {
+            'modules': modules,
+            'options': {
+                'check_source': check_source,
+                'legacy_layout': legacy_layout,
+                },
+            }
+    (stdoutdata, stderrdata) = compile_proc.communicate(json.dumps(request))
+    retcode = compile_proc.returncode
+    if retcode != 0:
+        logging.info('Compiling bytecode failed with exit code = %s',
+                retcode)
+        logging.info('Compile stdout:\n%s', stdoutdata)
+        logging.info('Compile stderr:\n%s', stderrdata)
+        raise digg.dev.hackbuilder.errors.Error(
+                'Compiling bytecode in %s failed.' % (root,))
+    if stderrdata:
+        logging.debug('Modules that failed to compile:\n%s', stderrdata)
+
+    compiled_count = int(stdoutdata.strip())
+    logging.info('Compiled %d of %d modules in %s', compiled_count,
+            len(modules), root)
+    return compiled_count
@@ -0,0 +1,573 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import distutils.spawn
+import errno
+import filecmp
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import stat
+import subprocess
+import tempfile
+
+import digg.dev.hackbuilder.archive
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+# Bump this when a change to how templates are made makes cached templates
+# stale.
+TEMPLATE_VERSION = 1
+
+TEMPLATE_METADATA_FILENAME = '.hack_template.json'
+
+# Files that later build steps rewrite in place. They are always copied into
+# a clone, never hard linked, so that the template is never modified.
+MUTABLE_FILE_PATTERNS = (
+        'bin/*',
+        '*.pth',
+        )
+
+# Interpreter executables in bin/ are never modified, so they can be linked.
+IMMUTABLE_FILE_PATTERNS = (
+        'bin/python',
+        'bin/python[0-9]*',
+        )
+
+# Files that legitimately differ between virtualenvs built from the same
+# libraries, because they contain the path they were built at. When merging
+# virtualenvs, the first virtualenv's copy is used.
+MERGE_FIRST_WINS_PATTERNS = (
+        'bin/activate*',
+        '*.pyc',
+        '*.pyo',
+        )
+
+# Files of a virtualenv that binaries don't need at runtime: installer
+# tooling, tests and documentation. pkg_resources stays, since console
+# scripts load their entry points with it. Older virtualenvs install
+# setuptools or distribute as an egg with pkg_resources inside, so only
+# their metadata and a flat setuptools package are left out, never an egg.
+SLIM_EXCLUDE_PATTERNS = (
+        'bin/easy_install',
+        'bin/easy_install-[0-9]*',
+        'bin/pip',
+        'bin/pip-[0-9]*',
+        'lib/python*/site-packages/distribute-*.dist-info',
+        'lib/python*/site-packages/distribute-*.egg-info',
+        'lib/python*/site-packages/easy_install.py*',
+        'lib/python*/site-packages/pip',
+        'lib/python*/site-packages/pip-*',
+        'lib/python*/site-packages/setuptools',
+        'lib/python*/site-packages/setuptools-*.dist-info',
+        'lib/python*/site-packages/setuptools-*.egg-info',
+        'lib/python*/site-packages/*/test',
+        'lib/python*/site-packages/*/tests',
+        'share/doc',
+        'share/man',
+        )
+
+# The line that relocatable scripts run to activate the virtualenv they are
+# in. This is the same line that virtualenv --relocatable uses.
+RELOCATABLE_ACTIVATE_LINE = (
+        "import os; activate_this=os.path.join(os.path.dirname("
+        "os.path.realpath(__file__)), 'activate_this.py'); "
+        "execfile(activate_this, dict(__file__=activate_this)); "
+        "del os, activate_this")
+
+
+class VirtualenvTemplate(object):
+    """A virtualenv that new virtualenvs are cloned from.
+
+    Attributes:
+        root: The filesystem path of the template virtualenv
+        key: The cache key of the template
+        original_root: The path the template virtualenv was created at. This
+            is the path that is baked into the files of the template.
+        fixup_paths: The paths, relative to root, of the files that contain
+            original_root and need to be rewritten in a clone
+    """
+    def __init__(self, root, key, original_root, fixup_paths):
+        self.root = root
+        self.key = key
+        self.original_root = original_root
+        self.fixup_paths = fixup_paths
+
+    @classmethod
+    def load(cls, root):
+        """Load a template from its cache directory.
+
+        Returns: The template or None if there is no template there.
+        """
+        metadata_path = os.path.join(root, TEMPLATE_METADATA_FILENAME)
+        try:
+            with open(metadata_path) as f:
+                metadata = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+
+        return cls(root, str(metadata['key']),
+                str(metadata['original_root']),
+                [str(path) for path in metadata['fixup_paths']])
+
+    def save(self, root):
+        """Save the metadata of the template into a directory."""
+        metadata_path = os.path.join(root, TEMPLATE_METADATA_FILENAME)
+        with open(metadata_path, 'w') as f:
+            json.dump({
+                    'key': self.key,
+                    'original_root': self.original_root,
+                    'fixup_paths': self.fixup_paths,
+                    }, f, sort_keys=True, indent=4)
+
+
+def get_template(python, virtualenv_tool_path, cache_dir,
+        virtualenv_args=()):
+    """Get a template virtualenv for an interpreter, creating it if needed.
+
+    Templates are cached per interpreter and virtualenv tool, so the
+    virtualenv tool only runs once for all the binaries using the same
+    interpreter.
+
+    Args:
+        python: The name or path of the python interpreter
+        virtualenv_tool_path: The path of the virtualenv.py script
+        cache_dir: The directory in which templates are cached
+        virtualenv_args: Extra arguments for the virtualenv tool
+
+    Returns: A VirtualenvTemplate.
+
+    Raises:
+        digg.dev.hackbuilder.errors.Error: if the template can't be created
+    """
+    key = _get_template_key(python, virtualenv_tool_path, virtualenv_args)
+    template_root = os.path.join(cache_dir, key)
+    template = VirtualenvTemplate.load(template_root)
+    if template is not None:
+        logging.info('Using cached virtualenv template: %s', template_root)
+        return template
+
+    logging.info('Creating virtualenv template: %s', template_root)
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(cache_dir)
+    creation_root = tempfile.mkdtemp(prefix=key + '.tmp-', dir=cache_dir)
+    try:
+        _run_virtualenv_tool(python, virtualenv_tool_path,
+                list(virtualenv_args) + [creation_root])
+        fixup_paths = _find_files_containing(creation_root, creation_root)
+        template = VirtualenvTemplate(template_root, key, creation_root,
+                fixup_paths)
+        # The metadata is saved first, so the template is complete as soon
+        # as it shows up under its final name.
+        template.save(creation_root)
+        try:
+            os.rename(creation_root, template_root)
+        except OSError, e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+            # Another build made the same template at the same time.
+            return VirtualenvTemplate.load(template_root)
+        return template
+    finally:
+        shutil.rmtree(creation_root, ignore_errors=True)
+
+
+def _get_template_key(python, virtualenv_tool_path, virtualenv_args):
+    python_path = distutils.spawn.find_executable(python)
+    if python_path is None:
+        raise digg.dev.hackbuilder.errors.Error(
+                'Python interpreter (%s) not found.' % (python,))
+    python_path = os.path.realpath(python_path)
+    python_stat = os.stat(python_path)
+    tool_stat = os.stat(virtualenv_tool_path)
+    key_data = json.dumps([
+            TEMPLATE_VERSION,
+            python_path, python_stat.st_size, python_stat.st_mtime,
+            virtualenv_tool_path, tool_stat.st_size, tool_stat.st_mtime,
+            list(virtualenv_args),
+            ])
+    return hashlib.sha1(key_data).hexdigest()
+
+
+def _run_virtualenv_tool(python, virtualenv_tool_path, args):
+    logging.debug('Absolute path for virtualenv tool: %s',
+            virtualenv_tool_path)
+    virtualenv_proc = subprocess.Popen(
+                [python, '-B', virtualenv_tool_path] + args,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+    (stdoutdata, stderrdata) = virtualenv_proc.communicate()
+    retcode = virtualenv_proc.returncode
+    if retcode != 0:
+        logging.info('Virtualenv creation failed with exit code = %s',
+                retcode)
+        logging.info('Virtualenv creation stdout:\n%s', stdoutdata)
+        logging.info('Virtualenv creation stderr:\n%s', stderrdata)
+        raise digg.dev.hackbuilder.errors.Error(
+                'Virtualenv creation failed.')
+
+
+def _find_files_containing(root, text):
+    found_paths = []
+    for dirpath, subdirs, filenames in os.walk(root):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            if os.path.islink(full_path):
+                continue
+            with open(full_path, 'rb') as f:
+                if text in f.read():
+                    found_paths.append(os.path.relpath(full_path, root))
+    return sorted(found_paths)
+
+
+def clone_template(template, dest_root):
+    """Create a virtualenv by cloning a template.
+
+    Files that are never modified are hard linked (or reflinked or copied,
+    when linking is not possible). Files that mention the path of the
+    template are rewritten to mention dest_root instead.
+
+    Args:
+        template: The VirtualenvTemplate to clone
+        dest_root: The path of the new virtualenv. It must not exist yet.
+    """
+    logging.info('Cloning virtualenv template %s to %s', template.root,
+            dest_root)
+    fixup_paths = frozenset(template.fixup_paths)
+    os.makedirs(dest_root)
+    for dirpath, subdirs, filenames in os.walk(template.root):
+        rel_dir = os.path.relpath(dirpath, template.root)
+        dest_dir = os.path.normpath(os.path.join(dest_root, rel_dir))
+        for name in subdirs + filenames:
+            src_path = os.path.join(dirpath, name)
+            dest_path = os.path.join(dest_dir, name)
+            rel_path = os.path.normpath(os.path.join(rel_dir, name))
+            if rel_path == TEMPLATE_METADATA_FILENAME:
+                continue
+            elif os.path.islink(src_path):
+                link_target = os.readlink(src_path)
+                if link_target.startswith(template.original_root):
+                    link_target = (dest_root +
+                            link_target[len(template.original_root):])
+                os.symlink(link_target, dest_path)
+            elif os.path.isdir(src_path):
+                os.mkdir(dest_path)
+            elif rel_path in fixup_paths:
+                with open(src_path, 'rb') as f:
+                    data = f.read()
+                with open(dest_path, 'wb') as f:
+                    f.write(data.replace(template.original_root, dest_root))
+                shutil.copymode(src_path, dest_path)
+            elif _is_mutable_file(rel_path):
+                digg.dev.hackbuilder.util.copy_file(src_path, dest_path)
+            else:
+                digg.dev.hackbuilder.util.link_or_copy_file(src_path,
+                        dest_path)
+
+
+def _is_mutable_file(rel_path):
+    for pattern in IMMUTABLE_FILE_PATTERNS:
+        if fnmatch.fnmatch(rel_path, pattern):
+            return False
+    for pattern in MUTABLE_FILE_PATTERNS:
+        if fnmatch.fnmatch(rel_path, pattern):
+            return True
+    return False
+
+
+def make_relocatable(virtualenv_root, python_version, state_path):
+    """Make a virtualenv relocatable.
+
+    This does the same as virtualenv --relocatable without starting an
+    interpreter. Scripts in bin/ that use the absolute path of the
+    virtualenv's interpreter get a /usr/bin/env shebang and activate the
+    virtualenv relative to their own location. Absolute paths into the
+    virtualenv in .pth and .egg-link files are made relative.
+
+    Files are only rewritten when they need to be. The identity of every
+    file that has been looked at is recorded in state_path, so unchanged
+    files are not even read again on later calls.
+
+    Args:
+        virtualenv_root: The root directory of the virtualenv
+        python_version: The major.minor version string of the interpreter
+        state_path: The path of the file recording what has been relocated
+    """
+    try:
+        with open(state_path) as f:
+            previous_state = json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        previous_state = {}
+
+    virtualenv_root = os.path.normcase(os.path.abspath(virtualenv_root))
+    old_shebang = '#!%s/bin/python' % (virtualenv_root,)
+    new_shebang = '#!/usr/bin/env python%s' % (python_version,)
+    site_packages_dir = os.path.join(virtualenv_root, 'lib',
+            'python' + python_version, 'site-packages')
+
+    candidates = []
+    bin_dir = os.path.join(virtualenv_root, 'bin')
+    for filename in os.listdir(bin_dir):
+        candidates.append((os.path.join(bin_dir, filename),
+                           _relocate_script))
+    if os.path.isdir(site_packages_dir):
+        for filename in os.listdir(site_packages_dir):
+            if filename.endswith(('.pth', '.egg-link')):
+                candidates.append((os.path.join(site_packages_dir, filename),
+                                   _relocate_path_file))
+
+    state = {}
+    relocated_count = 0
+    for (path, relocate) in sorted(candidates):
+        try:
+            file_stat = os.lstat(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            continue
+        if not stat.S_ISREG(file_stat.st_mode):
+            continue
+
+        rel_path = os.path.relpath(path, virtualenv_root)
+        file_id = _get_file_id(file_stat)
+        if previous_state.get(rel_path) == file_id:
+            state[rel_path] = file_id
+            continue
+
+        with open(path, 'rb') as f:
+            data = f.read()
+        new_data = relocate(path, data, virtualenv_root, old_shebang,
+                new_shebang)
+        if new_data is not None and new_data != data:
+            logging.debug('Making %s relocatable', path)
+            _replace_file_contents(path, new_data)
+            relocated_count += 1
+            file_stat = os.lstat(path)
+        state[rel_path] = _get_file_id(file_stat)
+
+    logging.info('Made %d files relocatable in %s', relocated_count,
+            virtualenv_root)
+    if state != previous_state:
+        temp_path = '%s.%d' % (state_path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump(state, f, sort_keys=True, indent=4)
+        os.rename(temp_path, state_path)
+
+
+def _get_file_id(file_stat):
+    return [file_stat.st_ino, file_stat.st_size, file_stat.st_mtime]
+
+
+def _relocate_script(path, data, virtualenv_root, old_shebang, new_shebang):
+    if '\0' in data:
+        # This is a binary, not a script.
+        return None
+
+    lines = data.split('\n')
+    if not lines[0].strip().startswith(old_shebang):
+        return None
+
+    # The activation line has to come after any __future__ imports.
+    activate_at = 1
+    for index in range(len(lines) - 1, 0, -1):
+        if lines[index].split()[:3] == ['from', '__future__', 'import']:
+            activate_at = index + 1
+            break
+    lines = ([new_shebang] + lines[1:activate_at] +
+             ['', RELOCATABLE_ACTIVATE_LINE, ''] + lines[activate_at:])
+    return '\n'.join(lines)
+
+
+def _relocate_path_file(path, data, virtualenv_root, old_shebang,
+        new_shebang):
+    dirname = os.path.dirname(path)
+    new_lines = []
+    for line in data.splitlines():
+        stripped_line = line.strip()
+        if (stripped_line.startswith(virtualenv_root) and
+                os.path.isabs(stripped_line)):
+            line = os.path.relpath(stripped_line, dirname)
+        new_lines.append(line)
+    return '\n'.join(new_lines) + '\n'
+
+
+def _replace_file_contents(path, data):
+    # The file is replaced instead of written in place, since it may be hard
+    # linked into other trees.
+    temp_path = '%s.hack-tmp' % (path,)
+    with open(temp_path, 'wb') as f:
+        f.write(data)
+    shutil.copymode(path, temp_path)
+    os.rename(temp_path, path)
+
+
+def merge_virtualenvs(sources, dest_root):
+    """Merge several virtualenvs into one.
+
+    The merged virtualenv is made of hard links to the files of the sources,
+    so merging costs next to no I/O. Files that are the same in several
+    sources are merged, and so are the lines of .pth files. Any other file
+    that differs between sources means their libraries conflict.
+
+    Args:
+        sources: A list of (virtualenv root, exclude) tuples, where exclude
+            lists paths relative to the virtualenv root to leave out
+        dest_root: The path to create the merged virtualenv at. Anything
+            already there is removed.
+
+    Raises:
+        digg.dev.hackbuilder.errors.Error: Two sources have different
+            versions of a file.
+    """
+    logging.info('Merging virtualenvs %s into %s',
+            ', '.join(root for root, _ in sources), dest_root)
+
+    # rel_path -> (kind, source root, symlink target or None)
+    entries = {}
+    pth_lines = {}
+    for root, exclude in sources:
+        for rel_path, file_stat in digg.dev.hackbuilder.archive.scan_tree(
+                root, exclude):
+            full_path = os.path.join(root, rel_path)
+            if stat.S_ISDIR(file_stat.st_mode):
+                entry = ('d', root, None)
+            elif stat.S_ISLNK(file_stat.st_mode):
+                entry = ('l', root, _get_relative_symlink_target(root,
+                    rel_path, os.readlink(full_path)))
+            else:
+                entry = ('f', root, None)
+
+            existing_entry = entries.get(rel_path)
+            if existing_entry is None:
+                entries[rel_path] = entry
+                if rel_path.endswith('.pth') and entry[0] == 'f':
+                    pth_lines[rel_path] = _read_lines(full_path)
+            elif not _merge_entry(rel_path, existing_entry, entry,
+                    pth_lines):
+                raise digg.dev.hackbuilder.errors.Error(
+                        'Virtualenvs %s and %s have conflicting versions of '
+                        '%s' % (existing_entry[1], root, rel_path))
+
+    if os.path.lexists(dest_root):
+        shutil.rmtree(dest_root)
+    os.makedirs(dest_root)
+    for rel_path in sorted(entries):
+        (kind, root, link_target) = entries[rel_path]
+        dest_path = os.path.join(dest_root, rel_path)
+        if kind == 'd':
+            os.mkdir(dest_path)
+        elif kind == 'l':
+            os.symlink(link_target, dest_path)
+        elif rel_path in pth_lines:
+            with open(dest_path, 'w') as f:
+                f.writelines(line + '\n' for line in pth_lines[rel_path])
+        else:
+            digg.dev.hackbuilder.util.link_or_copy_file(
+                    os.path.join(root, rel_path), dest_path)
+
+
+def _merge_entry(rel_path, existing_entry, entry, pth_lines):
+    if existing_entry[0] != entry[0]:
+        return False
+    if entry[0] == 'd':
+        return True
+    if entry[0] == 'l':
+        return existing_entry[2] == entry[2]
+
+    if rel_path in pth_lines:
+        lines = pth_lines[rel_path]
+        lines.extend(line
+                for line in _read_lines(os.path.join(entry[1], rel_path))
+                if line not in lines)
+        return True
+    if any(fnmatch.fnmatch(rel_path, pattern)
+           for pattern in MERGE_FIRST_WINS_PATTERNS):
+        return True
+    existing_path = os.path.join(existing_entry[1], rel_path)
+    path = os.path.join(entry[1], rel_path)
+    return (os.path.samefile(existing_path, path) or
+            filecmp.cmp(existing_path, path, shallow=False))
+
+
+def _get_relative_symlink_target(root, rel_path, link_target):
+    # Symlinks into the virtualenv itself are absolute, which would make them
+    # differ between virtualenvs.
+    if os.path.isabs(link_target) and (
+            link_target + os.path.sep).startswith(root + os.path.sep):
+        return os.path.relpath(link_target,
+                os.path.dirname(os.path.join(root, rel_path)))
+    return link_target
+
+
+def _read_lines(path):
+    with open(path) as f:
+        return f.read().splitlines()
+
+
+def find_slim_files(virtualenv_root, patterns, bytecode_only=False):
+    """Find the files a slim virtualenv leaves out.
+
+    Args:
+        virtualenv_root: The root of the virtualenv
+        patterns: fnmatch patterns of paths relative to virtualenv_root. A
+            matching directory is left out with everything in it.
+        bytecode_only: Whether to also leave out the sources of modules in
+            site-packages that have been compiled to bytecode
+
+    Returns: A set of paths relative to virtualenv_root.
+    """
+    slim_files = set()
+    for dirpath, subdirs, filenames in os.walk(virtualenv_root):
+        rel_dir = os.path.relpath(dirpath, virtualenv_root)
+        if rel_dir == '.':
+            rel_dir = ''
+        for subdir in list(subdirs):
+            rel_path = os.path.join(rel_dir, subdir)
+            if _matches_any(rel_path, patterns):
+                subdirs.remove(subdir)
+                slim_files.add(rel_path)
+                if not os.path.islink(os.path.join(dirpath, subdir)):
+                    slim_files.update(_list_tree(virtualenv_root, rel_path))
+
+        in_site_packages = fnmatch.fnmatch(rel_dir,
+                'lib/python*/site-packages*')
+        for filename in filenames:
+            rel_path = os.path.join(rel_dir, filename)
+            if _matches_any(rel_path, patterns):
+                slim_files.add(rel_path)
+            elif (bytecode_only and in_site_packages and
+                    filename.endswith('.py') and
+                    filename + 'c' in filenames):
+                slim_files.add(rel_path)
+    return slim_files
+
+
+def _matches_any(rel_path, patterns):
+    return any(fnmatch.fnmatch(rel_path, pattern) for pattern in patterns)
+
+
+def _list_tree(root, rel_dir):
+    rel_paths = []
+    for dirpath, subdirs, filenames in os.walk(os.path.join(root, rel_dir)):
+        for name in subdirs + filenames:
+            rel_paths.append(os.path.relpath(os.path.join(dirpath, name),
+                root))
+    return rel_paths
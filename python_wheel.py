@@ -0,0 +1,393 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import base64
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+# Runs a setup.py with setuptools imported first. This makes the setuptools
+# only install options available even for libraries whose setup.py only uses
+# distutils.
+SETUPTOOLS_SHIM = (
+        "import setuptools, tokenize; __file__='setup.py'; "
+        "exec(compile(getattr(tokenize, 'open', open)(__file__).read()"
+        ".replace('\\r\\n', '\\n'), __file__, 'exec'))")
+
+# Prints the details of an interpreter that decide whether a wheel built with
+# it can be installed for another interpreter.
+INTERPRETER_INFO_SCRIPT = (
+        'import distutils.util, json, os, platform, sys; '
+        'print(json.dumps({'
+        "'version': '%d.%d' % sys.version_info[:2], "
+        "'implementation': platform.python_implementation(), "
+        "'platform': distutils.util.get_platform(), "
+        "'maxunicode': sys.maxunicode, "
+        "'prefix': os.path.realpath(getattr(sys, 'real_prefix', sys.prefix)), "
+        '}))')
+
+WHEEL_INSTALL_SCHEMES = ('lib', 'scripts', 'data', 'headers')
+
+NATIVE_EXTENSION_SUFFIXES = ('.so', '.pyd', '.dylib')
+
+# Timestamp used for all wheel members so that a wheel only depends on the
+# contents of the files in it.
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+_interpreter_info_cache = {}
+
+
+def get_interpreter_info(python_path, toolchain_probes=None):
+    """Get the details of a python interpreter that matter for wheels.
+
+    The results are cached for the life of the process.
+
+    Args:
+        python_path: The filesystem path of the python interpreter
+        toolchain_probes: A digg.dev.hackbuilder.toolchain.ToolchainProbes
+            to keep the details in across processes, or None to probe the
+            interpreter once per process
+
+    Returns: A dict with the version, implementation, platform, maxunicode
+        and prefix of the interpreter. For a virtualenv interpreter, the
+        prefix is the one of the interpreter the virtualenv was made from.
+
+    Raises:
+        digg.dev.hackbuilder.errors.Error: if the interpreter can't be run
+    """
+    if python_path in _interpreter_info_cache:
+        return _interpreter_info_cache[python_path]
+
+    if toolchain_probes is not None:
+        stdoutdata = toolchain_probes.probe(python_path,
+                ['-B', '-c', INTERPRETER_INFO_SCRIPT])
+    else:
+        logging.info('Probing python interpreter: %s', python_path)
+        proc = subprocess.Popen(
+                (python_path, '-B', '-c', INTERPRETER_INFO_SCRIPT),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+        (stdoutdata, stderrdata) = proc.communicate()
+        retcode = proc.returncode
+        if retcode != 0:
+            logging.info('Interpreter probe failed with exit code = %s',
+                    retcode)
+            logging.info('Interpreter probe stdout:\n%s', stdoutdata)
+            logging.info('Interpreter probe stderr:\n%s', stderrdata)
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Probing python interpreter (%s) failed.' %
+                    (python_path,))
+
+    interpreter_info = dict(
+            (str(key), str(value) if isinstance(value, unicode) else value)
+            for (key, value) in json.loads(stdoutdata).iteritems())
+    logging.debug('Interpreter info for %s: %s', python_path,
+            interpreter_info)
+    _interpreter_info_cache[python_path] = interpreter_info
+    return interpreter_info
+
+
+def find_wheel(wheel_dir):
+    """Find a previously built wheel.
+
+    Args:
+        wheel_dir: The directory the wheel was built into
+
+    Returns: The path of the wheel or None if there is no wheel.
+    """
+    try:
+        filenames = os.listdir(wheel_dir)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    for filename in filenames:
+        if filename.endswith('.whl'):
+            return os.path.join(wheel_dir, filename)
+    return None
+
+
+def build_wheel(python_path, setup_py_dir, wheel_dir, interpreter_info):
+    """Build a wheel of a library.
+
+    The library is installed by setuptools into a scratch directory, and the
+    result is packed up as a wheel.
+
+    Args:
+        python_path: The path of a python interpreter that has setuptools
+        setup_py_dir: The directory containing the setup.py of the library
+        wheel_dir: The directory in which to put the wheel
+        interpreter_info: The interpreter details from get_interpreter_info
+
+    Returns: The path of the built wheel.
+
+    Raises:
+        digg.dev.hackbuilder.errors.Error: if the library fails to build
+    """
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(wheel_dir)
+    scratch_dir = tempfile.mkdtemp(prefix='build-', dir=wheel_dir)
+    try:
+        install_dirs = dict((scheme, os.path.join(scratch_dir, scheme))
+                            for scheme in WHEEL_INSTALL_SCHEMES)
+        proc = subprocess.Popen(
+                (python_path, '-B', '-c', SETUPTOOLS_SHIM,
+                 'build', '--build-base', os.path.join(scratch_dir, 'build'),
+                 'install', '--single-version-externally-managed',
+                 '--record', os.path.join(scratch_dir, 'record.txt'),
+                 '--install-lib', install_dirs['lib'],
+                 '--install-scripts', install_dirs['scripts'],
+                 '--install-data', install_dirs['data'],
+                 '--install-headers', install_dirs['headers']),
+                cwd=setup_py_dir,
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+        (stdoutdata, stderrdata) = proc.communicate()
+        retcode = proc.returncode
+        if retcode != 0:
+            logging.info('Wheel build failed with exit code = %s', retcode)
+            logging.info('Wheel build stdout:\n%s', stdoutdata)
+            logging.info('Wheel build stderr:\n%s', stderrdata)
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Building wheel in %s failed.' % (setup_py_dir,))
+
+        return _pack_wheel(install_dirs, wheel_dir, interpreter_info)
+    finally:
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+
+
+def _pack_wheel(install_dirs, wheel_dir, interpreter_info):
+    name, version, egg_info_path = _get_distribution_from_install(
+            install_dirs['lib'])
+    wheel_name = '%s-%s' % (_escape_wheel_name(name),
+                            _escape_wheel_name(version))
+    dist_info_dir = wheel_name + '.dist-info'
+    data_dir = wheel_name + '.data'
+
+    members = []
+    for scheme in WHEEL_INSTALL_SCHEMES:
+        if scheme == 'lib':
+            archive_prefix = ''
+        else:
+            archive_prefix = '%s/%s/' % (data_dir, scheme)
+        for full_path, rel_path in _walk_files(install_dirs[scheme]):
+            members.append((archive_prefix + rel_path, full_path, scheme))
+    members.sort()
+
+    is_purelib = not any(archive_path.endswith(NATIVE_EXTENSION_SUFFIXES)
+                         for (archive_path, _, _) in members)
+    tag = _get_wheel_tag(interpreter_info, is_purelib)
+
+    wheel_filename = '%s-%s.whl' % (wheel_name, tag)
+    (fd, temp_path) = tempfile.mkstemp(prefix='wheel-', dir=wheel_dir)
+    os.close(fd)
+    records = []
+    with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as wheel_zip:
+        for (archive_path, full_path, scheme) in members:
+            with open(full_path, 'rb') as f:
+                data = f.read()
+            if scheme == 'scripts':
+                data = _make_script_shebang_generic(data)
+            mode = os.stat(full_path).st_mode
+            _write_zip_member(wheel_zip, archive_path, data, mode, records)
+
+        metadata_files = [
+                ('METADATA', _read_pkg_info(egg_info_path)),
+                ('WHEEL', 'Wheel-Version: 1.0\n'
+                          'Generator: hackbuilder\n'
+                          'Root-Is-Purelib: %s\n'
+                          'Tag: %s\n' % (str(is_purelib).lower(), tag)),
+                ]
+        for extra_filename in ('entry_points.txt', 'top_level.txt'):
+            extra_path = os.path.join(egg_info_path, extra_filename)
+            if os.path.isfile(extra_path):
+                with open(extra_path, 'rb') as f:
+                    metadata_files.append((extra_filename, f.read()))
+        for (filename, data) in metadata_files:
+            _write_zip_member(wheel_zip, '%s/%s' % (dist_info_dir, filename),
+                    data, 0644, records)
+
+        record_path = '%s/RECORD' % (dist_info_dir,)
+        records.append('%s,,' % (record_path,))
+        _write_zip_member(wheel_zip, record_path,
+                ''.join('%s\n' % (r,) for r in records), 0644, [])
+
+    wheel_path = os.path.join(wheel_dir, wheel_filename)
+    os.rename(temp_path, wheel_path)
+    logging.info('Built wheel: %s', wheel_path)
+    return wheel_path
+
+
+def _get_distribution_from_install(lib_dir):
+    for filename in sorted(os.listdir(lib_dir)):
+        if filename.endswith('.egg-info'):
+            egg_info_path = os.path.join(lib_dir, filename)
+            break
+    else:
+        raise digg.dev.hackbuilder.errors.Error(
+                'No egg-info found in installed library (%s).' % (lib_dir,))
+
+    pkg_info = _read_pkg_info(egg_info_path)
+    name = re.search(r'^Name: (.*)$', pkg_info, re.MULTILINE).group(1)
+    version = re.search(r'^Version: (.*)$', pkg_info, re.MULTILINE).group(1)
+    return (name.strip(), version.strip(), egg_info_path)
+
+
+def _read_pkg_info(egg_info_path):
+    if os.path.isdir(egg_info_path):
+        egg_info_path = os.path.join(egg_info_path, 'PKG-INFO')
+    with open(egg_info_path, 'rb') as f:
+        return f.read()
+
+
+def _escape_wheel_name(name):
+    return re.sub(r'[^\w\d.]+', '_', name)
+
+
+def _get_wheel_tag(interpreter_info, is_purelib):
+    major, minor = interpreter_info['version'].split('.')
+    if is_purelib:
+        return 'py%s-none-any' % (major,)
+
+    if interpreter_info['implementation'] == 'CPython':
+        python_tag = 'cp%s%s' % (major, minor)
+    else:
+        python_tag = 'py%s%s' % (major, minor)
+    abi_tag = python_tag
+    if major == '2':
+        abi_tag += 'm'
+        if interpreter_info['maxunicode'] == 0x10ffff:
+            abi_tag += 'u'
+    platform_tag = re.sub(r'[-.]', '_', interpreter_info['platform'])
+    return '%s-%s-%s' % (python_tag, abi_tag, platform_tag)
+
+
+def _walk_files(root_path):
+    for dirpath, subdirs, filenames in os.walk(root_path):
+        for filename in filenames:
+            full_path = os.path.join(dirpath, filename)
+            yield (full_path, os.path.relpath(full_path, root_path))
+
+
+def _make_script_shebang_generic(data):
+    if not data.startswith('#!'):
+        return data
+    first_line, newline, rest = data.partition('\n')
+    if 'python' not in first_line:
+        return data
+    return '#!python' + newline + rest
+
+
+def _write_zip_member(wheel_zip, archive_path, data, mode, records):
+    info = zipfile.ZipInfo(archive_path, ZIP_DATE_TIME)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = (mode & 0xFFFF) << 16
+    wheel_zip.writestr(info, data)
+    digest = base64.urlsafe_b64encode(hashlib.sha256(data).digest())
+    records.append('%s,sha256=%s,%d' % (archive_path, digest.rstrip('='),
+                                        len(data)))
+
+
+def get_site_packages_dir(virtualenv_root, interpreter_info):
+    """Get the site-packages directory of a virtualenv."""
+    return os.path.join(virtualenv_root, 'lib',
+            'python' + interpreter_info['version'], 'site-packages')
+
+
+def install_wheel(wheel_path, virtualenv_root, interpreter_info,
+        record_path):
+    """Install a wheel into a virtualenv.
+
+    The wheel is unpacked directly without running any installer, so
+    installing an already built library is just a matter of file I/O.
+
+    Args:
+        wheel_path: The path of the wheel to install
+        virtualenv_root: The root directory of the virtualenv
+        interpreter_info: The interpreter details from get_interpreter_info
+        record_path: The path of a file in which to record the absolute
+            paths of all the installed files
+    """
+    logging.debug('Installing wheel %s into %s', wheel_path, virtualenv_root)
+    site_packages_dir = get_site_packages_dir(virtualenv_root,
+            interpreter_info)
+    python_bin_path = os.path.join(virtualenv_root, 'bin', 'python')
+    (dist_name, version) = os.path.basename(wheel_path).split('-')[:2]
+    data_dir = '%s-%s.data' % (dist_name, version)
+    scheme_dirs = {
+            'purelib': site_packages_dir,
+            'platlib': site_packages_dir,
+            'scripts': os.path.join(virtualenv_root, 'bin'),
+            'data': virtualenv_root,
+            'headers': os.path.join(virtualenv_root, 'include', 'site',
+                'python' + interpreter_info['version'], dist_name),
+            }
+
+    installed_paths = []
+    with zipfile.ZipFile(wheel_path) as wheel_zip:
+        for info in wheel_zip.infolist():
+            if info.filename.endswith('/'):
+                continue
+
+            path_parts = info.filename.split('/')
+            scheme = None
+            if path_parts[0] == data_dir:
+                scheme = path_parts[1]
+                dest_path = os.path.join(scheme_dirs[scheme], *path_parts[2:])
+            else:
+                dest_path = os.path.join(site_packages_dir, *path_parts)
+
+            data = wheel_zip.read(info)
+            if scheme == 'scripts' and data.startswith('#!python'):
+                data = '#!' + python_bin_path + data[len('#!python'):]
+
+            _write_installed_file(dest_path, data, info.external_attr >> 16)
+            installed_paths.append(dest_path)
+
+    with open(record_path, 'w') as f:
+        f.writelines('%s\n' % (path,) for path in installed_paths)
+
+
+def _write_installed_file(path, data, mode):
+    dirname = os.path.dirname(path)
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # Replace rather than overwrite existing files. Virtualenvs are cloned
+    # from templates with hard links, and writing through a link would
+    # modify the template.
+    try:
+        os.remove(path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    with open(path, 'wb') as f:
+        f.write(data)
+    if mode & 0111:
+        os.chmod(path, 0755)
@@ -0,0 +1,244 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import logging
+import os
+import os.path
+import re
+import zipfile
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+# Files that hold native code. The dynamic loader can't load these from a
+# zip file, so the bootstrap extracts them before they are imported.
+NATIVE_FILE_PATTERN = re.compile(r'\.(so|pyd|dylib)(\.[0-9.]+)?$')
+NATIVE_MODULE_SUFFIXES = ('.so', '.pyd')
+BOOTSTRAP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# The __main__ module of a zipapp. It runs under both Python 2 and 3.
+BOOTSTRAP_TEMPLATE = r'''# Generated by hack. Runs %(console_script)s from this file.
+import os
+import shutil
+import sys
+import tempfile
+import zipfile
+
+ARCHIVE_HASH = %(archive_hash)r
+MODULE_NAME = %(module_name)r
+ATTRIBUTE_NAMES = %(attribute_names)r
+# The modules in native files, mapped to their path in the archive.
+NATIVE_MODULES = %(native_modules)r
+# All native files, including the libraries native modules link against.
+NATIVE_FILES = %(native_files)r
+
+ARCHIVE_PATH = os.path.dirname(os.path.abspath(__file__))
+
+
+def get_cache_root():
+    cache_root = os.environ.get('HACK_ZIPAPP_CACHE')
+    if cache_root:
+        return cache_root
+    xdg_cache_home = (os.environ.get('XDG_CACHE_HOME') or
+                      os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(xdg_cache_home, 'hack-zipapp')
+
+
+def extract_native_files():
+    """Extract the native files of this archive, once per archive version.
+
+    Native files are extracted together, so extensions find the libraries
+    next to them. The extracted tree is renamed into place, so concurrent
+    runs never see a partial tree.
+    """
+    cache_root = get_cache_root()
+    extract_root = os.path.join(cache_root, ARCHIVE_HASH)
+    if os.path.isdir(extract_root):
+        return extract_root
+
+    if not os.path.isdir(cache_root):
+        try:
+            os.makedirs(cache_root)
+        except OSError:
+            if not os.path.isdir(cache_root):
+                raise
+    temp_root = tempfile.mkdtemp(prefix='.' + ARCHIVE_HASH, dir=cache_root)
+    try:
+        archive = zipfile.ZipFile(ARCHIVE_PATH)
+        try:
+            for name in NATIVE_FILES:
+                dest_path = os.path.join(temp_root, *name.split('/'))
+                if not os.path.isdir(os.path.dirname(dest_path)):
+                    os.makedirs(os.path.dirname(dest_path))
+                with open(dest_path, 'wb') as f:
+                    f.write(archive.read(name))
+                os.chmod(dest_path, 0o755)
+        finally:
+            archive.close()
+        try:
+            os.rename(temp_root, extract_root)
+        except OSError:
+            # Another run got there first.
+            if not os.path.isdir(extract_root):
+                raise
+    finally:
+        if os.path.isdir(temp_root):
+            shutil.rmtree(temp_root)
+    return extract_root
+
+
+class NativeModuleFinder(object):
+    """Imports native modules from their extracted files."""
+
+    def __init__(self):
+        self._extract_root = None
+
+    def _get_path(self, fullname):
+        if self._extract_root is None:
+            self._extract_root = extract_native_files()
+        return os.path.join(self._extract_root,
+                            *NATIVE_MODULES[fullname].split('/'))
+
+    def find_spec(self, fullname, path, target=None):
+        if fullname not in NATIVE_MODULES:
+            return None
+        import importlib.util
+        return importlib.util.spec_from_file_location(
+            fullname, self._get_path(fullname))
+
+    def find_module(self, fullname, path=None):
+        if fullname not in NATIVE_MODULES:
+            return None
+        return self
+
+    def load_module(self, fullname):
+        if fullname in sys.modules:
+            return sys.modules[fullname]
+        import imp
+        return imp.load_dynamic(fullname, self._get_path(fullname))
+
+
+def main():
+    if NATIVE_MODULES:
+        sys.meta_path.insert(0, NativeModuleFinder())
+    entry_point = __import__(MODULE_NAME, fromlist=['__name__'])
+    for attribute_name in ATTRIBUTE_NAMES:
+        entry_point = getattr(entry_point, attribute_name)
+    sys.exit(entry_point())
+
+
+if __name__ == '__main__':
+    main()
+'''
+
+
+def find_native_modules(names):
+    """Find the importable modules among the native files of an archive.
+
+    Args:
+        names: The archive paths of the native files
+
+    Returns: A dict of archive paths keyed by module name.
+    """
+    native_modules = {}
+    for name in names:
+        if not name.endswith(NATIVE_MODULE_SUFFIXES):
+            continue
+        parts = name.split('/')
+        # Extension modules may carry an ABI tag, as in
+        # foo.cpython-37m-x86_64-linux-gnu.so.
+        parts[-1] = parts[-1].split('.')[0]
+        if all(re.match(r'^[A-Za-z_][A-Za-z0-9_]*$', part)
+               for part in parts):
+            native_modules['.'.join(parts)] = name
+    return native_modules
+
+
+def write_zipapp(output_path, root, console_script, interpreter,
+        digest_cache=None):
+    """Write the files of a directory tree into an executable zip file.
+
+    Python runs the zip file through the bootstrap __main__ module, which
+    runs the console script. Modules are imported straight from the zip file
+    by zipimport, which looks for their bytecode next to them. Native files
+    are extracted to a cache directory the first time a native module is
+    imported.
+
+    The file is written under a temporary name and renamed into place, so a
+    running zipapp is never modified.
+
+    Args:
+        output_path: The path of the zipapp
+        root: The root of the tree to write into the zipapp
+        console_script: The entry point to run, as in module:function
+        interpreter: The interpreter to name in the #! line
+        digest_cache: A digg.dev.hackbuilder.digest.DigestCache to get the
+            digests of the files from, or None to hash every file
+    """
+    if ':' not in console_script:
+        raise digg.dev.hackbuilder.errors.Error(
+                'Console script %s has no function.' % (console_script,))
+    (module_name, attribute_path) = console_script.split(':', 1)
+
+    paths = []
+    for dirpath, subdirs, filenames in os.walk(root):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            paths.append((os.path.relpath(full_path, root).replace(
+                os.path.sep, '/'), full_path))
+    if '__main__.py' in [name for name, full_path in paths]:
+        raise digg.dev.hackbuilder.errors.Error(
+                'Zipapp tree %s already has a __main__.py.' % (root,))
+
+    full_paths = [full_path for name, full_path in paths]
+    if digest_cache is None:
+        file_digests = [digg.dev.hackbuilder.util.hash_file(full_path, 'sha1')
+                        for full_path in full_paths]
+    else:
+        file_digests = digest_cache.get_digests(full_paths, 'sha1')
+    archive_hash = hashlib.sha1()
+    for (name, full_path), file_digest in zip(paths, file_digests):
+        archive_hash.update(name + '\0' + file_digest)
+    native_files = sorted(name for name, full_path in paths
+                          if NATIVE_FILE_PATTERN.search(name))
+    bootstrap_text = BOOTSTRAP_TEMPLATE % {
+            'archive_hash': archive_hash.hexdigest(),
+            'attribute_names': tuple(attribute_path.split('.')),
+            'console_script': console_script,
+            'module_name': module_name,
+            'native_files': tuple(native_files),
+            'native_modules': find_native_modules(native_files),
+            }
+
+    logging.info('Writing zipapp %s with %d files, %d of them native',
+            output_path, len(paths), len(native_files))
+    temp_path = '%s.%d' % (output_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write('#!%s\n' % (interpreter,))
+        zip_file = zipfile.ZipFile(f, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            info = zipfile.ZipInfo('__main__.py', BOOTSTRAP_DATE_TIME)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            info.external_attr = 0644 << 16
+            zip_file.writestr(info, bootstrap_text)
+            for name, full_path in paths:
+                # zipimport compares the time of a module's entry with the
+                # timestamp in its bytecode, so keep the file times.
+                zip_file.write(full_path, name)
+        finally:
+            zip_file.close()
+    os.chmod(temp_path, 0755)
+    os.rename(temp_path, output_path)
@@ -0,0 +1,273 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import os.path
+import sys
+
+import digg.dev.hackbuilder.common
+import digg.dev.hackbuilder.toolchain
+import digg.dev.hackbuilder.util
+
+# Bump this when a change to hack makes binaries built for runs stale.
+RUN_MANIFEST_VERSION = 4
+RUN_MANIFEST_FILENAME = 'run_manifest.json'
+
+# Directories at the root of the repository that hold build outputs rather
+# than inputs.
+OUTPUT_DIR_NAMES = frozenset([
+        digg.dev.hackbuilder.common.DEFAULT_SOURCE_DIR,
+        digg.dev.hackbuilder.common.DEFAULT_BUILD_DIR,
+        digg.dev.hackbuilder.common.DEFAULT_PACKAGE_DIR,
+        digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR,
+        ])
+VCS_DIR_NAMES = frozenset(['.git', '.hg', '.repo', '.svn'])
+# Bytecode is written as a side effect of running python, not by people.
+IGNORED_FILE_SUFFIXES = ('.pyc', '.pyo')
+
+
+def get_input_files(targets):
+    """Get the files that some targets are built from.
+
+    These are the build files and declared files of the targets, along with
+    the modules of hack itself, which decide what gets built.
+
+    Args:
+        targets: The BuildTargets to get the inputs of
+
+    Returns: A sorted list of absolute file paths.
+    """
+    input_files = set(_get_hack_source_files())
+    for target in targets:
+        input_files.update(target.get_input_paths()[0])
+    return sorted(input_files)
+
+
+def get_input_dirs(targets):
+    """Get the directory trees that some targets are built from.
+
+    These are the directories that targets declare as inputs with all they
+    hold, such as the lib_dir of a third party library. Every run stats
+    every file under them to check that a binary is up to date, so that
+    check costs time in proportion to the size of these trees, and targets
+    should declare files rather than directories where they can.
+
+    Args:
+        targets: The BuildTargets to get the inputs of
+
+    Returns: A sorted list of absolute directory paths, none of which is in
+        another.
+    """
+    dirs = set()
+    for target in targets:
+        dirs.update(path.rstrip(os.path.sep)
+                    for path in target.get_input_paths()[1])
+
+    input_dirs = []
+    for path in sorted(dirs):
+        if input_dirs and (path + os.path.sep).startswith(
+                input_dirs[-1] + os.path.sep):
+            continue
+        input_dirs.append(path)
+    return input_dirs
+
+
+def get_listed_dirs(targets):
+    """Get the directories that globs listed for some targets.
+
+    Args:
+        targets: The BuildTargets to get the directories of
+
+    Returns: A sorted list of absolute directory paths.
+    """
+    listed_dirs = set()
+    for target in targets:
+        listed_dirs.update(target.listed_dirs)
+    return sorted(listed_dirs)
+
+
+def _get_hack_source_files():
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    source_files = set()
+    for module in list(sys.modules.values()):
+        path = getattr(module, '__file__', None)
+        if path is None:
+            continue
+        path = os.path.abspath(path)
+        if not path.startswith(package_dir + os.path.sep):
+            continue
+        if path.endswith(IGNORED_FILE_SUFFIXES):
+            path = path[:-1]
+        source_files.add(path)
+    return source_files
+
+
+def fingerprint_inputs(repo_root, input_files, input_dirs, listed_dirs,
+        build_settings):
+    """Fingerprint the inputs of a build.
+
+    The fingerprint covers the path, size and modification time of every
+    input file and every file in the input directories, so it changes
+    whenever one is added, removed or written. File contents aren't read.
+    It also covers the modification time and inode of every listed
+    directory, which change when a file is added to or removed from it, so
+    that a new file that a glob would match makes the binary stale.
+
+    Args:
+        repo_root: The root of the repository. Build outputs under it aren't
+            inputs.
+        input_files: The files from get_input_files
+        input_dirs: The directories from get_input_dirs
+        listed_dirs: The directories from get_listed_dirs
+        build_settings: A dict of the settings the build runs with, suitable
+            for JSON
+
+    Returns: A hex digest.
+    """
+    fingerprint = hashlib.sha1(json.dumps([RUN_MANIFEST_VERSION,
+            build_settings], sort_keys=True))
+    for path in input_files:
+        _fingerprint_file(fingerprint, path)
+    for input_dir in input_dirs:
+        for dirpath, subdirs, filenames in os.walk(input_dir):
+            subdirs[:] = sorted(subdir for subdir in subdirs
+                                if subdir not in VCS_DIR_NAMES and
+                                not (dirpath == repo_root and
+                                     subdir in OUTPUT_DIR_NAMES))
+            for filename in sorted(filenames):
+                if filename.endswith(IGNORED_FILE_SUFFIXES):
+                    continue
+                _fingerprint_file(fingerprint, os.path.join(dirpath,
+                        filename))
+    for path in listed_dirs:
+        _fingerprint_dir(fingerprint, path)
+    return fingerprint.hexdigest()
+
+
+def _fingerprint_file(fingerprint, path):
+    try:
+        file_stat = os.lstat(path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        fingerprint.update('%s\0missing\0' % (path,))
+        return
+    fingerprint.update('%s\0%d\0%r\0' % (path, file_stat.st_size,
+            file_stat.st_mtime))
+
+
+def _fingerprint_dir(fingerprint, path):
+    try:
+        dir_stat = os.stat(path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        fingerprint.update('%s\0missing\0' % (path,))
+        return
+    fingerprint.update('%s\0%d\0%r\0' % (path, dir_stat.st_ino,
+            dir_stat.st_mtime))
+
+
+class RunManifest(object):
+    """The binaries built for runs and the inputs they were built from.
+
+    The manifest lets a run find out that a target's binary is up to date
+    without reading any build files.
+    """
+    def __init__(self, repo_root):
+        self.repo_root = repo_root
+        self.path = os.path.join(repo_root,
+                digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR,
+                RUN_MANIFEST_FILENAME)
+
+    def get_fresh_bin_path(self, target_id, build_settings):
+        """Get the binary of a target if nothing changed since it was built.
+
+        Args:
+            target_id: The normalized TargetID of the target
+            build_settings: See fingerprint_inputs
+
+        Returns: The path of the binary, or None if it has to be built.
+        """
+        entry = self._load().get(target_id.id_string)
+        if entry is None:
+            logging.info('%s has not been built for a run yet.', target_id)
+            return None
+        bin_path = entry['bin_path'].encode('utf-8')
+        if not os.path.exists(bin_path):
+            logging.info('Binary of %s is missing.', target_id)
+            return None
+        if not digg.dev.hackbuilder.toolchain.tool_stamps_unchanged(
+                entry['tool_stamps']):
+            logging.info('Tools that built %s changed.', target_id)
+            return None
+        input_files = [path.encode('utf-8') for path in entry['input_files']]
+        input_dirs = [path.encode('utf-8') for path in entry['input_dirs']]
+        listed_dirs = [path.encode('utf-8')
+                       for path in entry['listed_dirs']]
+        if (fingerprint_inputs(self.repo_root, input_files, input_dirs,
+                listed_dirs, build_settings) != entry['fingerprint']):
+            logging.info('Inputs of %s changed since it was built.',
+                    target_id)
+            return None
+        return bin_path
+
+    def save_entry(self, target_id, bin_path, input_files, input_dirs,
+            listed_dirs, fingerprint, tool_stamps):
+        """Record that a target's binary was built from the given inputs.
+
+        Args:
+            target_id: The normalized TargetID of the target
+            bin_path: The path of the target's binary
+            input_files: The files from get_input_files
+            input_dirs: The directories from get_input_dirs
+            listed_dirs: The directories from get_listed_dirs
+            fingerprint: The fingerprint of the inputs, taken before the
+                build started
+            tool_stamps: The stamps of the tools the build probed, from
+                digg.dev.hackbuilder.toolchain.ToolchainProbes.get_tool_stamps
+        """
+        entries = self._load()
+        entries[target_id.id_string] = {
+                'bin_path': bin_path,
+                'fingerprint': fingerprint,
+                'input_dirs': input_dirs,
+                'input_files': input_files,
+                'listed_dirs': listed_dirs,
+                'tool_stamps': tool_stamps,
+                }
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.path))
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': RUN_MANIFEST_VERSION, 'targets': entries},
+                    f, sort_keys=True, indent=4)
+        os.rename(temp_path, self.path)
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                manifest_data = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return {}
+        if (not isinstance(manifest_data, dict) or
+                manifest_data.get('version') != RUN_MANIFEST_VERSION):
+            return {}
+        return manifest_data['targets']
@@ -0,0 +1,263 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import os.path
+import stat
+
+import digg.dev.hackbuilder.util
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+MANIFEST_VERSION = 1
+# The number of symlinks a worker creates at a time.
+SYMLINK_BATCH_SIZE = 512
+
+
+def mirror_tree(from_path, to_path, manifest_path, jobs=None):
+    """Mirror a directory tree into the source tree with symlinks.
+
+    Directories are created in a mirror image of the directories in
+    from_path. Every other entry becomes a symlink to its counterpart in
+    from_path. See mirror_files for how the mirror is kept up to date.
+
+    The subtrees of from_path are scanned in parallel, with scandir when it
+    is available, so big vendored trees are scanned at the speed of the
+    filesystem.
+
+    Args:
+        from_path: The root of the tree to mirror
+        to_path: The directory to mirror the tree into
+        manifest_path: The path of the manifest of the mirrored tree
+        jobs: The number of threads to scan and mirror with. This defaults
+            to the number of CPUs.
+    """
+    (rel_paths, rel_dirs) = _list_dir(from_path, '')
+    for (subtree_paths, subtree_dirs) in digg.dev.hackbuilder.util.run_in_parallel(
+            lambda rel_dir: _scan_subtree(from_path, rel_dir),
+            list(rel_dirs), jobs):
+        rel_paths.extend(subtree_paths)
+        rel_dirs.extend(subtree_dirs)
+    mirror_files(rel_paths, from_path, to_path, manifest_path, rel_dirs,
+            jobs)
+
+
+def _scan_subtree(from_path, rel_dir):
+    rel_paths = []
+    rel_dirs = [rel_dir]
+    pending_dirs = [rel_dir]
+    while pending_dirs:
+        (dir_paths, subdirs) = _list_dir(from_path, pending_dirs.pop())
+        rel_paths.extend(dir_paths)
+        rel_dirs.extend(subdirs)
+        pending_dirs.extend(subdirs)
+    return (rel_paths, rel_dirs)
+
+
+def _list_dir(from_path, rel_dir):
+    """List a directory of a tree.
+
+    Symlinks to directories are listed like files.
+
+    Returns: A pair of lists of the paths relative to from_path of the files
+        and of the subdirectories in the directory.
+    """
+    prefix = rel_dir + os.path.sep if rel_dir else ''
+    full_dir = os.path.join(from_path, rel_dir)
+    rel_paths = []
+    rel_dirs = []
+    if scandir is not None:
+        for entry in scandir(full_dir):
+            if entry.is_dir(follow_symlinks=False):
+                rel_dirs.append(prefix + entry.name)
+            else:
+                rel_paths.append(prefix + entry.name)
+    else:
+        for name in os.listdir(full_dir):
+            if stat.S_ISDIR(os.lstat(os.path.join(full_dir, name)).st_mode):
+                rel_dirs.append(prefix + name)
+            else:
+                rel_paths.append(prefix + name)
+    return (rel_paths, rel_dirs)
+
+
+def mirror_files(rel_paths, from_path, to_path, manifest_path, rel_dirs=(),
+        jobs=None):
+    """Mirror files into the source tree with symlinks.
+
+    The mirrored files are described by a manifest stored at manifest_path.
+    When the files match the manifest, nothing on disk is touched.
+    Otherwise, only the symlinks that changed are created and the ones for
+    files that are no longer mirrored are removed, along with directories
+    they leave empty.
+
+    Several targets may mirror files into the same directories, so an entry
+    is only removed while it still is what this mirror created.
+
+    Args:
+        rel_paths: The paths of the files relative to from_path
+        from_path: The directory the files are in
+        to_path: The directory to mirror the files into
+        manifest_path: The path of the manifest of the mirrored files
+        rel_dirs: The paths of directories to create even if empty
+        jobs: The number of threads to create symlinks with. This defaults
+            to the number of CPUs.
+    """
+    # Symlinks point up to to_path and then over to from_path, which saves
+    # a relpath call per file.
+    from_path_from_to_path = os.path.relpath(from_path, to_path)
+    new_manifest = dict((os.path.normpath(rel_dir), ['d'])
+                        for rel_dir in rel_dirs)
+    for rel_path in rel_paths:
+        rel_path = os.path.normpath(rel_path)
+        depth = rel_path.count(os.path.sep)
+        new_manifest[rel_path] = ['l', os.path.join(
+                *(['..'] * depth + [from_path_from_to_path, rel_path]))]
+        rel_dir = os.path.dirname(rel_path)
+        while rel_dir and rel_dir not in new_manifest:
+            new_manifest[rel_dir] = ['d']
+            rel_dir = os.path.dirname(rel_dir)
+
+    old_manifest = _load_manifest(manifest_path)
+    if old_manifest is None or not os.path.isdir(to_path):
+        # The mirror is in an unknown state, so create every entry and
+        # replace whatever is in the way.
+        old_manifest = {}
+
+    if new_manifest == old_manifest:
+        logging.debug('Mirror of %s in %s is up to date.', from_path,
+                to_path)
+        return
+
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(to_path)
+
+    # Children sort after their parents, so reverse order removes the
+    # contents of a directory before the directory itself.
+    removed_count = 0
+    for rel_path in sorted(old_manifest, reverse=True):
+        old_entry = old_manifest[rel_path]
+        if new_manifest.get(rel_path) == old_entry:
+            continue
+        if _remove_entry(os.path.join(to_path, rel_path), old_entry):
+            removed_count += 1
+
+    changed_paths = sorted(rel_path for rel_path, entry
+                           in new_manifest.iteritems()
+                           if old_manifest.get(rel_path) != entry)
+    # Parents sort before their children, so every directory exists by the
+    # time its entries are created.
+    symlinks = []
+    for rel_path in changed_paths:
+        entry = new_manifest[rel_path]
+        full_path = os.path.join(to_path, rel_path)
+        if entry[0] == 'd':
+            _mkdir(full_path)
+        else:
+            symlinks.append((entry[1], full_path))
+    digg.dev.hackbuilder.util.run_in_parallel(_create_symlinks,
+            [symlinks[i:i + SYMLINK_BATCH_SIZE]
+             for i in xrange(0, len(symlinks), SYMLINK_BATCH_SIZE)],
+            jobs)
+
+    logging.info('Mirrored %d and removed %d entries in %s',
+            len(changed_paths), removed_count, to_path)
+    _save_manifest(manifest_path, new_manifest)
+
+
+def _mkdir(path):
+    try:
+        os.mkdir(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        if os.path.islink(path) or not os.path.isdir(path):
+            os.remove(path)
+            os.mkdir(path)
+
+
+def _create_symlinks(symlinks):
+    for link_target, path in symlinks:
+        _symlink(link_target, path)
+
+
+def _remove_entry(path, entry):
+    if entry[0] == 'd':
+        try:
+            os.rmdir(path)
+        except OSError, e:
+            # Other targets may still have files in the directory.
+            if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST,
+                    errno.ENOTDIR):
+                raise
+            return False
+        return True
+
+    try:
+        if os.readlink(path) != entry[1]:
+            return False
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.EINVAL):
+            raise
+        return False
+    os.remove(path)
+    return True
+
+
+def _symlink(link_target, path):
+    try:
+        os.symlink(link_target, path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+        if os.path.islink(path) and os.readlink(path) == link_target:
+            return
+        os.remove(path)
+        os.symlink(link_target, path)
+
+
+def _load_manifest(manifest_path):
+    try:
+        with open(manifest_path) as f:
+            manifest_data = json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    if (not isinstance(manifest_data, dict) or
+            manifest_data.get('version') != MANIFEST_VERSION):
+        return None
+    return manifest_data['entries']
+
+
+def _save_manifest(manifest_path, manifest):
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(
+            os.path.dirname(manifest_path))
+    manifest_data = {
+            'version': MANIFEST_VERSION,
+            'entries': manifest,
+            }
+    temp_path = '%s.%d' % (manifest_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(manifest_data, f, sort_keys=True)
+    os.rename(temp_path, manifest_path)
@@ -0,0 +1,194 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import errno
+import json
+import logging
+import os
+import os.path
+import shutil
+import stat
+
+import digg.dev.hackbuilder.archive
+import digg.dev.hackbuilder.util
+
+MANIFEST_VERSION = 2
+
+
+def stage_tree(src_root, dest_root, manifest_path, source_date_epoch=None,
+        exclude=()):
+    """Stage a directory tree into a package hierarchy.
+
+    Files are hard linked into place, or reflinked or copied where hard
+    linking isn't possible, so staging costs next to no I/O. Because of
+    that, nothing may modify staged files in place.
+
+    The staged tree is described by a manifest stored at manifest_path. When
+    the source tree matches the manifest, the staged tree is left untouched.
+    Otherwise, only the entries that changed are restaged and entries that
+    disappeared from the source are removed.
+
+    For reproducible builds, files are copied instead of linked, so their
+    modification times can be clamped to source_date_epoch and their modes
+    normalized without touching the source tree. Timestamps in .pyc headers
+    are clamped too.
+
+    Args:
+        src_root: The root directory of the tree to stage
+        dest_root: The directory to stage the tree into
+        manifest_path: The path of the manifest of the staged tree
+        source_date_epoch: The latest modification time of any staged
+            entry, or None for a build that isn't reproducible
+        exclude: Paths relative to src_root to leave out. See
+            digg.dev.hackbuilder.archive.scan_tree.
+    """
+    new_manifest = _scan_tree(src_root, exclude)
+    old_manifest = _load_manifest(manifest_path, source_date_epoch)
+    if old_manifest is None or not os.path.isdir(dest_root):
+        # The staged tree is in an unknown state, so start over.
+        if os.path.lexists(dest_root):
+            shutil.rmtree(dest_root)
+        old_manifest = {}
+
+    if new_manifest == old_manifest:
+        logging.info('Already staged %s to %s', src_root, dest_root)
+        return
+
+    logging.info('Staging %s to %s', src_root, dest_root)
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(dest_root)
+
+    # Children sort after their parents, so reverse order removes the
+    # contents of a directory before the directory itself.
+    removed_count = 0
+    for rel_path in sorted(old_manifest, reverse=True):
+        old_entry = old_manifest[rel_path]
+        new_entry = new_manifest.get(rel_path)
+        if new_entry == old_entry:
+            continue
+        if new_entry is not None and new_entry[0] == old_entry[0] == 'd':
+            # Only the mode changed; the contents are handled separately.
+            continue
+        _remove_path(os.path.join(dest_root, rel_path))
+        removed_count += 1
+
+    staged_count = 0
+    for rel_path in sorted(new_manifest):
+        entry = new_manifest[rel_path]
+        if old_manifest.get(rel_path) == entry:
+            continue
+        src_path = os.path.join(src_root, rel_path)
+        dest_path = os.path.join(dest_root, rel_path)
+        if entry[0] == 'd':
+            if not os.path.isdir(dest_path):
+                os.mkdir(dest_path)
+            mode = entry[1]
+            if source_date_epoch is not None:
+                mode = digg.dev.hackbuilder.archive.normalize_mode('d', mode)
+            os.chmod(dest_path, mode)
+        elif entry[0] == 'l':
+            os.symlink(entry[1], dest_path)
+        elif source_date_epoch is None:
+            digg.dev.hackbuilder.util.link_or_copy_file(src_path, dest_path)
+        else:
+            _copy_file_reproducibly(src_path, dest_path, entry,
+                    source_date_epoch)
+        staged_count += 1
+
+    if source_date_epoch is not None:
+        _clamp_directory_mtimes(dest_root, source_date_epoch)
+
+    logging.info('Staged %d and removed %d entries in %s', staged_count,
+            removed_count, dest_root)
+    _save_manifest(manifest_path, new_manifest, source_date_epoch)
+
+
+def _copy_file_reproducibly(src_path, dest_path, entry, source_date_epoch):
+    if dest_path.endswith('.pyc'):
+        with open(src_path, 'rb') as f:
+            data = digg.dev.hackbuilder.archive.normalize_pyc_header(
+                    f.read(), source_date_epoch)
+        with open(dest_path, 'wb') as f:
+            f.write(data)
+    else:
+        digg.dev.hackbuilder.util.copy_file(src_path, dest_path)
+    os.chmod(dest_path,
+            digg.dev.hackbuilder.archive.normalize_mode('f', entry[4]))
+    mtime = digg.dev.hackbuilder.archive.clamp_mtime(int(entry[3]),
+            source_date_epoch)
+    os.utime(dest_path, (mtime, mtime))
+
+
+def _clamp_directory_mtimes(dest_root, source_date_epoch):
+    # Creating entries updates the modification time of their directory, so
+    # this has to happen after everything is staged. Symlinks are left alone
+    # since their own times can't be set without lutimes.
+    for dirpath, subdirs, filenames in os.walk(dest_root):
+        mtime = digg.dev.hackbuilder.archive.clamp_mtime(
+                int(os.lstat(dirpath).st_mtime), source_date_epoch)
+        os.utime(dirpath, (mtime, mtime))
+
+
+def _scan_tree(src_root, exclude):
+    manifest = {}
+    for rel_path, file_stat in digg.dev.hackbuilder.archive.scan_tree(
+            src_root, exclude):
+        if stat.S_ISLNK(file_stat.st_mode):
+            manifest[rel_path] = ['l',
+                    os.readlink(os.path.join(src_root, rel_path))]
+        elif stat.S_ISDIR(file_stat.st_mode):
+            manifest[rel_path] = ['d', stat.S_IMODE(file_stat.st_mode)]
+        else:
+            manifest[rel_path] = ['f', file_stat.st_ino, file_stat.st_size,
+                    file_stat.st_mtime, stat.S_IMODE(file_stat.st_mode)]
+    return manifest
+
+
+def _load_manifest(manifest_path, source_date_epoch):
+    try:
+        with open(manifest_path) as f:
+            manifest_data = json.load(f)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+    if (not isinstance(manifest_data, dict) or
+            manifest_data.get('version') != MANIFEST_VERSION or
+            manifest_data.get('source_date_epoch') != source_date_epoch):
+        # The tree was staged differently, so its state is unknown.
+        return None
+    return manifest_data['entries']
+
+
+def _save_manifest(manifest_path, manifest, source_date_epoch):
+    digg.dev.hackbuilder.util.makedirs_if_not_exists(
+            os.path.dirname(manifest_path))
+    manifest_data = {
+            'version': MANIFEST_VERSION,
+            'source_date_epoch': source_date_epoch,
+            'entries': manifest,
+            }
+    temp_path = '%s.%d' % (manifest_path, os.getpid())
+    with open(temp_path, 'w') as f:
+        json.dump(manifest_data, f, sort_keys=True)
+    os.rename(temp_path, manifest_path)
+
+
+def _remove_path(path):
+    if not os.path.lexists(path):
+        return
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
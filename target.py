@@ -12,6 +12,7 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import json
 import logging
 import os.path
 import re
@@ -19,6 +20,9 @@ import sys
 
 import digg.dev.hackbuilder.common
 import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.import_profile
+import digg.dev.hackbuilder.run_manifest
+import digg.dev.hackbuilder.toolchain
 
 
 class Normalizer(object):
@@ -213,6 +217,10 @@ class TargetID(object):
     def is_normalized(self):
         return self.is_absolute() and self.has_name()
 
+    def to_filename(self):
+        """Get a form of a normalized target id usable as a filename."""
+        return self.id_string[1:].replace(os.path.sep, '_').replace(':', '-')
+
 
 class Target(object):
     def __init__(self, dep_ids=None):
@@ -255,16 +263,125 @@ class RunTarget(Target):
         self.build_target_resolver = (
                 digg.dev.hackbuilder.build.BuildTargetFromBuildFileResolver(
                     build_file_reader))
-        target = self.build_target_resolver.resolve(target_id)
+        self._build_target = None
         super(RunTarget, self).__init__([target_id])
 
-    def run(self, args):
+    def get_build_target(self):
+        """Get the build target of the binary, reading build files once."""
+        if self._build_target is None:
+            self._build_target = self.build_target_resolver.resolve(
+                    self.target_id)
+        return self._build_target
+
+    def build(self, build_settings):
+        """Build the binary unless it is up to date.
+
+        The binary is up to date when none of the input files of the
+        targets it is built from changed since it was last built for a run,
+        and no file was added to or removed from a directory that a glob of
+        their build files listed.
+        Checking that takes no build files, so running an up to date binary
+        starts right away. Otherwise, the binary is built like hack build
+        would build it.
+
+        Args:
+            build_settings: A dict of the settings that builds run with,
+                suitable for JSON. Changing them makes the binary stale.
+
+        Returns: The path of the binary.
+        """
+        run_manifest = digg.dev.hackbuilder.run_manifest.RunManifest(
+                self.normalizer.repo_root_path)
+        bin_path = run_manifest.get_fresh_bin_path(self.target_id,
+                build_settings)
+        if bin_path is not None:
+            logging.info('Binary of %s is up to date.', self.target_id)
+            return bin_path
+
+        target = self.get_build_target()
+        transitive_deps = target.get_transitive_deps(
+                self.build_target_resolver)
+        targets = _get_targets_in_tree({target: transitive_deps})
+        input_files = digg.dev.hackbuilder.run_manifest.get_input_files(
+                targets)
+        input_dirs = digg.dev.hackbuilder.run_manifest.get_input_dirs(targets)
+        listed_dirs = digg.dev.hackbuilder.run_manifest.get_listed_dirs(
+                targets)
+        # Fingerprinting before building means that files changed during the
+        # build make the next run build again.
+        fingerprint = digg.dev.hackbuilder.run_manifest.fingerprint_inputs(
+                self.normalizer.repo_root_path, input_files, input_dirs,
+                listed_dirs, build_settings)
+        build = digg.dev.hackbuilder.build.Build({target: transitive_deps},
+                self.normalizer)
+        build.build()
+        tool_stamps = digg.dev.hackbuilder.toolchain.get_toolchain_probes(
+                target.cache_root).get_tool_stamps()
+        run_manifest.save_entry(self.target_id, target.bin_path, input_files,
+                input_dirs, listed_dirs, fingerprint, tool_stamps)
+        return target.bin_path
+
+    def run(self, args, import_profile_path=None, bin_path=None):
+        """Run the binary of the target.
+
+        Args:
+            args: The command line arguments for the binary
+            import_profile_path: Where to save the import profile of the
+                run, or None to exec the binary without profiling it
+            bin_path: The path of the binary, if already known
+
+        Returns: The exit code of the binary, when profiling. Otherwise, the
+            binary replaces this process.
+        """
         logging.info('Running target: %s', self.target_id)
-        target = self.build_target_resolver.resolve(self.target_id)
-        all_args = [target.bin_path] + args
+        if bin_path is None:
+            bin_path = self.get_build_target().bin_path
+        if import_profile_path is not None:
+            return self._run_with_import_profile(self.get_build_target(),
+                    bin_path, args, import_profile_path)
+
+        all_args = [bin_path] + args
         command_string = '"{0}"'.format('" "'.join(all_args))
         logging.info('Execing command: %s', command_string)
-        os.execv(target.bin_path, all_args)
+        os.execv(bin_path, all_args)
+
+    def _run_with_import_profile(self, target, bin_path, args,
+            import_profile_path):
+        build = digg.dev.hackbuilder.build.Build(
+                {target: target.get_transitive_deps(
+                    self.build_target_resolver)},
+                self.normalizer)
+        builder = build.builders[target.target_id]
+        if not hasattr(builder, 'get_module_owners'):
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Target %s does not support import profiling.' %
+                    (self.target_id,))
+        (package_owners, file_owners) = builder.get_module_owners(
+                build.builders)
+
+        (returncode, records) = (
+                digg.dev.hackbuilder.import_profile.run_with_import_profile(
+                    bin_path, args,
+                    os.path.join(target.target_build_dir, 'import_profile')))
+        profile = (
+                digg.dev.hackbuilder.import_profile.aggregate_import_profile(
+                    records, package_owners, file_owners))
+        sys.stderr.write(
+                digg.dev.hackbuilder.import_profile.format_import_profile(
+                    profile))
+        with open(import_profile_path, 'w') as f:
+            json.dump(profile, f, sort_keys=True, indent=4)
+        logging.info('Saved import profile of %s to %s', self.target_id,
+                import_profile_path)
+        return returncode
+
+
+def _get_targets_in_tree(target_tree):
+    targets = set()
+    for target, dep_tree in target_tree.iteritems():
+        targets.add(target)
+        targets.update(_get_targets_in_tree(dep_tree))
+    return targets
 
 
 class BuildTarget(Target):
@@ -300,11 +417,32 @@ class BuildTarget(Target):
                 digg.dev.hackbuilder.common.DEFAULT_BUILD_DIR,
                 self.target_id.path[1:],
                 '-' + self.target_id.name)
+        self.source_tree_manifest_path = os.path.join(self.target_build_dir,
+                'source_tree_manifest.json')
 
         self.package_root = os.path.join(
                 self.normalizer.repo_root_path,
                 digg.dev.hackbuilder.common.DEFAULT_PACKAGE_DIR)
 
+        self.cache_root = os.path.join(
+                self.normalizer.repo_root_path,
+                digg.dev.hackbuilder.common.DEFAULT_CACHE_DIR)
+
+        # The directories that globs listed while the build file was read.
+        self.listed_dirs = []
+
+    def get_input_paths(self):
+        """Get the files and directory trees the target is built from.
+
+        Besides its build file, a target's inputs are whatever files it
+        declares. Subclasses with such files override this.
+
+        Returns: A pair of lists of absolute paths, the first of files and
+            the second of directories that are inputs with all they hold.
+        """
+        return ([os.path.join(self.target_working_copy_dir,
+                    digg.dev.hackbuilder.common.BUILD_FILENAME)], [])
+
 
 class BinaryLauncherBuildTarget(BuildTarget):
     pass
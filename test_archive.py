@@ -0,0 +1,188 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import gzip
+import hashlib
+import imp
+import os
+import os.path
+import shutil
+import StringIO
+import struct
+import tarfile
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.archive
+
+
+def read_ar_members(path):
+    members = []
+    with open(path, 'rb') as f:
+        assert f.read(8) == '!<arch>\n'
+        while True:
+            header = f.read(60)
+            if not header:
+                break
+            name = header[:16].strip()
+            size = int(header[48:58])
+            members.append((name, f.read(size)))
+            if size % 2:
+                f.read(1)
+    return members
+
+
+class ParallelGzipWriterTests(unittest.TestCase):
+    def test_output_is_single_gzip_stream(self):
+        data = ''.join(chr(i % 251) for i in xrange(3 * 1000 * 1000))
+        output = StringIO.StringIO()
+        writer = digg.dev.hackbuilder.archive.ParallelGzipWriter(output,
+                level=1, threads=4)
+        writer.write(data[:12345])
+        writer.write(data[12345:])
+        writer.close()
+        gzip_file = gzip.GzipFile(fileobj=StringIO.StringIO(
+                output.getvalue()))
+        self.assertEqual(gzip_file.read(), data)
+
+
+class ScanTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.temp_dir, 'lib', 'shared', 'sub'))
+        os.makedirs(os.path.join(self.temp_dir, 'lib', 'own'))
+        for rel_path in ('lib/shared/a.py', 'lib/shared/sub/b.py',
+                'lib/own/c.py'):
+            with open(os.path.join(self.temp_dir, rel_path), 'w') as f:
+                f.write(rel_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_excluded_directories_are_pruned(self):
+        entries = digg.dev.hackbuilder.archive.scan_tree(self.temp_dir,
+                ['lib/shared/a.py', 'lib/shared/sub/b.py'])
+        self.assertEqual([rel_path for rel_path, _ in entries],
+                ['lib', 'lib/own', 'lib/own/c.py'])
+
+
+class WriteDebTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.src_root = os.path.join(self.temp_dir, 'src')
+        os.makedirs(os.path.join(self.src_root, 'bin'))
+        with open(os.path.join(self.src_root, 'bin', 'tool'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(os.path.join(self.src_root, 'bin', 'tool'), 0755)
+        os.symlink('bin/tool', os.path.join(self.src_root, 'tool'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_write_deb(self):
+        control_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        control_manifest.add_directory('/')
+        control_manifest.add_data('control', 'Package: test\n')
+        data_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        data_manifest.add_directory('/')
+        data_manifest.add_tree(self.src_root, '/usr/lib/test')
+        data_manifest.add_data('/etc/init/test.conf', 'exec true')
+
+        deb_path = os.path.join(self.temp_dir, 'test.deb')
+        digg.dev.hackbuilder.archive.write_deb(deb_path, control_manifest,
+                data_manifest, compression_threads=2)
+
+        members = read_ar_members(deb_path)
+        self.assertEqual([name for name, _ in members],
+                ['debian-binary', 'control.tar.gz', 'data.tar.gz'])
+        self.assertEqual(members[0][1], '2.0\n')
+        data_tar = tarfile.open(fileobj=StringIO.StringIO(members[2][1]))
+        self.assertEqual(data_tar.getnames(), [
+                '.',
+                './etc',
+                './etc/init',
+                './etc/init/test.conf',
+                './usr',
+                './usr/lib',
+                './usr/lib/test',
+                './usr/lib/test/bin',
+                './usr/lib/test/bin/tool',
+                './usr/lib/test/tool',
+                ])
+        tool_info = data_tar.getmember('./usr/lib/test/bin/tool')
+        self.assertEqual((tool_info.mode, tool_info.uname), (0755, 'root'))
+        self.assertEqual(data_tar.extractfile(tool_info).read(),
+                '#!/bin/sh\n')
+        self.assertEqual(data_tar.getmember('./usr/lib/test/tool').linkname,
+                'bin/tool')
+
+    def test_reproducible_deb(self):
+        with open(os.path.join(self.src_root, 'bin', 'mod.pyc'), 'wb') as f:
+            f.write(imp.get_magic() + struct.pack('<I', 2000000000) + 'code')
+        os.chmod(os.path.join(self.src_root, 'bin'), 0700)
+
+        def write_deb(deb_path, threads):
+            data_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+            data_manifest.add_tree(self.src_root, '/usr/lib/test')
+            digg.dev.hackbuilder.archive.write_deb(deb_path,
+                    digg.dev.hackbuilder.archive.PackageManifest(),
+                    data_manifest, compression_threads=threads,
+                    source_date_epoch=1000000000)
+            with open(deb_path, 'rb') as f:
+                return f.read()
+
+        first_deb = write_deb(os.path.join(self.temp_dir, 'a.deb'), 1)
+        os.utime(os.path.join(self.src_root, 'bin', 'tool'), None)
+        second_deb = write_deb(os.path.join(self.temp_dir, 'b.deb'), 3)
+        self.assertEqual(first_deb, second_deb)
+
+        data_tar = tarfile.open(fileobj=StringIO.StringIO(
+                read_ar_members(os.path.join(self.temp_dir, 'a.deb'))[2][1]))
+        bin_info = data_tar.getmember('./usr/lib/test/bin')
+        self.assertEqual((bin_info.mode, bin_info.mtime), (0755, 1000000000))
+        pyc_data = data_tar.extractfile('./usr/lib/test/bin/mod.pyc').read()
+        self.assertEqual(pyc_data[4:8], struct.pack('<I', 1000000000))
+
+    def test_md5sums_and_installed_size_match_written_files(self):
+        with open(os.path.join(self.src_root, 'bin', 'mod.pyc'), 'wb') as f:
+            f.write(imp.get_magic() + struct.pack('<I', 2000000000) +
+                    'x' * 2000)
+        data_manifest = digg.dev.hackbuilder.archive.PackageManifest()
+        data_manifest.add_tree(self.src_root, '/usr/lib/test')
+        data_manifest.add_data('/etc/test.conf', 'conf')
+        deb_path = os.path.join(self.temp_dir, 'test.deb')
+        digg.dev.hackbuilder.archive.write_deb(deb_path,
+                digg.dev.hackbuilder.archive.PackageManifest(),
+                data_manifest, source_date_epoch=1000000000)
+
+        data_tar = tarfile.open(fileobj=StringIO.StringIO(
+                read_ar_members(deb_path)[2][1]))
+        written_md5sums = sorted(
+                (info.name[len('./'):],
+                 hashlib.md5(data_tar.extractfile(info).read()).hexdigest())
+                for info in data_tar.getmembers() if info.isfile())
+        self.assertEqual(digg.dev.hackbuilder.archive.get_md5sums(
+                data_manifest, source_date_epoch=1000000000),
+                written_md5sums)
+        # usr, usr/lib, usr/lib/test, usr/lib/test/bin, etc and the tool
+        # symlink take 1 KiB each, mod.pyc takes 2 KiB and the others 1 KiB.
+        self.assertEqual(digg.dev.hackbuilder.archive.get_installed_size(
+                data_manifest), 10)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
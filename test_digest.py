@@ -0,0 +1,82 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import hashlib
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.util
+from digg.dev.hackbuilder.digest import DigestCache
+
+
+class DigestCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'digest_cache.json')
+        self.original_hash_file = digg.dev.hackbuilder.util.hash_file
+        self.hashed_paths = []
+        def hash_file(path, algorithm='sha256'):
+            self.hashed_paths.append(path)
+            return self.original_hash_file(path, algorithm)
+        digg.dev.hackbuilder.util.hash_file = hash_file
+
+    def tearDown(self):
+        digg.dev.hackbuilder.util.hash_file = self.original_hash_file
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, name, contents, mtime=1000000000):
+        path = os.path.join(self.temp_dir, name)
+        if os.path.exists(path):
+            os.remove(path)
+        with open(path, 'w') as f:
+            f.write(contents)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def test_digests_hashed_once_per_change(self):
+        paths = [self._write_file('file%d' % (i,), 'contents %d' % (i,))
+                 for i in xrange(10)]
+        cache = DigestCache(self.cache_path)
+        self.assertEqual(cache.get_digests(paths, 'md5'),
+                [hashlib.md5('contents %d' % (i,)).hexdigest()
+                 for i in xrange(10)])
+        cache.save()
+
+        cache = DigestCache(self.cache_path)
+        cache.get_digests(paths, 'md5')
+        self.assertEqual(len(self.hashed_paths), 10)
+
+        self._write_file('file3', 'changed')
+        self.assertEqual(cache.get_digest(paths[3], 'md5'),
+                hashlib.md5('changed').hexdigest())
+        self.assertEqual(self.hashed_paths[10:], [paths[3]])
+
+    def test_recently_modified_files_always_hashed(self):
+        path = self._write_file('file', 'contents', mtime=None)
+        cache = DigestCache(self.cache_path)
+        for i in xrange(2):
+            self.assertEqual(cache.get_digest(path),
+                    hashlib.sha256('contents').hexdigest())
+        self.assertEqual(self.hashed_paths, [path, path])
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from digg.dev.hackbuilder.dir_listing_cache import DirListingCache
+
+
+class DirListingCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.temp_dir, 'root')
+        self.cache_path = os.path.join(self.temp_dir, 'cache.json')
+        for rel_path in ('a.py', 'b.txt', '.hidden.py', 'pkg/c.py',
+                'pkg/sub/d.py', 'pkg/sub/test_d.py'):
+            self._write_file(rel_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, rel_path):
+        full_path = os.path.join(self.root, rel_path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as f:
+            f.write(rel_path)
+
+    def _age_dirs(self):
+        for dirpath, subdirs, filenames in os.walk(self.root):
+            os.utime(dirpath, (1000000000, 1000000000))
+
+    def test_glob_patterns(self):
+        cache = DirListingCache(self.cache_path)
+        self.assertEqual(cache.glob(self.root, ['*.py']), ['a.py'])
+        self.assertEqual(cache.glob(self.root, ['**/*.py']),
+                ['a.py', 'pkg/c.py', 'pkg/sub/d.py', 'pkg/sub/test_d.py'])
+        self.assertEqual(cache.glob(self.root, ['pkg/**'],
+                exclude=['**/test_*.py']), ['pkg/c.py', 'pkg/sub/d.py'])
+        self.assertEqual(cache.glob(self.root, ['.*.py', 'missing/*']),
+                ['.hidden.py'])
+
+    def test_saved_listings_reused_until_dir_changes(self):
+        self._age_dirs()
+        cache = DirListingCache(self.cache_path)
+        cache.glob(self.root, ['**'])
+        cache.save()
+
+        # Listings that are still valid come from the saved cache.
+        cache = DirListingCache(self.cache_path)
+        self.assertEqual(cache.list_dir(os.path.join(self.root, 'pkg')),
+                (['c.py'], ['sub']))
+        self.assertFalse(cache._dirty)
+
+        self._write_file('pkg/e.py')
+        self.assertEqual(DirListingCache(self.cache_path).glob(self.root,
+                ['pkg/*.py']), ['pkg/c.py', 'pkg/e.py'])
+
+    def test_recently_modified_dirs_not_saved(self):
+        cache = DirListingCache(self.cache_path)
+        cache.glob(self.root, ['*'])
+        cache.save()
+        self.assertEqual(DirListingCache(self.cache_path)._load(), {})
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
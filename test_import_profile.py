@@ -0,0 +1,90 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.import_profile
+from digg.dev.hackbuilder.import_profile import ImportRecord
+
+
+class ImportProfileTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.lib_dir = os.path.join(self.temp_dir, 'lib')
+        os.makedirs(os.path.join(self.lib_dir, 'app'))
+        self._write_file('lib/app/__init__.py', '')
+        self._write_file('lib/app/slow.py', 'import time\ntime.sleep(0.05)\n')
+        self._write_file('lib/third.py', 'import app.slow\n')
+        self.bin_path = os.path.join(self.temp_dir, 'bin')
+        self._write_file('bin',
+                '#!%s\n'
+                'import sys\n'
+                'sys.path.insert(0, %r)\n'
+                'import third\n'
+                'sys.exit(4)\n' % (sys.executable, self.lib_dir))
+        os.chmod(self.bin_path, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, rel_path, contents):
+        with open(os.path.join(self.temp_dir, rel_path), 'w') as f:
+            f.write(contents)
+
+    def test_run_with_import_profile(self):
+        (returncode, records) = (
+                digg.dev.hackbuilder.import_profile.run_with_import_profile(
+                    self.bin_path, [], os.path.join(self.temp_dir, 'profile')))
+        self.assertEqual(returncode, 4)
+
+        profile = (
+                digg.dev.hackbuilder.import_profile.aggregate_import_profile(
+                    records, {'app': '/lib:app'},
+                    {os.path.join(self.lib_dir, 'third.py'): '/lib:third'}))
+        owner_profiles = dict((p['owner'], p) for p in profile['owners'])
+        self.assertEqual([m['module'] for m in
+                owner_profiles['/lib:app']['modules']], ['app.slow', 'app'])
+        self.assertTrue(owner_profiles['/lib:app']['self_seconds'] >= 0.05)
+        third_module = owner_profiles['/lib:third']['modules'][0]
+        self.assertEqual(third_module['imported_by'], '__main__')
+        self.assertTrue(third_module['cumulative_seconds'] >= 0.05)
+        self.assertTrue(third_module['self_seconds'] < 0.05)
+        self.assertTrue('/lib:app' in
+                digg.dev.hackbuilder.import_profile.format_import_profile(
+                    profile))
+
+    def test_module_owner(self):
+        get_module_owner = (
+                digg.dev.hackbuilder.import_profile.get_module_owner)
+        file_owners = {'/venv/site-packages/lib.py': '/third_party:lib'}
+        self.assertEqual(get_module_owner(ImportRecord('lib',
+                '/venv/site-packages/__pycache__/lib.cpython-37.pyc', None,
+                0, 0), {}, file_owners), '/third_party:lib')
+        self.assertEqual(get_module_owner(ImportRecord('app.sub.mod',
+                '/venv/app/sub/mod.pyc', None, 0, 0), {'app': '/lib:app'},
+                file_owners), '/lib:app')
+        self.assertEqual(get_module_owner(ImportRecord('sys', None, None, 0,
+                0), {}, {}), digg.dev.hackbuilder.import_profile.BUILTIN_OWNER)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import sys
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.python_bytecode
+
+
+class CompileTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.temp_dir, 'lib')
+        self.script_path = os.path.join(self.temp_dir, 'compile.py')
+        os.makedirs(os.path.join(self.root, 'pkg'))
+        self._write_module('pkg/__init__.py', '')
+        self._write_module('pkg/a.py', 'A = 1\n')
+        self._write_module('broken.py', 'def\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_module(self, rel_path, contents):
+        with open(os.path.join(self.root, rel_path), 'w') as f:
+            f.write(contents)
+
+    def _compile(self):
+        return digg.dev.hackbuilder.python_bytecode.compile_tree(
+                sys.executable, self.root, self.script_path, jobs=2)
+
+    def test_find_modules(self):
+        self.assertEqual(
+                digg.dev.hackbuilder.python_bytecode.find_modules(self.root),
+                ['broken.py', 'pkg/__init__.py', 'pkg/a.py'])
+
+    def test_compile_skips_broken_and_up_to_date_modules(self):
+        self.assertEqual(self._compile(), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'pkg',
+                'a.pyc')))
+        self.assertEqual(self._compile(), 0)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.python_virtualenv
+
+
+class MergeVirtualenvsTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.first_root = self._make_virtualenv('first')
+        self.second_root = self._make_virtualenv('second')
+        self.dest_root = os.path.join(self.temp_dir, 'merged')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _make_virtualenv(self, name):
+        root = os.path.join(self.temp_dir, name)
+        os.makedirs(os.path.join(root, 'bin'))
+        os.makedirs(os.path.join(root, 'lib', 'site-packages', 'shared'))
+        self._write_file(root, 'bin/' + name, name)
+        self._write_file(root, 'bin/activate', 'VIRTUAL_ENV=' + root)
+        self._write_file(root, 'lib/site-packages/shared/__init__.py', '')
+        self._write_file(root, 'lib/site-packages/easy-install.pth',
+                'shared.egg\n%s.egg\n' % (name,))
+        os.symlink(os.path.join(root, 'lib'), os.path.join(root, 'lib64'))
+        return root
+
+    def _write_file(self, root, rel_path, contents):
+        with open(os.path.join(root, rel_path), 'w') as f:
+            f.write(contents)
+
+    def _read_file(self, rel_path):
+        with open(os.path.join(self.dest_root, rel_path)) as f:
+            return f.read()
+
+    def _merge(self):
+        digg.dev.hackbuilder.python_virtualenv.merge_virtualenvs(
+                [(self.first_root, ()), (self.second_root, ())],
+                self.dest_root)
+
+    def test_merge(self):
+        self._merge()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest_root,
+                'bin'))), ['activate', 'first', 'second'])
+        self.assertEqual(self._read_file('lib/site-packages/easy-install.pth'),
+                'shared.egg\nfirst.egg\nsecond.egg\n')
+        self.assertEqual(os.readlink(os.path.join(self.dest_root, 'lib64')),
+                'lib')
+
+    def test_conflicting_files_raise(self):
+        self._write_file(self.second_root,
+                'lib/site-packages/shared/__init__.py', 'version = 2')
+        self.assertRaises(digg.dev.hackbuilder.errors.Error, self._merge)
+
+
+class FindSlimFilesTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.site_packages = os.path.join('lib', 'python2.7',
+                'site-packages')
+        for rel_path in ('bin/pip', 'bin/tool',
+                'lib/python2.7/site-packages/pkg_resources.py',
+                'lib/python2.7/site-packages/setuptools/__init__.py',
+                'lib/python2.7/site-packages/lib/__init__.py',
+                'lib/python2.7/site-packages/lib/__init__.pyc',
+                'lib/python2.7/site-packages/lib/tests/test_lib.py'):
+            self._write_file(rel_path)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, rel_path):
+        full_path = os.path.join(self.temp_dir, rel_path)
+        if not os.path.isdir(os.path.dirname(full_path)):
+            os.makedirs(os.path.dirname(full_path))
+        with open(full_path, 'w') as f:
+            f.write(rel_path)
+
+    def _find_slim_files(self, bytecode_only):
+        return digg.dev.hackbuilder.python_virtualenv.find_slim_files(
+                self.temp_dir,
+                digg.dev.hackbuilder.python_virtualenv.SLIM_EXCLUDE_PATTERNS,
+                bytecode_only)
+
+    def test_default_patterns(self):
+        self.assertEqual(sorted(self._find_slim_files(False)), [
+                'bin/pip',
+                os.path.join(self.site_packages, 'lib/tests'),
+                os.path.join(self.site_packages, 'lib/tests/test_lib.py'),
+                os.path.join(self.site_packages, 'setuptools'),
+                os.path.join(self.site_packages, 'setuptools/__init__.py'),
+                ])
+
+    def test_setuptools_eggs_kept(self):
+        # pkg_resources lives inside the egg of setuptools or distribute.
+        egg_files = [os.path.join(self.site_packages, rel_path)
+                for rel_path in (
+                    'setuptools-0.6c11-py2.7.egg/pkg_resources.py',
+                    'setuptools-0.6c11-py2.7.egg/setuptools/__init__.py',
+                    'distribute-0.6.34-py2.7.egg/pkg_resources.py')]
+        metadata_files = [os.path.join(self.site_packages, rel_path)
+                for rel_path in (
+                    'setuptools-0.6c11.egg-info',
+                    'setuptools-28.8.0.dist-info/RECORD')]
+        for rel_path in egg_files + metadata_files:
+            self._write_file(rel_path)
+
+        slim_files = self._find_slim_files(False)
+        for rel_path in egg_files:
+            self.assertFalse(rel_path in slim_files)
+        for rel_path in metadata_files:
+            self.assertTrue(rel_path in slim_files)
+
+    def test_bytecode_only(self):
+        self.assertTrue(os.path.join(self.site_packages, 'lib/__init__.py')
+                in self._find_slim_files(True))
+
+
+# Makes a small virtualenv at the path it is given, and counts its runs.
+FAKE_VIRTUALENV_TOOL = """\
+import os, sys
+root = sys.argv[-1]
+with open(os.path.join(os.path.dirname(__file__), 'runs'), 'a') as f:
+    f.write('run\\n')
+site_packages = os.path.join(root, 'lib', 'python2.7', 'site-packages')
+os.makedirs(os.path.join(root, 'bin'))
+os.makedirs(site_packages)
+files = {
+    'bin/python': 'interpreter',
+    'bin/activate': 'VIRTUAL_ENV="%s"\\n' % (root,),
+    'bin/helper': 'helper',
+    'lib/python2.7/site.py': 'site',
+    'lib/python2.7/site-packages/easy-install.pth': './demo.egg\\n',
+    'lib/python2.7/site-packages/demo.py': 'demo',
+    }
+for rel_path, contents in files.items():
+    with open(os.path.join(root, rel_path), 'w') as f:
+        f.write(contents)
+os.symlink(os.path.join(root, 'lib'), os.path.join(root, 'lib64'))
+"""
+
+
+class VirtualenvTemplateTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'templates')
+        self.tool_path = os.path.join(self.temp_dir, 'virtualenv.py')
+        with open(self.tool_path, 'w') as f:
+            f.write(FAKE_VIRTUALENV_TOOL)
+        # A stand-in interpreter, so the test can change it.
+        self.python_path = os.path.join(self.temp_dir, 'python')
+        with open(self.python_path, 'w') as f:
+            f.write('#!/bin/sh\nexec %s "$@"\n' % (sys.executable,))
+        os.chmod(self.python_path, 0755)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _get_template(self):
+        return digg.dev.hackbuilder.python_virtualenv.get_template(
+                self.python_path, self.tool_path, self.cache_dir)
+
+    def _get_run_count(self):
+        with open(os.path.join(self.temp_dir, 'runs')) as f:
+            return len(f.readlines())
+
+    def _read_file(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_clone(self):
+        template = self._get_template()
+        self.assertEqual(template.fixup_paths, ['bin/activate'])
+        dest_root = os.path.join(self.temp_dir, 'clone')
+        digg.dev.hackbuilder.python_virtualenv.clone_template(template,
+                dest_root)
+
+        def shares_inode(rel_path):
+            return (os.stat(os.path.join(template.root, rel_path)).st_ino ==
+                    os.stat(os.path.join(dest_root, rel_path)).st_ino)
+
+        # Files that later build steps rewrite are copies.
+        for rel_path in ('bin/activate', 'bin/helper',
+                'lib/python2.7/site-packages/easy-install.pth'):
+            self.assertFalse(shares_inode(rel_path), rel_path)
+        self.assertEqual(self._read_file(os.path.join(dest_root,
+                'bin/activate')), 'VIRTUAL_ENV="%s"\n' % (dest_root,))
+        self.assertEqual(self._read_file(os.path.join(dest_root,
+                'bin/helper')), 'helper')
+        for rel_path in ('bin/python', 'lib/python2.7/site.py',
+                'lib/python2.7/site-packages/demo.py'):
+            self.assertTrue(shares_inode(rel_path), rel_path)
+        self.assertEqual(os.readlink(os.path.join(dest_root, 'lib64')),
+                os.path.join(dest_root, 'lib'))
+        self.assertFalse(os.path.exists(os.path.join(dest_root,
+                digg.dev.hackbuilder.python_virtualenv.
+                    TEMPLATE_METADATA_FILENAME)))
+
+    def test_mutable_files(self):
+        is_mutable_file = (
+                digg.dev.hackbuilder.python_virtualenv._is_mutable_file)
+        self.assertTrue(is_mutable_file('bin/activate'))
+        self.assertTrue(is_mutable_file(
+                'lib/python2.7/site-packages/easy-install.pth'))
+        self.assertFalse(is_mutable_file('bin/python'))
+        self.assertFalse(is_mutable_file('bin/python2.7'))
+        self.assertFalse(is_mutable_file('lib/python2.7/os.py'))
+
+    def test_template_cached_until_interpreter_changes(self):
+        template = self._get_template()
+        self.assertEqual(self._get_template().root, template.root)
+        self.assertEqual(self._get_run_count(), 1)
+
+        os.utime(self.python_path, (1000000000, 1000000000))
+        self.assertNotEqual(self._get_template().root, template.root)
+        self.assertEqual(self._get_run_count(), 2)
+
+        with open(self.python_path, 'a') as f:
+            f.write('# A new build of the interpreter.\n')
+        os.utime(self.python_path, (1000000000, 1000000000))
+        self._get_template()
+        self.assertEqual(self._get_run_count(), 3)
+
+
+class MakeRelocatableTests(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.site_packages = os.path.join(self.root, 'lib', 'python2.7',
+                'site-packages')
+        os.makedirs(os.path.join(self.root, 'bin'))
+        os.makedirs(self.site_packages)
+        self.state_path = os.path.join(self.root, 'relocation.json')
+        self.script_path = os.path.join(self.root, 'bin', 'demo')
+        self._write_file(self.script_path,
+                '#!%s/bin/python\n'
+                'from __future__ import print_function\n'
+                'import demo\n' % (self.root,), 0755)
+        self._write_file(os.path.join(self.root, 'bin', 'tool'),
+                '#!/bin/sh\nexec true\n', 0755)
+        self.pth_path = os.path.join(self.site_packages, 'easy-install.pth')
+        self._write_file(self.pth_path,
+                '%s/demo.egg\n'
+                'import sys; sys.__plen = len(sys.path)\n'
+                './other.egg\n'
+                '/usr/lib/python2.7/dist-packages\n' % (self.site_packages,))
+        self.egg_link_path = os.path.join(self.site_packages,
+                'demo.egg-link')
+        self._write_file(self.egg_link_path, '%s/src/demo\n.' % (self.root,))
+        self.opened_paths = []
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def _write_file(self, path, contents, mode=0644):
+        if os.path.exists(path):
+            os.remove(path)
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.chmod(path, mode)
+
+    def _read_file(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def _recording_open(self, path, *args):
+        self.opened_paths.append(path)
+        return open(path, *args)
+
+    def _make_relocatable(self):
+        self.opened_paths = []
+        module = digg.dev.hackbuilder.python_virtualenv
+        module.open = self._recording_open
+        try:
+            module.make_relocatable(self.root, '2.7', self.state_path)
+        finally:
+            del module.open
+
+    def test_relocates_scripts_and_path_files(self):
+        self._make_relocatable()
+        self.assertEqual(self._read_file(self.script_path),
+                '#!/usr/bin/env python2.7\n'
+                'from __future__ import print_function\n'
+                '\n' +
+                digg.dev.hackbuilder.python_virtualenv.
+                    RELOCATABLE_ACTIVATE_LINE + '\n'
+                '\n'
+                'import demo\n')
+        self.assertEqual(stat.S_IMODE(os.stat(self.script_path).st_mode),
+                0755)
+        self.assertEqual(self._read_file(os.path.join(self.root, 'bin',
+                'tool')), '#!/bin/sh\nexec true\n')
+        self.assertEqual(self._read_file(self.pth_path),
+                'demo.egg\n'
+                'import sys; sys.__plen = len(sys.path)\n'
+                './other.egg\n'
+                '/usr/lib/python2.7/dist-packages\n')
+        self.assertEqual(self._read_file(self.egg_link_path),
+                '../../../src/demo\n.\n')
+
+    def test_unchanged_files_not_read_again(self):
+        self._make_relocatable()
+        with open(self.state_path) as f:
+            state = f.read()
+        self._make_relocatable()
+        self.assertEqual(self.opened_paths, [self.state_path])
+        with open(self.state_path) as f:
+            self.assertEqual(f.read(), state)
+
+        # A changed modification time is enough to look at a file again.
+        os.utime(self.pth_path, (1000000000, 1000000000))
+        self._make_relocatable()
+        self.assertTrue(self.pth_path in self.opened_paths)
+        self.assertFalse(self.script_path in self.opened_paths)
+
+        # A script installed again is relocated again.
+        self._write_file(self.script_path,
+                '#!%s/bin/python\nimport demo\n' % (self.root,), 0755)
+        self._make_relocatable()
+        self.assertTrue(self._read_file(self.script_path).startswith(
+                '#!/usr/bin/env python2.7\n\n'))
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
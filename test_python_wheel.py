@@ -0,0 +1,245 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import base64
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import digg.dev.hackbuilder.python_wheel
+import digg.dev.hackbuilder.util
+
+INTERPRETER_INFO = {
+        'version': '2.7',
+        'implementation': 'CPython',
+        'platform': 'linux-x86_64',
+        'maxunicode': 0x10ffff,
+        'prefix': '/usr',
+        }
+
+
+class PythonWheelTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.install_dirs = dict(
+                (scheme, os.path.join(self.temp_dir, 'install', scheme))
+                for scheme in
+                    digg.dev.hackbuilder.python_wheel.WHEEL_INSTALL_SCHEMES)
+        self.wheel_dir = os.path.join(self.temp_dir, 'wheels')
+        os.makedirs(self.wheel_dir)
+        self._write_file('lib/demo/__init__.py', 'VERSION = 1\n')
+        self._write_file('lib/demo_lib-1.0-py2.7.egg-info/PKG-INFO',
+                'Metadata-Version: 1.1\nName: demo-lib\nVersion: 1.0\n')
+        self._write_file('lib/demo_lib-1.0-py2.7.egg-info/entry_points.txt',
+                '[console_scripts]\ndemo = demo:main\n')
+        self._write_file('scripts/demo',
+                '#!/usr/bin/python2.7 -u\nimport demo\n', 0755)
+        self._write_file('data/share/demo/demo.txt', 'data\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, rel_path, contents, mode=0644):
+        path = os.path.join(self.temp_dir, 'install', rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(contents)
+        os.chmod(path, mode)
+
+    def _pack_wheel(self):
+        return digg.dev.hackbuilder.python_wheel._pack_wheel(
+                self.install_dirs, self.wheel_dir, INTERPRETER_INFO)
+
+    def _get_record_hash(self, data):
+        return 'sha256=' + base64.urlsafe_b64encode(
+                hashlib.sha256(data).digest()).rstrip('=')
+
+    def test_pack_wheel(self):
+        wheel_path = self._pack_wheel()
+        self.assertEqual(os.path.basename(wheel_path),
+                'demo_lib-1.0-py2-none-any.whl')
+        self.assertEqual(os.listdir(self.wheel_dir),
+                ['demo_lib-1.0-py2-none-any.whl'])
+        with zipfile.ZipFile(wheel_path) as wheel_zip:
+            self.assertEqual(sorted(wheel_zip.namelist()), [
+                    'demo/__init__.py',
+                    'demo_lib-1.0-py2.7.egg-info/PKG-INFO',
+                    'demo_lib-1.0-py2.7.egg-info/entry_points.txt',
+                    'demo_lib-1.0.data/data/share/demo/demo.txt',
+                    'demo_lib-1.0.data/scripts/demo',
+                    'demo_lib-1.0.dist-info/METADATA',
+                    'demo_lib-1.0.dist-info/RECORD',
+                    'demo_lib-1.0.dist-info/WHEEL',
+                    'demo_lib-1.0.dist-info/entry_points.txt',
+                    ])
+            self.assertTrue('Root-Is-Purelib: true\nTag: py2-none-any\n' in
+                    wheel_zip.read('demo_lib-1.0.dist-info/WHEEL'))
+            script_info = wheel_zip.getinfo('demo_lib-1.0.data/scripts/demo')
+            self.assertEqual(wheel_zip.read(script_info),
+                    '#!python\nimport demo\n')
+            self.assertEqual(stat.S_IMODE(script_info.external_attr >> 16),
+                    0755)
+            self.assertEqual(script_info.date_time,
+                    digg.dev.hackbuilder.python_wheel.ZIP_DATE_TIME)
+
+            records = wheel_zip.read(
+                    'demo_lib-1.0.dist-info/RECORD').splitlines()
+            self.assertEqual(len(records), len(wheel_zip.namelist()))
+            self.assertTrue('demo_lib-1.0.dist-info/RECORD,,' in records)
+            for record in records:
+                (path, record_hash, size) = record.split(',')
+                if path.endswith('/RECORD'):
+                    continue
+                data = wheel_zip.read(path)
+                self.assertEqual(record_hash, self._get_record_hash(data))
+                self.assertEqual(int(size), len(data))
+
+    def test_pack_wheel_is_reproducible(self):
+        with open(self._pack_wheel(), 'rb') as f:
+            first_wheel = f.read()
+        with open(self._pack_wheel(), 'rb') as f:
+            self.assertEqual(f.read(), first_wheel)
+
+    def test_platlib_tag(self):
+        self._write_file('lib/demo/_speedups.so', 'native')
+        wheel_path = self._pack_wheel()
+        self.assertEqual(os.path.basename(wheel_path),
+                'demo_lib-1.0-cp27-cp27mu-linux_x86_64.whl')
+        with zipfile.ZipFile(wheel_path) as wheel_zip:
+            self.assertTrue('Root-Is-Purelib: false\n' in
+                    wheel_zip.read('demo_lib-1.0.dist-info/WHEEL'))
+
+    def test_wheel_tags(self):
+        get_wheel_tag = digg.dev.hackbuilder.python_wheel._get_wheel_tag
+        self.assertEqual(get_wheel_tag(INTERPRETER_INFO, True),
+                'py2-none-any')
+        narrow_info = dict(INTERPRETER_INFO, maxunicode=0xffff,
+                platform='macosx-10.9-x86_64')
+        self.assertEqual(get_wheel_tag(narrow_info, False),
+                'cp27-cp27m-macosx_10_9_x86_64')
+        pypy_info = dict(INTERPRETER_INFO, implementation='PyPy')
+        self.assertEqual(get_wheel_tag(pypy_info, False),
+                'py27-py27mu-linux_x86_64')
+        python3_info = dict(INTERPRETER_INFO, version='3.6')
+        self.assertEqual(get_wheel_tag(python3_info, False),
+                'cp36-cp36-linux_x86_64')
+
+    def test_script_shebangs_made_generic(self):
+        make_generic = (
+                digg.dev.hackbuilder.python_wheel._make_script_shebang_generic)
+        self.assertEqual(make_generic('#!/usr/bin/env python\nmain()\n'),
+                '#!python\nmain()\n')
+        self.assertEqual(make_generic('#!/bin/sh\nexec true\n'),
+                '#!/bin/sh\nexec true\n')
+        self.assertEqual(make_generic('import demo\n'), 'import demo\n')
+
+    def test_install_wheel(self):
+        wheel_path = self._pack_wheel()
+        virtualenv_root = os.path.join(self.temp_dir, 'venv')
+        site_packages_dir = os.path.join(virtualenv_root, 'lib',
+                'python2.7', 'site-packages')
+        init_py_path = os.path.join(site_packages_dir, 'demo', '__init__.py')
+        # Files of a virtualenv cloned from a template are hard links that
+        # installing mustn't write through.
+        os.makedirs(os.path.dirname(init_py_path))
+        template_path = os.path.join(self.temp_dir, 'template_init.py')
+        with open(template_path, 'w') as f:
+            f.write('template\n')
+        os.link(template_path, init_py_path)
+        record_path = os.path.join(self.temp_dir, 'record.txt')
+
+        digg.dev.hackbuilder.python_wheel.install_wheel(wheel_path,
+                virtualenv_root, INTERPRETER_INFO, record_path)
+
+        script_path = os.path.join(virtualenv_root, 'bin', 'demo')
+        dist_info_dir = os.path.join(site_packages_dir,
+                'demo_lib-1.0.dist-info')
+        with open(record_path) as f:
+            self.assertEqual(sorted(f.read().splitlines()), sorted([
+                    init_py_path,
+                    os.path.join(site_packages_dir,
+                        'demo_lib-1.0-py2.7.egg-info', 'PKG-INFO'),
+                    os.path.join(site_packages_dir,
+                        'demo_lib-1.0-py2.7.egg-info', 'entry_points.txt'),
+                    os.path.join(virtualenv_root, 'share', 'demo',
+                        'demo.txt'),
+                    script_path,
+                    os.path.join(dist_info_dir, 'METADATA'),
+                    os.path.join(dist_info_dir, 'RECORD'),
+                    os.path.join(dist_info_dir, 'WHEEL'),
+                    os.path.join(dist_info_dir, 'entry_points.txt'),
+                    ]))
+        with open(script_path) as f:
+            self.assertEqual(f.read(), '#!%s\nimport demo\n' %
+                    (os.path.join(virtualenv_root, 'bin', 'python'),))
+        self.assertEqual(stat.S_IMODE(os.stat(script_path).st_mode), 0755)
+        self.assertFalse(os.stat(init_py_path).st_mode & 0111)
+        with open(init_py_path) as f:
+            self.assertEqual(f.read(), 'VERSION = 1\n')
+        with open(template_path) as f:
+            self.assertEqual(f.read(), 'template\n')
+
+    def test_build_wheel(self):
+        setup_py_dir = os.path.join(self.temp_dir, 'src')
+        os.makedirs(os.path.join(setup_py_dir, 'demo'))
+        with open(os.path.join(setup_py_dir, 'setup.py'), 'w') as f:
+            f.write('from distutils.core import setup\n'
+                    "setup(name='demo-lib', version='1.0', "
+                    "packages=['demo'])\n")
+        with open(os.path.join(setup_py_dir, 'demo', '__init__.py'),
+                'w') as f:
+            f.write('VERSION = 1\n')
+        interpreter_info = (
+                digg.dev.hackbuilder.python_wheel.get_interpreter_info(
+                    sys.executable))
+
+        wheel_path = digg.dev.hackbuilder.python_wheel.build_wheel(
+                sys.executable, setup_py_dir, self.wheel_dir,
+                interpreter_info)
+        self.assertEqual(digg.dev.hackbuilder.python_wheel.find_wheel(
+                self.wheel_dir), wheel_path)
+        # The scratch install is cleaned up.
+        self.assertEqual(os.listdir(self.wheel_dir),
+                [os.path.basename(wheel_path)])
+        with zipfile.ZipFile(wheel_path) as wheel_zip:
+            self.assertEqual(wheel_zip.read('demo/__init__.py'),
+                    'VERSION = 1\n')
+
+    def test_source_tree_hash_changes_with_contents(self):
+        lib_dir = self.install_dirs['lib']
+        init_py_path = os.path.join(lib_dir, 'demo', '__init__.py')
+        tree_hash = digg.dev.hackbuilder.util.hash_directory_tree(lib_dir)
+        self.assertEqual(
+                digg.dev.hackbuilder.util.hash_directory_tree(lib_dir),
+                tree_hash)
+
+        with open(init_py_path, 'w') as f:
+            f.write('VERSION = 2\n')
+        self.assertNotEqual(
+                digg.dev.hackbuilder.util.hash_directory_tree(lib_dir),
+                tree_hash)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
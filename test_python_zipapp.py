@@ -0,0 +1,84 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+import digg.dev.hackbuilder.python_bytecode
+import digg.dev.hackbuilder.python_zipapp
+
+
+class WriteZipAppTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.temp_dir, 'root')
+        self.zipapp_path = os.path.join(self.temp_dir, 'app.pyz')
+        os.makedirs(os.path.join(self.root, 'app'))
+        self._write_file('app/__init__.py', '')
+        self._write_file('app/main.py',
+                'import sys\n'
+                '\n'
+                'def main():\n'
+                '    sys.stdout.write(__file__)\n'
+                '    return 3\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_file(self, rel_path, contents):
+        with open(os.path.join(self.root, rel_path), 'w') as f:
+            f.write(contents)
+
+    def test_zipapp_runs_console_script_from_bytecode(self):
+        digg.dev.hackbuilder.python_bytecode.compile_tree(sys.executable,
+                self.root, os.path.join(self.temp_dir, 'compile.py'),
+                legacy_layout=True, check_source=False)
+        digg.dev.hackbuilder.python_zipapp.write_zipapp(self.zipapp_path,
+                self.root, 'app.main:main', sys.executable)
+
+        zip_file = zipfile.ZipFile(self.zipapp_path)
+        self.assertEqual(sorted(zip_file.namelist()),
+                ['__main__.py', 'app/__init__.py', 'app/__init__.pyc',
+                 'app/main.py', 'app/main.pyc'])
+        zip_file.close()
+
+        zipapp_proc = subprocess.Popen([self.zipapp_path],
+                stdout=subprocess.PIPE)
+        (stdoutdata, stderrdata) = zipapp_proc.communicate()
+        self.assertEqual(zipapp_proc.returncode, 3)
+        self.assertEqual(stdoutdata,
+                os.path.join(self.zipapp_path, 'app', 'main.pyc'))
+
+    def test_find_native_modules(self):
+        self.assertEqual(
+                digg.dev.hackbuilder.python_zipapp.find_native_modules([
+                    'app/_speedups.so',
+                    'app/_fast.cpython-37m-x86_64-linux-gnu.so',
+                    'app.libs/libfoo-1a2b.so.1',
+                    ]),
+                {'app._speedups': 'app/_speedups.so',
+                 'app._fast': 'app/_fast.cpython-37m-x86_64-linux-gnu.so'})
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import tempfile
+import time
+import unittest
+
+import digg.dev.hackbuilder.dir_listing_cache
+import digg.dev.hackbuilder.run_manifest
+import digg.dev.hackbuilder.toolchain
+from digg.dev.hackbuilder.target import TargetID
+
+
+class RunManifestTests(unittest.TestCase):
+    def setUp(self):
+        self.repo_root = tempfile.mkdtemp()
+        self.target_id = TargetID('/tools', 'tool')
+        self.bin_path = os.path.join(self.repo_root, 'hack-build', 'tool')
+        self.src_path = os.path.join(self.repo_root, 'tools', 'tool.py')
+        os.makedirs(os.path.dirname(self.bin_path))
+        os.makedirs(os.path.dirname(self.src_path))
+        self._write_file(self.bin_path, 'binary')
+        self._write_file(self.src_path, 'source')
+        self.input_files = [self.src_path]
+        self.input_dirs = []
+        self.listed_dirs = []
+        self.run_manifest = digg.dev.hackbuilder.run_manifest.RunManifest(
+                self.repo_root)
+
+    def tearDown(self):
+        shutil.rmtree(self.repo_root)
+
+    def _write_file(self, path, contents):
+        with open(path, 'w') as f:
+            f.write(contents)
+
+    def _save(self, build_settings, tool_stamps=None):
+        fingerprint = digg.dev.hackbuilder.run_manifest.fingerprint_inputs(
+                self.repo_root, self.input_files, self.input_dirs,
+                self.listed_dirs, build_settings)
+        self.run_manifest.save_entry(self.target_id, self.bin_path,
+                self.input_files, self.input_dirs, self.listed_dirs,
+                fingerprint, tool_stamps or {})
+
+    def test_unchanged_inputs_are_fresh(self):
+        self._save({'jobs': 1})
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {'jobs': 1}), self.bin_path)
+
+    def test_changes_make_binary_stale(self):
+        self._save({'jobs': 1})
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {'jobs': 2}), None)
+
+        os.utime(self.src_path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {'jobs': 1}), None)
+
+        self._save({'jobs': 1})
+        os.remove(self.bin_path)
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {'jobs': 1}), None)
+
+        self._save({'jobs': 1})
+        os.remove(self.src_path)
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {'jobs': 1}), None)
+
+    def test_undeclared_files_are_not_inputs(self):
+        self._save({})
+        self._write_file(os.path.join(self.repo_root, 'tools', 'notes.txt'),
+                'notes')
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), self.bin_path)
+
+    def test_new_glob_matches_make_binary_stale(self):
+        tools_dir = os.path.dirname(self.src_path)
+        # The directory was last modified before the binary was built.
+        os.utime(tools_dir, (time.time() - 10, time.time() - 10))
+        listed_dirs = set()
+        dir_listing_cache = (
+                digg.dev.hackbuilder.dir_listing_cache.DirListingCache(
+                    os.path.join(self.repo_root, 'dir_listing_cache.json')))
+        self.assertEqual(dir_listing_cache.glob(tools_dir, ['*.py'],
+                listed_dirs=listed_dirs), ['tool.py'])
+        self.listed_dirs = sorted(listed_dirs)
+        self._save({})
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), self.bin_path)
+
+        self._write_file(os.path.join(tools_dir, 'helper.py'), 'helper')
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), None)
+
+    def test_changed_tools_make_binary_stale(self):
+        tool_path = os.path.join(self.repo_root, 'tool')
+        self._write_file(tool_path, 'tool')
+        self._save({}, {tool_path:
+            digg.dev.hackbuilder.toolchain.get_tool_stamp(tool_path)})
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), self.bin_path)
+
+        os.utime(tool_path, (time.time() + 10, time.time() + 10))
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), None)
+
+    def test_build_outputs_are_not_inputs(self):
+        self.input_files = []
+        self.input_dirs = [self.repo_root]
+        self._save({})
+        self._write_file(self.bin_path, 'rebuilt binary')
+        self._write_file(self.src_path + 'c', 'bytecode')
+        self.assertEqual(self.run_manifest.get_fresh_bin_path(self.target_id,
+                {}), self.bin_path)
+
+    def test_input_dirs_leave_out_nested_dirs(self):
+        class FakeTarget(object):
+            def __init__(self, input_dir):
+                self.input_dir = input_dir
+
+            def get_input_paths(self):
+                return ([], [self.input_dir])
+
+        input_dirs = digg.dev.hackbuilder.run_manifest.get_input_dirs([
+                FakeTarget('/repo/a'), FakeTarget('/repo/a/b'),
+                FakeTarget('/repo/ab/')])
+        self.assertTrue('/repo/a' in input_dirs)
+        self.assertTrue('/repo/ab' in input_dirs)
+        self.assertFalse('/repo/a/b' in input_dirs)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
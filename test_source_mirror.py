@@ -0,0 +1,105 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.source_mirror
+
+
+class MirrorTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.src_root = os.path.join(self.temp_dir, 'src')
+        self.dest_root = os.path.join(self.temp_dir, 'dest')
+        self.manifest_path = os.path.join(self.temp_dir, 'manifest')
+        os.makedirs(os.path.join(self.src_root, 'pkg', 'sub'))
+        self._write_src_file('pkg/__init__.py')
+        self._write_src_file('pkg/sub/mod.py')
+        self._write_src_file('setup.py')
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_src_file(self, rel_path):
+        with open(os.path.join(self.src_root, rel_path), 'w') as f:
+            f.write(rel_path)
+
+    def _mirror(self):
+        digg.dev.hackbuilder.source_mirror.mirror_tree(self.src_root,
+                self.dest_root, self.manifest_path)
+
+    def _read_dest_file(self, rel_path):
+        with open(os.path.join(self.dest_root, rel_path)) as f:
+            return f.read()
+
+    def test_mirror_symlinks_files(self):
+        self._mirror()
+        mod_path = os.path.join(self.dest_root, 'pkg', 'sub', 'mod.py')
+        self.assertTrue(os.path.islink(mod_path))
+        self.assertEqual(os.readlink(mod_path),
+                os.path.join('..', '..', '..', 'src', 'pkg', 'sub', 'mod.py'))
+        self.assertEqual(self._read_dest_file('setup.py'), 'setup.py')
+
+    def test_unchanged_tree_left_untouched(self):
+        self._mirror()
+        os.remove(os.path.join(self.dest_root, 'setup.py'))
+        self._mirror()
+        self.assertFalse(os.path.lexists(os.path.join(self.dest_root,
+                'setup.py')))
+
+    def test_removed_files_pruned(self):
+        self._mirror()
+        # Files that other targets put in the mirror are left alone.
+        with open(os.path.join(self.dest_root, 'pkg', 'sub', 'other.py'),
+                'w') as f:
+            f.write('other')
+        shutil.rmtree(os.path.join(self.src_root, 'pkg', 'sub'))
+        os.remove(os.path.join(self.src_root, 'setup.py'))
+        self._write_src_file('pkg/new.py')
+        self._mirror()
+
+        self.assertFalse(os.path.lexists(os.path.join(self.dest_root,
+                'setup.py')))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest_root,
+                'pkg', 'sub'))), ['other.py'])
+        self.assertEqual(self._read_dest_file('pkg/new.py'), 'pkg/new.py')
+
+    def test_emptied_directories_removed(self):
+        self._mirror()
+        shutil.rmtree(os.path.join(self.src_root, 'pkg', 'sub'))
+        self._mirror()
+        self.assertEqual(os.listdir(os.path.join(self.dest_root, 'pkg')),
+                ['__init__.py'])
+
+    def test_empty_directories_and_dir_symlinks_mirrored(self):
+        os.makedirs(os.path.join(self.src_root, 'pkg', 'empty'))
+        os.symlink('sub', os.path.join(self.src_root, 'pkg', 'sub_link'))
+        self._mirror()
+        self.assertEqual(os.listdir(os.path.join(self.dest_root, 'pkg',
+                'empty')), [])
+        link_path = os.path.join(self.dest_root, 'pkg', 'sub_link')
+        self.assertTrue(os.path.islink(link_path))
+        self.assertEqual(os.readlink(link_path),
+                os.path.join('..', '..', 'src', 'pkg', 'sub_link'))
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
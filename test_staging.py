@@ -0,0 +1,88 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.staging
+
+
+class StageTreeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.src_root = os.path.join(self.temp_dir, 'src')
+        self.dest_root = os.path.join(self.temp_dir, 'dest')
+        self.manifest_path = os.path.join(self.temp_dir, 'manifest')
+        os.makedirs(os.path.join(self.src_root, 'lib'))
+        self._write_src_file('lib/a.py', 'a')
+        self._write_src_file('b.txt', 'b')
+        os.symlink('lib', os.path.join(self.src_root, 'lib64'))
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write_src_file(self, rel_path, contents):
+        with open(os.path.join(self.src_root, rel_path), 'w') as f:
+            f.write(contents)
+
+    def _stage(self, source_date_epoch=None):
+        digg.dev.hackbuilder.staging.stage_tree(self.src_root,
+                self.dest_root, self.manifest_path, source_date_epoch)
+
+    def test_stage_links_files(self):
+        self._stage()
+        src_stat = os.stat(os.path.join(self.src_root, 'lib', 'a.py'))
+        dest_stat = os.stat(os.path.join(self.dest_root, 'lib', 'a.py'))
+        self.assertEqual(src_stat.st_ino, dest_stat.st_ino)
+        self.assertEqual(os.readlink(os.path.join(self.dest_root, 'lib64')),
+                'lib')
+
+    def test_unchanged_tree_left_untouched(self):
+        self._stage()
+        dest_path = os.path.join(self.dest_root, 'b.txt')
+        os.remove(dest_path)
+        self._stage()
+        self.assertFalse(os.path.exists(dest_path))
+
+    def test_restage_removes_stale_and_adds_new(self):
+        self._stage()
+        os.remove(os.path.join(self.src_root, 'lib', 'a.py'))
+        os.remove(os.path.join(self.src_root, 'b.txt'))
+        self._write_src_file('b.txt', 'new b')
+        self._write_src_file('lib/c.py', 'c')
+        self._stage()
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dest_root,
+                'lib'))), ['c.py'])
+        with open(os.path.join(self.dest_root, 'b.txt')) as f:
+            self.assertEqual(f.read(), 'new b')
+
+    def test_reproducible_stage_copies_and_clamps(self):
+        os.chmod(os.path.join(self.src_root, 'b.txt'), 0600)
+        self._stage(1000000000)
+        src_stat = os.stat(os.path.join(self.src_root, 'b.txt'))
+        dest_stat = os.stat(os.path.join(self.dest_root, 'b.txt'))
+        self.assertNotEqual(src_stat.st_ino, dest_stat.st_ino)
+        self.assertEqual(dest_stat.st_mode & 0777, 0644)
+        self.assertEqual(dest_stat.st_mtime, 1000000000)
+        self.assertEqual(os.stat(self.dest_root).st_mtime, 1000000000)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
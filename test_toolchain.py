@@ -0,0 +1,78 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+import digg.dev.hackbuilder.errors
+from digg.dev.hackbuilder.toolchain import ToolchainProbes
+
+
+class ToolchainProbesTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.temp_dir, 'probes.json')
+        self.count_path = os.path.join(self.temp_dir, 'count')
+        self.tool_path = os.path.join(self.temp_dir, 'tool')
+        self._write_tool('echo "$HACK_TEST_ARCH-$1"')
+
+    def tearDown(self):
+        os.environ.pop('HACK_TEST_ARCH', None)
+        shutil.rmtree(self.temp_dir)
+
+    def _write_tool(self, command, mtime=1000000000):
+        with open(self.tool_path, 'w') as f:
+            f.write('#!/bin/sh\necho run >> %s\n%s\n' % (self.count_path,
+                command))
+        os.chmod(self.tool_path, 0755)
+        os.utime(self.tool_path, (mtime, mtime))
+
+    def _get_run_count(self):
+        with open(self.count_path) as f:
+            return len(f.readlines())
+
+    def _probe(self):
+        probes = ToolchainProbes(self.cache_path)
+        output = probes.probe(self.tool_path, ['x'],
+                env_var_names=('HACK_TEST_ARCH',))
+        probes.save()
+        return output
+
+    def test_probe_runs_once_per_change(self):
+        os.environ['HACK_TEST_ARCH'] = 'amd64'
+        self.assertEqual(self._probe(), 'amd64-x\n')
+        self.assertEqual(self._probe(), 'amd64-x\n')
+        self.assertEqual(self._get_run_count(), 1)
+
+        os.environ['HACK_TEST_ARCH'] = 'i386'
+        self.assertEqual(self._probe(), 'i386-x\n')
+        self.assertEqual(self._get_run_count(), 2)
+
+        self._write_tool('echo changed', mtime=1000000001)
+        self.assertEqual(self._probe(), 'changed\n')
+        self.assertEqual(self._get_run_count(), 3)
+
+    def test_failed_probe_raises(self):
+        self._write_tool('exit 3')
+        self.assertRaises(digg.dev.hackbuilder.errors.Error, self._probe)
+
+
+def main():
+    unittest.main(__name__)
+
+if __name__ == '__main__':
+    main()
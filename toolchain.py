@@ -0,0 +1,218 @@
+#  Copyright 2012 Ooyala, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import distutils.spawn
+import errno
+import json
+import logging
+import os
+import os.path
+import subprocess
+import threading
+import time
+
+import digg.dev.hackbuilder.errors
+import digg.dev.hackbuilder.util
+
+TOOLCHAIN_CACHE_VERSION = 1
+TOOLCHAIN_CACHE_FILENAME = 'toolchain_probes.json'
+# Probes of tools modified this recently aren't saved, since the tool could
+# change again without its stamp changing.
+RACY_MTIME_SECONDS = 2
+
+_toolchain_probes = {}
+_toolchain_probes_lock = threading.Lock()
+
+
+def get_toolchain_probes(cache_root):
+    """Get the toolchain probe cache kept in a cache directory.
+
+    The cache is shared by everything in the process, so each tool is only
+    probed once per change to it.
+
+    Args:
+        cache_root: The absolute path of the hack-cache directory
+    """
+    with _toolchain_probes_lock:
+        if cache_root not in _toolchain_probes:
+            _toolchain_probes[cache_root] = ToolchainProbes(os.path.join(
+                    cache_root, TOOLCHAIN_CACHE_FILENAME))
+        return _toolchain_probes[cache_root]
+
+
+def save_toolchain_probes():
+    """Save every toolchain probe cache of the process with new results."""
+    with _toolchain_probes_lock:
+        toolchain_probes = _toolchain_probes.values()
+    for probes in toolchain_probes:
+        probes.save()
+
+
+def find_tool(tool):
+    """Get the absolute real path of a tool, searching PATH for bare names.
+
+    Raises:
+        digg.dev.hackbuilder.errors.Error: if the tool can't be found
+    """
+    if os.path.sep in tool:
+        tool_path = tool
+    else:
+        tool_path = distutils.spawn.find_executable(tool)
+    if tool_path is None or not os.path.exists(tool_path):
+        raise digg.dev.hackbuilder.errors.Error(
+                'Tool (%s) not found.' % (tool,))
+    return os.path.realpath(tool_path)
+
+
+def get_tool_stamp(tool_path):
+    """Get the stamp of a tool, which changes whenever the tool does.
+
+    Args:
+        tool_path: The absolute real path of the tool
+
+    Returns: A list suitable for JSON, or None if the tool is gone.
+    """
+    try:
+        tool_stat = os.stat(tool_path)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+    return [tool_stat.st_ino, tool_stat.st_size, tool_stat.st_mtime]
+
+
+def tool_stamps_unchanged(tool_stamps):
+    """Check if tools are unchanged since their stamps were taken.
+
+    Args:
+        tool_stamps: dict of tool stamps keyed by tool path, as returned by
+            ToolchainProbes.get_tool_stamps
+    """
+    return all(get_tool_stamp(tool_path) == tool_stamp
+               for tool_path, tool_stamp in tool_stamps.iteritems())
+
+
+class ToolchainProbes(object):
+    """The output of commands that describe the tools a build uses.
+
+    A probe runs a tool with some arguments and keeps what it prints. The
+    result is reused for as long as the tool keeps its stamp and the
+    environment variables the probe depends on keep their values.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = None
+        self._tool_stamps = {}
+        self._dirty = False
+
+    def probe(self, tool, args, env_var_names=()):
+        """Get the output of a tool, running it only if it changed.
+
+        Args:
+            tool: The name or path of the tool
+            args: The arguments to run the tool with
+            env_var_names: The environment variables that change the output
+
+        Returns: What the tool printed on stdout.
+
+        Raises:
+            digg.dev.hackbuilder.errors.Error: if the tool fails
+        """
+        tool_path = find_tool(tool)
+        tool_stamp = get_tool_stamp(tool_path)
+        key = json.dumps([tool_path, list(args),
+                dict((name, os.environ.get(name)) for name in env_var_names)],
+                sort_keys=True)
+        with self._lock:
+            self._tool_stamps[tool_path] = tool_stamp
+            entry = self._load().get(key)
+        if entry is not None and entry['stamp'] == tool_stamp:
+            return entry['output']
+
+        logging.info('Probing tool: %s %s', tool_path, ' '.join(args))
+        proc = subprocess.Popen([tool_path] + list(args),
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, close_fds=True)
+        (stdoutdata, stderrdata) = proc.communicate()
+        retcode = proc.returncode
+        if retcode != 0:
+            logging.info('Probe failed with exit code = %s', retcode)
+            logging.info('Probe stdout:\n%s', stdoutdata)
+            logging.info('Probe stderr:\n%s', stderrdata)
+            raise digg.dev.hackbuilder.errors.Error(
+                    'Probing tool (%s) failed.' % (tool_path,))
+
+        with self._lock:
+            self._entries[key] = {
+                    'stamp': tool_stamp,
+                    'output': stdoutdata,
+                    'racy': time.time() - tool_stamp[2] < RACY_MTIME_SECONDS,
+                    }
+            self._dirty = True
+        return stdoutdata
+
+    def get_tool_stamps(self):
+        """Get the stamps of the tools probed by this process.
+
+        Results that depend on probes stay valid for as long as
+        tool_stamps_unchanged is true for these stamps.
+
+        Returns: A dict of tool stamps keyed by tool path.
+        """
+        with self._lock:
+            return dict(self._tool_stamps)
+
+    def save(self):
+        """Save the probe results if any were added since they were loaded."""
+        with self._lock:
+            if not self._dirty:
+                return
+            entries = dict((key, {'stamp': entry['stamp'],
+                                  'output': entry['output']})
+                           for key, entry in self._entries.iteritems()
+                           if not entry['racy'])
+            self._dirty = False
+
+        digg.dev.hackbuilder.util.makedirs_if_not_exists(
+                os.path.dirname(self.path))
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        with open(temp_path, 'w') as f:
+            json.dump({'version': TOOLCHAIN_CACHE_VERSION,
+                       'entries': entries}, f, sort_keys=True, indent=4)
+        os.rename(temp_path, self.path)
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = {}
+        try:
+            with open(self.path) as f:
+                cache_data = json.load(f)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return self._entries
+        except ValueError:
+            logging.warning('Ignoring corrupt toolchain probe cache: %s',
+                    self.path)
+            return self._entries
+        if (isinstance(cache_data, dict) and
+                cache_data.get('version') == TOOLCHAIN_CACHE_VERSION):
+            self._entries = dict(
+                    (key, {'stamp': entry['stamp'],
+                           'output': entry['output'].encode('utf-8'),
+                           'racy': False})
+                    for key, entry in cache_data['entries'].iteritems())
+        return self._entries
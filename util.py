@@ -13,12 +13,33 @@
 #  limitations under the License.
 
 import errno
+import fcntl
+import hashlib
 import logging
+import multiprocessing
+import multiprocessing.pool
 import os
 import os.path
+import shutil
 
 import digg.dev.hackbuilder.errors
 
+# Timeout used when waiting on worker pools. Waiting with a timeout, however
+# long, keeps the main thread responsive to KeyboardInterrupt.
+_POOL_WAIT_TIMEOUT = 60 * 60 * 24 * 365
+
+# The Linux ioctl that makes a file share the data blocks of another file on
+# filesystems that support copy on write (e.g. btrfs and xfs).
+_FICLONE = 0x40049409
+
+# Errors that mean a file can't be cloned or hard linked, but copying it may
+# still work.
+_LINK_FALLBACK_ERRNOS = frozenset((errno.EXDEV, errno.EPERM, errno.EACCES,
+        errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+        errno.ENOSYS, errno.EBADF))
+
+_COPY_CHUNK_SIZE = 1 << 20
+
 def get_root_of_repo_directory_tree(path='.'):
     """Find the root of the repository.
 
@@ -93,51 +114,171 @@ def makedirs_if_not_exists(name, mode=0777):
     logging.debug('Recursively made directory: %s', name)
 
 
-def mirror_filesystem_hierarchy(from_path, to_path):
-    """Create symlinked file hierarchy.
+def run_in_parallel(function, items, jobs=None):
+    """Call a function on each item using a pool of worker threads.
+
+    This is meant for work that spends most of its time outside of the
+    interpreter (e.g. waiting on subprocesses or doing I/O), so threads are
+    good enough to keep several items in flight at once.
+
+    Args:
+        function: The function to call with each item
+        items: An iterable of the items to process
+        jobs: The maximum number of items to process at once. This defaults
+            to the number of CPUs.
+
+    Returns: A list of the results of calling function on each item in the
+        same order as items.
+
+    Raises:
+        Any exception raised by function. The remaining items may or may not
+        have been processed when this happens.
+    """
+    items = list(items)
+    if jobs is None:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(items))
+    if jobs <= 1:
+        return [function(item) for item in items]
+
+    pool = multiprocessing.pool.ThreadPool(jobs)
+    try:
+        return pool.map_async(function, items).get(_POOL_WAIT_TIMEOUT)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def hash_file(path, algorithm='sha256'):
+    """Get the hex digest of the contents of a file.
+
+    Args:
+        path: The path of the file
+        algorithm: The name of a hashlib algorithm
+    """
+    file_hash = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(_COPY_CHUNK_SIZE), ''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def hash_directory_tree(path, digest_cache=None):
+    """Get a hash of the contents of a directory tree.
+
+    The hash covers the relative path, executable bit and contents of every
+    file as well as the targets of symlinks, so it changes whenever anything
+    in the tree that could affect a build changes.
+
+    Args:
+        path: The filesystem path of the root of the directory tree
+        digest_cache: A digg.dev.hackbuilder.digest.DigestCache to get the
+            digests of the files from, or None to hash every file
+
+    Returns: A hex digest string.
+    """
+    entries = []
+    file_paths = []
+    for dirpath, subdirs, filenames in os.walk(path):
+        subdirs.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(dirpath, filename)
+            rel_path = os.path.relpath(full_path, path)
+            if os.path.islink(full_path) and not os.path.exists(full_path):
+                entries.append(('L %s %s' % (rel_path,
+                    os.readlink(full_path)), False))
+                continue
+
+            is_executable = os.access(full_path, os.X_OK)
+            entries.append(('F %s %d %d' % (rel_path, is_executable,
+                os.path.getsize(full_path)), True))
+            file_paths.append(full_path)
+
+    if digest_cache is None:
+        file_digests = [hash_file(file_path, 'sha1')
+                        for file_path in file_paths]
+    else:
+        file_digests = digest_cache.get_digests(file_paths, 'sha1')
+
+    tree_hash = hashlib.sha1()
+    file_digests = iter(file_digests)
+    for entry, is_file in entries:
+        if is_file:
+            entry += ' ' + next(file_digests)
+        tree_hash.update(entry + '\0')
+    return tree_hash.hexdigest()
+
 
-    This function will mirror a filesystem hierarchy into the to_path from the
-    from_path. The directory hierarchy will be handled my creating directories
-    in a mirror image of the directories in the from_path. The other files will
-    be symlinks from their location in the from_path to the location in the
-    to_path.
+def copy_file(src, dst):
+    """Copy a file as cheaply as the filesystem allows.
+
+    The copy is a reflink sharing the data blocks of the source where the
+    filesystem supports it. Otherwise, the data is copied in large chunks.
+    The permission bits are copied too.
 
     Args:
-        from_path: the filesystem path of the root of the source location to
-                mirror
-        to_path: the filesystem path of the root to where the source hierarchy
-                will be mirrored
+        src: The path of the file to copy
+        dst: The path of the copy. It must not exist yet.
     """
-    logging.debug('Mirroring filesystem hierarchy from (%s) to (%s).',
-            from_path, to_path)
-    makedirs_if_not_exists(to_path)
-    for path, subdirs, filenames in os.walk(from_path):
-        # make directories
-        logging.debug('Path: %s', path)
-        for subdir in subdirs:
-            rel_dir = os.path.relpath(os.path.join(path, subdir), from_path)
-            full_to_path = os.path.join(to_path, rel_dir)
-            mkdir_if_not_exists(full_to_path)
-
-        # make symlinks
-        logging.debug('Files: %s', filenames)
-        for filename in filenames:
-            rel_file_path = os.path.relpath(
-                    os.path.join(path, filename), from_path)
-            full_from_path = os.path.join(from_path, rel_file_path)
-            full_to_path = os.path.join(to_path, rel_file_path)
-            rel_from_path = os.path.relpath(full_from_path,
-                    os.path.dirname(full_to_path))
+    with open(src, 'rb') as src_file:
+        with open(dst, 'wb') as dst_file:
             try:
-                os.symlink(rel_from_path, full_to_path)
-                logging.debug('Symlinked %s to %s.', full_to_path,
-                        rel_from_path)
-            except OSError, e:
-                if e.errno != errno.EEXIST:
+                fcntl.ioctl(dst_file.fileno(), _FICLONE, src_file.fileno())
+            except (IOError, OSError), e:
+                if e.errno not in _LINK_FALLBACK_ERRNOS:
                     raise
-                logging.debug('File already existed: %s', full_to_path)
-                if os.readlink(full_to_path) != rel_from_path:
-                    logging.debug('Symlink incorrect. Removing and '
-                            'symlinking %s to %s', full_to_path, rel_from_path)
-                    os.remove(full_to_path)
-                    os.symlink(rel_from_path, full_to_path)
+                shutil.copyfileobj(src_file, dst_file, _COPY_CHUNK_SIZE)
+    shutil.copymode(src, dst)
+
+
+def link_or_copy_file(src, dst):
+    """Hard link a file, or copy it if that isn't possible.
+
+    Only use this for files that will not be modified in place afterwards,
+    since a hard link shares its contents with the source.
+
+    Args:
+        src: The path of the file to link
+        dst: The path of the link. It must not exist yet.
+    """
+    try:
+        os.link(src, dst)
+    except OSError, e:
+        if e.errno not in _LINK_FALLBACK_ERRNOS:
+            raise
+        copy_file(src, dst)
+
+
+def write_checksum_file(path, digest_cache=None):
+    """Write the SHA-256 checksum of a file next to it.
+
+    The checksum file is named after the file with a .sha256 suffix and is in
+    the format read by "sha256sum -c". Comparing checksum files lets
+    publishing steps skip artifacts that did not change.
+
+    Args:
+        path: The path of the file to checksum
+        digest_cache: A digg.dev.hackbuilder.digest.DigestCache to get the
+            digest from, or None to hash the file
+
+    Returns: A tuple of the hex digest and whether it differs from the one
+        previously recorded.
+    """
+    if digest_cache is None:
+        digest = hash_file(path)
+    else:
+        digest = digest_cache.get_digest(path)
+    checksum_text = '%s  %s\n' % (digest, os.path.basename(path))
+
+    checksum_path = path + '.sha256'
+    try:
+        with open(checksum_path) as f:
+            if f.read() == checksum_text:
+                return (digest, False)
+    except IOError, e:
+        if e.errno != errno.ENOENT:
+            raise
+
+    with open(checksum_path, 'w') as f:
+        f.write(checksum_text)
+    return (digest, True)